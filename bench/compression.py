@@ -0,0 +1,165 @@
+"""
+Сколько токенов экономит подготовка писем и насколько меняется результат.
+
+    python -m bench.compression --budget 500 1000 2000
+    python -m bench.compression --budget 1000 --digest --quality --limit 50
+
+Без --digest считает токены по корпусу: исходные письма, после нормализации и
+сколько писем превышает бюджет (для них размер сжатого письма оценивается бюджетом).
+С --digest длинные письма сжимаются моделью (адрес из LLM_BASE_URL, можно указать
+на bench.fake_upstreams), с --quality для них дополнительно сравниваются эмоции
+полного и сжатого письма. Эмоции полного письма определяются дважды: их
+расхождение между собой - шум модели, с которым стоит сравнивать.
+
+Письмо уходит в модель дважды на запрос (анализ эмоций и история), поэтому
+экономия на запрос - удвоенная разница токенов.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+from typing import Optional
+
+from src.batch import BASE_URL, MODEL, iter_letters
+from src.compression import count_tokens, normalize_letter
+
+# сколько раз письмо уходит в модель при генерации истории
+SENDS_PER_REQUEST = 2
+
+
+def emotion_overlap(a: str, b: str) -> float:
+    """Доля общих эмоций (коэффициент Жаккара)"""
+    left = {e.strip().lower() for e in a.split(",") if e.strip()}
+    right = {e.strip().lower() for e in b.split(",") if e.strip()}
+    if not left and not right:
+        return 1.0
+    return len(left & right) / len(left | right)
+
+
+def token_report(letters: list[str], budget: int, digests: Optional[dict[int, str]] = None) -> dict:
+    raw = [count_tokens(text) for text in letters]
+    normalized = [count_tokens(normalize_letter(text)) for text in letters]
+    over = [i for i, tokens in enumerate(normalized) if tokens > budget]
+    prepared = list(normalized)
+    for i in over:
+        if digests is not None and i in digests:
+            prepared[i] = count_tokens(digests[i])
+        elif digests is None:
+            prepared[i] = budget
+    return {
+        "budget": budget,
+        "letters": len(letters),
+        "over_budget": len(over),
+        "tokens_raw": sum(raw),
+        "tokens_normalized": sum(normalized),
+        "tokens_prepared": sum(prepared),
+        "saved_per_request": SENDS_PER_REQUEST * (sum(raw) - sum(prepared)) / max(len(letters), 1),
+        "saved_share": 1 - sum(prepared) / sum(raw) if sum(raw) else 0.0,
+        "max_raw": max(raw, default=0),
+        "max_prepared": max(prepared, default=0),
+        "estimated": digests is None,
+    }
+
+
+async def measure_digests(letters: list[str], budget: int, quality: bool, concurrency: int) -> tuple[dict, dict]:
+    from src.agentsystem import AgentSystem
+    from src.ratelimit import RateLimiter
+
+    agent = AgentSystem(
+        model=os.getenv("LLM_MODEL") or MODEL,
+        base_url=os.getenv("LLM_BASE_URL") or BASE_URL,
+        api_key=os.getenv("OPENROUTEREGORGIT"),
+        temperature=0.7,
+        top_p=0.8,
+        rate_limiter=RateLimiter(),
+        letter_token_budget=budget,
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+    digests: dict[int, str] = {}
+    overlaps, noise = [], []
+
+    async def one(i: int, text: str):
+        async with semaphore:
+            normalized = normalize_letter(text)
+            digests[i] = await agent.aprepare_letter(text)
+            if quality:
+                full, again, short = await asyncio.gather(
+                    agent._analyze_emotions(normalized),
+                    agent._analyze_emotions(normalized),
+                    agent._analyze_emotions(digests[i]),
+                )
+                overlaps.append(emotion_overlap(full, short))
+                noise.append(emotion_overlap(full, again))
+
+    try:
+        over = [(i, text) for i, text in enumerate(letters) if count_tokens(normalize_letter(text)) > budget]
+        await asyncio.gather(*(one(i, text) for i, text in over))
+    finally:
+        await agent.aclose()
+    quality_report = {}
+    if quality and overlaps:
+        quality_report = {
+            "emotion_overlap_digest": statistics.mean(overlaps),
+            "emotion_overlap_noise": statistics.mean(noise),
+        }
+    return digests, quality_report
+
+
+def print_report(reports: list[dict]) -> None:
+    header = f"{'бюджет':>7} {'длинных':>8} {'исходно':>9} {'норм.':>9} {'в модель':>9} {'экономия':>9} {'на запрос':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in reports:
+        mark = "~" if r["estimated"] else " "
+        print(
+            f"{r['budget']:>7} {r['over_budget']:>8} {r['tokens_raw']:>9} {r['tokens_normalized']:>9} "
+            f"{r['tokens_prepared']:>8}{mark} {r['saved_share']:>8.1%} {r['saved_per_request']:>10.0f}"
+        )
+        if "emotion_overlap_digest" in r:
+            print(
+                f"        эмоции сжатого письма совпадают с полным на {r['emotion_overlap_digest']:.0%}, "
+                f"полное с самим собой - на {r['emotion_overlap_noise']:.0%}"
+            )
+    if any(r["estimated"] for r in reports):
+        print("~ размер сжатых писем оценен бюджетом, для точного счета запустите с --digest")
+
+
+async def amain(args: argparse.Namespace) -> list[dict]:
+    letters = [text for _, text in iter_letters(args.input, args.limit)]
+    reports = []
+    for budget in args.budget:
+        if args.digest:
+            digests, quality = await measure_digests(letters, budget, args.quality, args.concurrency)
+            reports.append({**token_report(letters, budget, digests), **quality})
+        else:
+            reports.append(token_report(letters, budget))
+    return reports
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Экономия токенов от подготовки писем")
+    parser.add_argument("--input", default="data/letters.pkl", help="data/letters.pkl или data/letters.bin")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--budget", type=int, nargs="+", default=[1000])
+    parser.add_argument("--digest", action="store_true", help="сжимать длинные письма моделью")
+    parser.add_argument("--quality", action="store_true", help="сравнить эмоции полного и сжатого письма")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--save", default=None, help="куда сохранить результат в json")
+    args = parser.parse_args()
+    if args.quality and not args.digest:
+        parser.error("--quality работает только вместе с --digest")
+
+    load_dotenv()
+    reports = asyncio.run(amain(args))
+    print_report(reports)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
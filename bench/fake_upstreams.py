@@ -0,0 +1,210 @@
+"""
+Локальные заглушки всех внешних сервисов для бенчмарков.
+
+Один процесс отвечает за:
+- OpenAI-совместимый чат (/v1/chat/completions, в том числе stream=true);
+- Freepik Mystic (/freepik/v1/ai/mystic);
+- gen-api Suno (/genapi/api/v1/networks/suno, /genapi/api/v1/request/get/{id}),
+  с callback_url в запросе - вебхук о готовности;
+- сервис писем (/letters/?letter_id=...).
+
+Задержки настраиваются аргументами командной строки:
+
+    python -m bench.fake_upstreams --port 9100 --llm-latency 0.5 --tokens-per-sec 50
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+import uuid
+from dataclasses import dataclass
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+
+@dataclass
+class FakeConfig:
+    llm_latency: float = 0.3  # время до первого токена
+    tokens_per_sec: float = 100.0
+    image_seconds: float = 3.0  # через сколько секунд картинка готова
+    song_seconds: float = 15.0
+    letter_latency: float = 0.02
+
+
+config = FakeConfig()
+app = FastAPI()
+_tasks: dict[str, tuple[float, str]] = {}
+_ids = itertools.count(1)
+
+LETTER = (
+    "Здравствуй, дорогая мама! Пишу тебе с фронта. У нас все хорошо, кормят сытно, "
+    "вчера было тихо. Очень скучаю по дому и жду, когда закончится война и мы встретимся. "
+    "Передавай привет сестре. Твой сын."
+)
+
+
+def answer(prompt: str) -> str:
+    """Правдоподобный ответ на каждый промт из src/prompts.py"""
+    if "JSON" in prompt:
+        return '{"is_military": true, "has_emotions": true, "emotions": ["грусть", "надежда"]}'
+    if 'ответь "Да", иначе' in prompt or "Больше ничего в ответ не включай, только \"Да\"" in prompt:
+        return "Да"
+    if "какие у пользователя требования" in prompt or "психолог" in prompt:
+        return "Мои мысли: автор скучает по дому.\nЭмоции и чувства: тоска, надежда, любовь, тревога, гордость"
+    if "извлечь только проверяемые" in prompt:
+        return "1941 год - начало войны"
+    if "профессиональный историк" in prompt:
+        return "Все четко"
+    if "заголовок для песни" in prompt:
+        return "Письмо домой"
+    if "куплеты" in prompt:
+        return "Куплет 1\nЯ пишу тебе, мама, с фронта\nКуплет 2\nСкоро вернусь домой"
+    if "архивист" in prompt:
+        letter = prompt.split("Письмо:\n", 1)[-1].split("\n\nВ ответе", 1)[0]
+        return " ".join(letter.split()[:150])
+    if "литератор" in prompt:
+        return "A young soviet soldier writes a letter home by candlelight in a trench, 1943."
+    return " ".join(["Солдат сидел в окопе и писал письмо домой."] * 20)
+
+
+def _count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _delay_for(text: str) -> float:
+    return config.llm_latency + _count_tokens(text) / config.tokens_per_sec
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    prompt = "\n".join(str(message.get("content", "")) for message in body.get("messages", []))
+    text = answer(prompt)
+    model = body.get("model", "fake")
+    usage = {
+        "prompt_tokens": _count_tokens(prompt),
+        "completion_tokens": _count_tokens(text),
+        "total_tokens": _count_tokens(prompt) + _count_tokens(text),
+    }
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+    if not body.get("stream"):
+        await asyncio.sleep(_delay_for(text))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    async def stream():
+        await asyncio.sleep(config.llm_latency)
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(_count_tokens(word) / config.tokens_per_sec)
+        final = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+        yield f"data: {json.dumps(final)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+def _new_task(ready_in: float, result: str) -> str:
+    task_id = str(next(_ids))
+    _tasks[task_id] = (time.monotonic() + ready_in, result)
+    return task_id
+
+
+@app.post("/freepik/v1/ai/mystic")
+async def freepik_create():
+    task_id = _new_task(config.image_seconds, "http://fake/image.png")
+    return {"data": {"task_id": task_id, "status": "CREATED"}}
+
+
+@app.get("/freepik/v1/ai/mystic/{task_id}")
+async def freepik_status(task_id: str):
+    ready_at, result = _tasks.get(task_id, (0.0, ""))
+    if time.monotonic() < ready_at:
+        return {"data": {"task_id": task_id, "status": "IN_PROGRESS"}}
+    return {"data": {"task_id": task_id, "status": "COMPLETED", "generated": [result]}}
+
+
+@app.post("/genapi/api/v1/networks/suno")
+async def suno_create(request: Request):
+    body = await request.json()
+    request_id = _new_task(config.song_seconds, "http://fake/song.mp3")
+    if body.get("callback_url"):
+        asyncio.create_task(_send_callback(body["callback_url"], request_id))
+    return {"request_id": request_id}
+
+
+async def _send_callback(url: str, request_id: str) -> None:
+    ready_at, result = _tasks[request_id]
+    await asyncio.sleep(max(0.0, ready_at - time.monotonic()))
+    async with httpx.AsyncClient() as client:
+        try:
+            await client.post(url, json={"request_id": request_id, "status": "success", "result": [result]})
+        except httpx.HTTPError:
+            # как и настоящий провайдер, повторять не будем - задачу найдет опрос
+            pass
+
+
+@app.get("/genapi/api/v1/request/get/{request_id}")
+async def suno_status(request_id: str):
+    ready_at, result = _tasks.get(request_id, (0.0, ""))
+    if time.monotonic() < ready_at:
+        return {"status": "processing"}
+    return {"status": "success", "result": [result]}
+
+
+@app.get("/letters/")
+async def letters(letter_id: str):
+    await asyncio.sleep(config.letter_latency)
+    if letter_id == "missing":
+        return []
+    return [{"id": letter_id, "text": LETTER}]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Заглушки OpenRouter, Freepik, gen-api и сервиса писем")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--llm-latency", type=float, default=config.llm_latency)
+    parser.add_argument("--tokens-per-sec", type=float, default=config.tokens_per_sec)
+    parser.add_argument("--image-seconds", type=float, default=config.image_seconds)
+    parser.add_argument("--song-seconds", type=float, default=config.song_seconds)
+    parser.add_argument("--letter-latency", type=float, default=config.letter_latency)
+    args = parser.parse_args()
+
+    config.llm_latency = args.llm_latency
+    config.tokens_per_sec = args.tokens_per_sec
+    config.image_seconds = args.image_seconds
+    config.song_seconds = args.song_seconds
+    config.letter_latency = args.letter_latency
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
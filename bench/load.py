@@ -0,0 +1,200 @@
+"""
+Нагрузочный прогон по запущенному сервису.
+
+    python -m bench.load --url http://127.0.0.1:8052 --scenario answer --concurrency 16 --requests 200
+
+Печатает p50/p95/p99 и запросы в секунду по каждому эндпоинту. С --save результат
+пишется в json, с --baseline сравнивается с прошлым прогоном: если p95 вырос или
+пропускная способность упала больше чем на --tolerance, скрипт завершается с кодом 1.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import httpx
+
+PROMPTS = (
+    "Сделай грустную историю",
+    "Напиши историю о надежде и любви",
+    "Хочу, чтобы история была более драматичной",
+    "Расскажи историю о письме с фронта",
+    "Сделай историю, которая вызывает ностальгию",
+)
+
+# сценарий -> (путь, дополнительные параметры)
+SCENARIOS = {
+    "answer": ("/get_llm_answer", {}),
+    "stream": ("/get_llm_answer_stream", {}),
+    "image": ("/get_llm_image", {}),
+    "audio": ("/get_llm_audio", {"generate_words_with_audio": "true"}),
+}
+
+
+@dataclass
+class EndpointStats:
+    latencies: list[float] = field(default_factory=list)
+    errors: dict[str, int] = field(default_factory=dict)
+    started: float = field(default_factory=time.monotonic)
+    finished: float = 0.0
+
+    def add_error(self, error: str) -> None:
+        self.errors[error] = self.errors.get(error, 0) + 1
+
+    def report(self) -> dict:
+        latencies = sorted(self.latencies)
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return {
+            "requests": len(latencies) + sum(self.errors.values()),
+            "ok": len(latencies),
+            "errors": dict(self.errors),
+            "rps": len(latencies) / elapsed if elapsed else 0.0,
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        }
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Перцентиль по методу ближайшего ранга"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(p / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+async def _one(client: httpx.AsyncClient, path: str, params: dict) -> None:
+    if path.endswith("_stream"):
+        async with client.stream("GET", path, params=params) as response:
+            response.raise_for_status()
+            async for _ in response.aiter_raw():
+                pass
+    else:
+        response = await client.get(path, params=params)
+        response.raise_for_status()
+
+
+async def run_scenario(
+    url: str,
+    scenario: str,
+    concurrency: int,
+    requests: Optional[int],
+    duration: Optional[float],
+    letters: int,
+    timeout: float,
+) -> EndpointStats:
+    """
+    concurrency клиентов шлют запросы без пауз, пока не отправлено requests
+    запросов или не прошло duration секунд
+    """
+    path, extra = SCENARIOS[scenario]
+    stats = EndpointStats()
+    counter = itertools.count()
+    deadline = time.monotonic() + duration if duration else None
+    rng = random.Random(0)
+
+    async def client_loop(client: httpx.AsyncClient):
+        while True:
+            i = next(counter)
+            if requests is not None and i >= requests:
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            params = {"prompt": rng.choice(PROMPTS), **extra}
+            if letters:
+                params["letter_id"] = str(rng.randrange(letters))
+            started = time.monotonic()
+            try:
+                await _one(client, path, params)
+            except httpx.HTTPStatusError as e:
+                stats.add_error(str(e.response.status_code))
+            except httpx.HTTPError as e:
+                stats.add_error(type(e).__name__)
+            else:
+                stats.latencies.append(time.monotonic() - started)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        stats.started = time.monotonic()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        stats.finished = time.monotonic()
+    return stats
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Регрессии относительно прошлого прогона"""
+    problems = []
+    for scenario, report in current.items():
+        base = baseline.get(scenario)
+        if base is None:
+            continue
+        if base["p95"] and report["p95"] > base["p95"] * (1 + tolerance):
+            problems.append(f"{scenario}: p95 {report['p95']:.3f} c против {base['p95']:.3f} c")
+        if base["rps"] and report["rps"] < base["rps"] * (1 - tolerance):
+            problems.append(f"{scenario}: {report['rps']:.2f} rps против {base['rps']:.2f} rps")
+    return problems
+
+
+def print_report(results: dict) -> None:
+    header = f"{'сценарий':<10} {'запросов':>8} {'ошибок':>7} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}"
+    print(header)
+    print("-" * len(header))
+    for scenario, r in results.items():
+        errors = sum(r["errors"].values())
+        print(
+            f"{scenario:<10} {r['requests']:>8} {errors:>7} {r['rps']:>8.2f} "
+            f"{r['p50']:>8.3f} {r['p95']:>8.3f} {r['p99']:>8.3f}"
+        )
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--scenario", nargs="+", choices=list(SCENARIOS), default=["answer"])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=None, help="запросов на сценарий")
+    parser.add_argument("--duration", type=float, default=None, help="секунд на сценарий")
+    parser.add_argument("--letters", type=int, default=0, help="сколько разных letter_id использовать, 0 - без письма")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--save", default=None, help="куда сохранить результат в json")
+    parser.add_argument("--baseline", default=None, help="json прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+
+
+async def run(args: argparse.Namespace, url: str) -> int:
+    if args.requests is None and args.duration is None:
+        args.requests = 100
+    results = {}
+    for scenario in args.scenario:
+        stats = await run_scenario(
+            url, scenario, args.concurrency, args.requests, args.duration, args.letters, args.timeout
+        )
+        results[scenario] = stats.report()
+    print_report(results)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"Регрессия: {problem}")
+        return 1 if problems else 0
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон сервиса")
+    parser.add_argument("--url", default="http://127.0.0.1:8052")
+    add_arguments(parser)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args, args.url)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Полный бенчмарк без внешних сервисов: поднимает заглушки, сервис с адресами
+на них и прогоняет нагрузку.
+
+    python -m bench.run --scenario answer image --concurrency 16 --requests 200
+    python -m bench.run --scenario answer --save bench/last.json --baseline bench/baseline.json
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench import load
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Процесс завершился с кодом {process.returncode}")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} не ответил за {timeout:.0f} c")
+
+
+def service_env(fakes_url: str, service_url: str, workdir: str, args: argparse.Namespace) -> dict:
+    """Окружение сервиса: все внешние адреса указывают на заглушки, ключи фиктивные"""
+    env = dict(os.environ)
+    env.update({
+        "LLM_BASE_URL": f"{fakes_url}/v1",
+        "FREEPIK_API_URL": f"{fakes_url}/freepik/v1/ai/mystic",
+        "GEN_API_URL": f"{fakes_url}/genapi/api/v1",
+        "LETTERS_API_URL": f"{fakes_url}/letters/",
+        "LETTERS_STORE_PATH": os.path.join(workdir, "letters.bin"),
+        "EMOTION_CACHE_PATH": os.path.join(workdir, "emotions.db"),
+        "DIGEST_CACHE_PATH": os.path.join(workdir, "digests.db"),
+        "VERDICT_LOG_PATH": "",
+        "JOBS_DB_PATH": "",
+        # повторяющиеся промты нагрузки иначе отдавались бы из кэша медиа
+        "MEDIA_CACHE_PATH": "",
+        "OPENROUTEREGORGIT": "bench",
+        "FREEPIK_API": "bench",
+        "GEN_API": "bench",
+        # заглушка gen-api присылает вебхук о готовности песни сразу
+        "PUBLIC_BASE_URL": service_url,
+        "SUNO_CALLBACK_SECRET": "bench",
+        "RATE_LIMITS": args.rate_limits,
+        "LOG_LEVEL": "WARNING",
+    })
+    return env
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк сервиса на локальных заглушках")
+    parser.add_argument("--fakes-port", type=int, default=9100)
+    parser.add_argument("--port", type=int, default=8053)
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--tokens-per-sec", type=float, default=100.0)
+    parser.add_argument("--image-seconds", type=float, default=3.0)
+    parser.add_argument("--song-seconds", type=float, default=15.0)
+    parser.add_argument(
+        "--rate-limits",
+        default="127.0.0.1=10000:10000:1000",
+        help="лимиты для заглушек в формате RATE_LIMITS, по умолчанию не ограничивают",
+    )
+    load.add_arguments(parser)
+    args = parser.parse_args()
+
+    fakes_url = f"http://127.0.0.1:{args.fakes_port}"
+    service_url = f"http://127.0.0.1:{args.port}"
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            fakes = subprocess.Popen([
+                sys.executable, "-m", "bench.fake_upstreams",
+                "--port", str(args.fakes_port),
+                "--llm-latency", str(args.llm_latency),
+                "--tokens-per-sec", str(args.tokens_per_sec),
+                "--image-seconds", str(args.image_seconds),
+                "--song-seconds", str(args.song_seconds),
+            ])
+            processes.append(fakes)
+            _wait_ready(f"{fakes_url}/letters/?letter_id=1", fakes)
+
+            service = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+                env=service_env(fakes_url, service_url, workdir, args),
+            )
+            processes.append(service)
+            _wait_ready(f"{service_url}/metrics", service)
+
+            code = asyncio.run(load.run(args, service_url))
+        finally:
+            for process in reversed(processes):
+                process.terminate()
+                process.wait(timeout=10)
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
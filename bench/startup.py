@@ -0,0 +1,90 @@
+"""
+Холодный старт воркера: время импорта, время до готовности сервиса и память.
+
+    python -m bench.startup --runs 5
+    python -m bench.startup --module src.fast_classifier --no-lifespan
+
+Каждый прогон идет в новом процессе, чтобы не мешали уже загруженные модули.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ("torch", "transformers", "pandas", "numpy", "pyarrow", "langchain_openai", "openai")
+
+_CHILD = """
+import asyncio, importlib, json, resource, sys, time
+
+started = time.perf_counter()
+module = importlib.import_module({module!r})
+imported = time.perf_counter()
+if {lifespan!r}:
+    async def startup():
+        async with module.lifespan(module.app):
+            return time.perf_counter()
+    ready = asyncio.run(startup())
+else:
+    ready = imported
+print(json.dumps({{
+    "import": imported - started,
+    "ready": ready - started,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure(module: str, lifespan: bool, env: dict) -> dict:
+    code = _CHILD.format(module=module, lifespan=lifespan, heavy=HEAVY_MODULES)
+    process = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"Не удалось запустить {module}:\n{process.stderr}")
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Время холодного старта и память воркера")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--no-lifespan", action="store_true", help="только импорт, без запуска lifespan")
+    parser.add_argument("--save", default=None, help="куда сохранить результат в json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ)
+        env.update({
+            "EMOTION_CACHE_PATH": os.path.join(workdir, "emotions.db"),
+            "DIGEST_CACHE_PATH": os.path.join(workdir, "digests.db"),
+            "LETTERS_STORE_PATH": os.path.join(workdir, "letters.bin"),
+            "VERDICT_LOG_PATH": "",
+            "JOBS_DB_PATH": "",
+            "MEDIA_CACHE_PATH": "",
+            "LOG_LEVEL": "WARNING",
+        })
+        for key in ("OPENROUTEREGORGIT", "FREEPIK_API", "GEN_API"):
+            env.setdefault(key, "bench")
+        runs = [measure(args.module, not args.no_lifespan, env) for _ in range(args.runs)]
+
+    result = {
+        "module": args.module,
+        "runs": args.runs,
+        "import_median": statistics.median(run["import"] for run in runs),
+        "ready_median": statistics.median(run["ready"] for run in runs),
+        "max_rss_mb": max(run["max_rss_mb"] for run in runs),
+        "heavy_modules": runs[-1]["heavy"],
+    }
+    print(f"{args.module}: импорт {result['import_median']:.2f} c, готов через {result['ready_median']:.2f} c, "
+          f"память {result['max_rss_mb']:.0f} МБ (медиана по {args.runs} запускам)")
+    print(f"Тяжелые модули в памяти: {', '.join(result['heavy_modules']) or 'нет'}")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
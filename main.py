@@ -1,26 +1,144 @@
+import hmac
+import json
 import logging
 import os
 from contextlib import asynccontextmanager
+from dataclasses import asdict
 from typing import Optional
 
-import httpx
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 
 from src import AgentSystem
-from src.summarizer import name_generator
+from src.agentsystem import FREEPIK_API_URL, GEN_API_URL
+from src.compression import DigestCache, aload_encoding
+from src.emotion_cache import EmotionCache
+from src.fast_classifier import QueryClassifier
+from src.hedging import HedgePolicy
+from src.jobs import InMemoryJobStore, JobQueue, QueueFullError, SQLiteJobStore
+from src.letter_index import LetterIndex
+from src.letters import LETTERS_API_URL, LetterNotFoundError, LetterService, LocalLetterStore
+from src.llm_cache import LLMCache
+from src.media_cache import MediaCache
+from src.metrics import HTTPMetricsMiddleware, render
+from src.model_routing import load_routes, parse_backends
+from src.ratelimit import RateLimiter, parse_limits
+from src.singleflight import DEFAULT_EXCLUDE, SingleFlight
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    load_dotenv()
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=os.getenv("LOG_LEVEL", "DEBUG"),
         format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
     )
-    load_dotenv()
+    app.state.emotion_cache = EmotionCache(os.getenv("EMOTION_CACHE_PATH") or "data/emotions.db")
+    app.state.digest_cache = DigestCache(os.getenv("DIGEST_CACHE_PATH") or "data/digests.db")
+    if int(os.getenv("LETTER_TOKEN_BUDGET", "0")):
+        # словарь токенизатора может скачиваться, пусть это случится до первого запроса
+        await aload_encoding()
+    media_cache_path = os.getenv("MEDIA_CACHE_PATH", "data/media.db")
+    app.state.media_cache = None
+    if media_cache_path:
+        app.state.media_cache = MediaCache(
+            media_cache_path,
+            max_entries=int(os.getenv("MEDIA_CACHE_SIZE", "10000")),
+            variants=int(os.getenv("MEDIA_CACHE_VARIANTS", "1")),
+            ttl=float(os.getenv("MEDIA_CACHE_TTL", "86400")) or None,
+        )
+    classifier_path = os.getenv("QUERY_CLASSIFIER_PATH") or "data/query_classifier.json"
+    if os.getenv("FAST_CLASSIFIER", "1") == "0":
+        fast_classifier = None
+    elif os.path.exists(classifier_path):
+        fast_classifier = QueryClassifier.load(classifier_path)
+    else:
+        fast_classifier = QueryClassifier()
+    single_flight = None
+    if os.getenv("SINGLE_FLIGHT", "1") != "0":
+        exclude = os.getenv("SINGLE_FLIGHT_EXCLUDE", ",".join(DEFAULT_EXCLUDE))
+        single_flight = SingleFlight(exclude=[stage.strip() for stage in exclude.split(",") if stage.strip()])
+    header_backend = os.getenv("HEADER_BACKEND", "llm")
+    name_generator = None
+    if header_backend == "local":
+        from src.summarizer import MODEL_NAME, NameGenerator
+
+        name_generator = NameGenerator(
+            model_name=os.getenv("NAME_GENERATOR_MODEL") or MODEL_NAME,
+            max_batch_size=int(os.getenv("NAME_GENERATOR_BATCH", "8")),
+            runtime=os.getenv("NAME_GENERATOR_RUNTIME", "torch"),
+            quantize=os.getenv("NAME_GENERATOR_QUANTIZE", "0") == "1",
+        )
+    letter_index_path = os.getenv("LETTER_INDEX_PATH", "data/letters.idx")
+    app.state.letter_index = LetterIndex(letter_index_path) if os.path.exists(letter_index_path) else None
+    if app.state.letter_index is not None:
+        logging.getLogger(__name__).info(f"Индекс писем: {app.state.letter_index.stats()}")
+    # gen-api сообщает о готовности песни вебхуком, если сервис доступен снаружи;
+    # без секрета вебхук не включается: иначе кто угодно мог бы подсунуть ссылку на песню
+    song_callback_url = None
+    public_base_url = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+    if public_base_url and os.getenv("SUNO_CALLBACK_SECRET"):
+        song_callback_url = f"{public_base_url}/callbacks/suno?token={os.getenv('SUNO_CALLBACK_SECRET')}"
+    elif public_base_url:
+        logging.getLogger(__name__).warning("PUBLIC_BASE_URL задан без SUNO_CALLBACK_SECRET, вебхук песен выключен")
+    app.state.agent = AgentSystem(
+        model="qwen/qwen3-235b-a22b:free",
+        base_url=os.getenv("LLM_BASE_URL") or "https://openrouter.ai/api/v1",
+        api_key=os.getenv("OPENROUTEREGORGIT"),
+        temperature=0.7,
+        top_p=0.8,
+        api_key_image=os.getenv('FREEPIK_API'),
+        api_key_song=os.getenv('GEN_API'),
+        emotion_cache=app.state.emotion_cache,
+        llm_cache=LLMCache(maxsize=int(os.getenv("LLM_CACHE_SIZE", "4096"))),
+        fast_classifier=fast_classifier,
+        verdict_log_path=os.getenv("VERDICT_LOG_PATH") or None,
+        rate_limiter=RateLimiter(parse_limits(os.getenv("RATE_LIMITS", ""))),
+        single_flight=single_flight,
+        freepik_url=os.getenv("FREEPIK_API_URL") or FREEPIK_API_URL,
+        gen_api_url=os.getenv("GEN_API_URL") or GEN_API_URL,
+        header_backend=header_backend,
+        name_generator=name_generator,
+        letter_token_budget=int(os.getenv("LETTER_TOKEN_BUDGET", "0")) or None,
+        digest_cache=app.state.digest_cache,
+        model_routes=load_routes(os.getenv("MODEL_ROUTES", ""), defaults=os.getenv("MODEL_ROUTES_DEFAULTS", "0") == "1"),
+        fallbacks=parse_backends(os.getenv("LLM_FALLBACKS", "")),
+        hedge_policy=HedgePolicy(
+            quantile=float(os.getenv("HEDGE_QUANTILE", "95")),
+            min_delay=float(os.getenv("HEDGE_MIN_DELAY", "1")),
+            max_delay=float(os.getenv("HEDGE_MAX_DELAY", "30")),
+        ),
+        media_cache=app.state.media_cache,
+        song_callback_url=song_callback_url,
+        letter_index=app.state.letter_index,
+    )
+    logging.getLogger(__name__).info(f"Модели шагов: {app.state.agent.models.describe()}")
+    letters_store_path = os.getenv("LETTERS_STORE_PATH", "data/letters.bin")
+    app.state.letters = LetterService(
+        base_url=os.getenv("LETTERS_API_URL") or LETTERS_API_URL,
+        local_store=LocalLetterStore(letters_store_path) if os.path.exists(letters_store_path) else None,
+    )
+    jobs_db_path = os.getenv("JOBS_DB_PATH")
+    job_store = SQLiteJobStore(jobs_db_path) if jobs_db_path else InMemoryJobStore()
+    app.state.jobs = JobQueue(
+        store=job_store,
+        handlers={"audio": lambda params, report: run_audio_job(app.state.agent, params, report)},
+        workers=int(os.getenv("JOB_WORKERS", "4")),
+        max_queue=int(os.getenv("JOB_QUEUE_SIZE", "100")),
+    )
+    await app.state.jobs.start()
     yield
+    await app.state.jobs.stop()
+    app.state.jobs.store.close()
+    await app.state.agent.aclose()
+    await app.state.letters.aclose()
+    app.state.emotion_cache.close()
+    app.state.digest_cache.close()
+    if app.state.media_cache is not None:
+        app.state.media_cache.close()
 
 
 app = FastAPI(
@@ -37,68 +155,114 @@ app.add_middleware(
     allow_methods=["*"],
 )
 
+app.add_middleware(HTTPMetricsMiddleware)
+
 
 async def get_letter_by_id(letter_id: str):
-    async with httpx.AsyncClient() as client:
-        letters_list = await client.get(
-            f"https://yamata-no-orochi.nktkln.com/letters/letters/?letter_id={letter_id}"
-        )
-        letter_text = letters_list.json()[0]["text"]
-        return letter_text
+    try:
+        return await app.state.letters.get(letter_id)
+    except LetterNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+def get_agent(request: Request) -> AgentSystem:
+    return request.app.state.agent
+
+
+def get_jobs(request: Request) -> JobQueue:
+    return request.app.state.jobs
+
+
+# какие шаги пайплайна и под какими ключами отдаются в статусе задачи
+AUDIO_JOB_RESULTS = {"story": "story", "image": "bg_image", "header": "title", "song": "url"}
+
+
+async def run_audio_job(agent: AgentSystem, params: dict, report) -> None:
+    """Фоновая версия /get_llm_audio: результаты сохраняются по мере готовности"""
+
+    async def on_result(stage: str, value) -> None:
+        if stage in AUDIO_JOB_RESULTS:
+            await report(AUDIO_JOB_RESULTS[stage], value)
+
+    letter_text = await get_letter_by_id(params["letter_id"]) if params.get("letter_id") else None
+    story = await agent.agenerate_story_text(query=params["prompt"], letter=letter_text, on_result=on_result)
+    await agent.agenerate_audio_url(
+        story,
+        without_words=not params["generate_words_with_audio"],
+        on_result=on_result,
+    )
 
 
 @app.get("/get_llm_answer")
 async def generate_llm_answer(
         prompt: str,
-        letter_id: Optional[str] = None
+        letter_id: Optional[str] = None,
+        agent: AgentSystem = Depends(get_agent),
 ):
-    agent = AgentSystem(
-        model="qwen/qwen3-235b-a22b:free",
-        base_url="https://openrouter.ai/api/v1",
-        api_key=os.getenv("OPENROUTEREGORGIT"),
-        temperature=0.7,
-        top_p=0.8,
-        api_key_image=os.getenv('FREEPIK_API'),
-        api_key_song=os.getenv('GEN_API'),
-    )
     if letter_id:
         """
         get letter from db and add to prompt
         """
         letter_text = await get_letter_by_id(letter_id)
-        story = agent.generate_story_text(query=prompt, letter=letter_text)
+        story = await agent.agenerate_story_text(query=prompt, letter=letter_text)
     else:
-        story = agent.generate_story_text(query=prompt)
+        story = await agent.agenerate_story_text(query=prompt)
     return {"ai_answer": story}
 
 
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.get("/get_llm_answer_stream")
+async def stream_llm_answer(
+        prompt: str,
+        letter_id: Optional[str] = None,
+        agent: AgentSystem = Depends(get_agent),
+):
+    """
+    То же, что /get_llm_answer, но в формате server-sent events:
+    precheck с результатами проверок, затем token по мере генерации и done в конце
+    """
+    letter_text = await get_letter_by_id(letter_id) if letter_id else None
+    events = agent.astream_story_text(query=prompt, letter=letter_text)
+    # проверки запроса выполняются до начала ответа, чтобы вернуть 400 обычным ответом
+    first_event = await anext(events)
+
+    async def event_stream():
+        yield sse_event(*first_event)
+        try:
+            async for event, data in events:
+                yield sse_event(event, {"text": data} if event == "token" else data)
+        except Exception as e:
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/get_llm_audio")
 async def get_audio_from_llm(
         prompt: str,
         generate_words_with_audio: bool,
         letter_id: Optional[str] = None,
+        agent: AgentSystem = Depends(get_agent),
 ):
-    agent = AgentSystem(
-        model="qwen/qwen3-235b-a22b:free",
-        base_url="https://openrouter.ai/api/v1",
-        api_key=os.getenv("OPENROUTEREGORGIT"),
-        temperature=0.7,
-        top_p=0.8,
-        api_key_image=os.getenv('FREEPIK_API'),
-        api_key_song=os.getenv('GEN_API'),
-        music=True,
-        without_words=not generate_words_with_audio
-    )
     if letter_id:
         """
         get letter from db and add to prompt
         """
         letter_text = await get_letter_by_id(letter_id)
-        story = agent.generate_story_text(query=prompt, letter=letter_text)
+        story = await agent.agenerate_story_text(query=prompt, letter=letter_text)
     else:
-        story = agent.generate_story_text(query=prompt)
+        story = await agent.agenerate_story_text(query=prompt)
 
-    audio_response = agent.generate_audio_url(story)
+    audio_response = await agent.agenerate_audio_url(
+        story, without_words=not generate_words_with_audio
+    )
 
     audio_url = audio_response['url_audio']
     audio_bg_image = audio_response['url_image']
@@ -115,27 +279,18 @@ async def get_audio_from_llm(
 async def get_image_from_llm(
         prompt: str,
         letter_id: Optional[str] = None,
+        agent: AgentSystem = Depends(get_agent),
 ):
-    agent = AgentSystem(
-        model="qwen/qwen3-235b-a22b:free",
-        base_url="https://openrouter.ai/api/v1",
-        api_key=os.getenv("OPENROUTEREGORGIT"),
-        temperature=0.7,
-        top_p=0.8,
-        api_key_image=os.getenv('FREEPIK_API'),
-        api_key_song=os.getenv('GEN_API'),
-        music=False,
-    )
     if letter_id:
         """
         get letter from db and add to prompt
         """
         letter_text = await get_letter_by_id(letter_id)
-        story = agent.generate_story_text(query=prompt, letter=letter_text)
+        story = await agent.agenerate_story_text(query=prompt, letter=letter_text)
     else:
-        story = agent.generate_story_text(query=prompt)
+        story = await agent.agenerate_story_text(query=prompt)
 
-    image_response = agent.generate_image_url(story)
+    image_response = await agent.agenerate_image_url(story)
 
     image_url = image_response['url_image']
     image_shortname = image_response['header']
@@ -146,5 +301,84 @@ async def get_image_from_llm(
     }
 
 
+@app.post("/jobs/audio")
+async def submit_audio_job(
+        prompt: str,
+        generate_words_with_audio: bool,
+        letter_id: Optional[str] = None,
+        jobs: JobQueue = Depends(get_jobs),
+):
+    try:
+        job = await jobs.submit(
+            "audio",
+            {"prompt": prompt, "generate_words_with_audio": generate_words_with_audio, "letter_id": letter_id},
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, jobs: JobQueue = Depends(get_jobs)):
+    job = await jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return {"job_id": job.id, "status": job.status, "result": job.result, "error": job.error}
+
+
+@app.get("/letters/search")
+async def search_letters(request: Request, q: str = "", emotions: str = "", limit: int = 10):
+    """Письма корпуса по словам запроса q и эмоциям через запятую: id, оценка и заранее посчитанные эмоции"""
+    index: Optional[LetterIndex] = request.app.state.letter_index
+    if index is None:
+        raise HTTPException(status_code=503, detail="Индекс писем не построен")
+    if not q.strip() and not emotions.strip():
+        raise HTTPException(status_code=400, detail="Нужен запрос q или эмоции")
+    return {"results": [asdict(hit) for hit in index.search(q, emotions, min(max(limit, 1), 100))]}
+
+
+@app.post("/callbacks/suno", include_in_schema=False)
+async def suno_callback(request: Request, token: str = "", agent: AgentSystem = Depends(get_agent)):
+    """Вебхук gen-api: песня готова или генерация упала"""
+    secret = os.getenv("SUNO_CALLBACK_SECRET", "")
+    if not secret:
+        raise HTTPException(status_code=403, detail="Вебхук выключен")
+    if not hmac.compare_digest(token.encode("utf-8"), secret.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Неверный токен")
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Тело вебхука должно быть json")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Тело вебхука должно быть json-объектом")
+    request_id = payload.get("request_id") or payload.get("id")
+    if request_id is None:
+        raise HTTPException(status_code=400, detail="Нет request_id")
+    # промежуточные статусы не интересны, задачу будит только итоговый
+    if payload.get("status") == "success" and not AgentSystem.valid_song_result(payload):
+        raise HTTPException(status_code=400, detail="В result нет ссылок на песню")
+    if payload.get("status") in ("success", "failed"):
+        agent.song_callbacks.resolve(str(request_id), payload)
+    return {"ok": True}
+
+
+@app.get("/rate_limits")
+async def get_rate_limits(agent: AgentSystem = Depends(get_agent)):
+    """Очереди к провайдерам: сколько запросов ждет, среднее и максимальное ожидание в секундах"""
+    return agent.rate_limiter.stats()
+
+
+@app.get("/llm_backends")
+async def get_llm_backends(agent: AgentSystem = Depends(get_agent)):
+    """Запасные бэкенды по шагам: p50/p95 ответа, задержка до дубля, доля ошибок и деградация"""
+    return agent.models.stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    data, content_type = render()
+    return Response(content=data, media_type=content_type)
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8052, workers=1)
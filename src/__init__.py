@@ -1,2 +1,21 @@
-from .agentsystem import AgentSystem
-from .checksystem import Checker
\ No newline at end of file
+from typing import TYPE_CHECKING
+
+__all__ = ["AgentSystem", "Checker"]
+
+if TYPE_CHECKING:
+    from .agentsystem import AgentSystem
+    from .checksystem import Checker
+
+
+def __getattr__(name: str):
+    # модули с langchain загружаются при первом обращении, а не при импорте пакета,
+    # чтобы утилиты из src (кэш эмоций, классификатор, письма) запускались быстро
+    if name == "AgentSystem":
+        from .agentsystem import AgentSystem
+
+        return AgentSystem
+    if name == "Checker":
+        from .checksystem import Checker
+
+        return Checker
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
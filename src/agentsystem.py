@@ -1,16 +1,91 @@
+import asyncio
+import json
 import logging
 import re
+import threading
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Optional, TypeVar
 
-import time
+import httpx
 from fastapi import HTTPException
 
-import requests
-
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import PydanticOutputParser
 from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
+from pydantic import BaseModel, Field
+
+from src.callbacks import CallbackRegistry
+from src.compression import DigestCache, aload_encoding, count_tokens, normalize_letter
+from src.emotion_cache import EmotionCache
+from src.fast_classifier import QueryClassifier
+from src.letter_index import LetterIndex
+from src.llm_cache import LLMCache, cached_chain
+from src.hedging import HedgedChat, HedgePolicy
+from src.media_cache import MediaCache, media_key
+from src.metrics import MEDIA_CACHE_REQUESTS
+from src.model_routing import ModelRegistry, StageModel
+from src.pipeline import Pipeline, Stage
+from src.poller import PollTimeoutError, TaskPoller
+from src.ratelimit import LimitedChain, RateLimiter
+from src.singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from src.summarizer import NameGenerator
+
+from src.prompts import (
+    ANALYZE_EMOTIONS_TEMPLATE,
+    CHECK_QUERY_TEMPLATE,
+    DECISION_EMOTIONS_TEMPLATE,
+    DIGEST_LETTER_TEMPLATE,
+    HEADER_TEMPLATE,
+    PRECHECK_TEMPLATE,
+    QUERY_EMOTIONS_TEMPLATE,
+    SONG_TEMPLATE,
+    STORY_TEMPLATE,
+    SUMMARY_TEMPLATE,
+)
 
 logger = logging.getLogger(__name__)
 
+FREEPIK_API_URL = "https://api.freepik.com/v1/ai/mystic"
+GEN_API_URL = "https://api.gen-api.ru/api/v1"
+
+# параметры Freepik Mystic, кроме промта; входят в ключ кэша медиа
+IMAGE_PARAMS = {
+    "structure_strength": 50,
+    "adherence": 50,
+    "hdr": 50,
+    "resolution": "1k",
+    "aspect_ratio": "social_story_9_16",
+    "model": "realism",
+    "creative_detailing": 33,
+    "engine": "automatic",
+    "fixed_generation": False,
+    "filter_nsfw": True,
+}
+SONG_TITLE = "Военная песня 1"
+
+T = TypeVar("T")
+
+_sync_loop: Optional[asyncio.AbstractEventLoop] = None
+_sync_lock = threading.Lock()
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """
+    Выполняет корутину из синхронного кода в общем фоновом цикле событий.
+
+    Работает и там, где цикл уже запущен (Jupyter), а клиенты моделей и http,
+    привязанные к циклу, переживают повторные вызовы. Синхронные и асинхронные
+    методы одного объекта лучше не смешивать: у них разные циклы
+    """
+    global _sync_loop
+    with _sync_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever, name="sync-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _sync_loop).result()
+
+
 class ServiceUnavailableError(Exception):
     """Исключение для недоступных сервисов"""
 
@@ -18,208 +93,383 @@ class UserMisstake(Exception):
     """Ошибка ввода от пользователя"""
 
 
+class OffTopicQueryError(HTTPException):
+    """Запрос не военной тематики. Генерация истории отвечает на него своим текстом, см. STORY_OFF_TOPIC_DETAIL"""
+
+    def __init__(self, detail: str = "Запрос пользователя не соответствует требованиям военной тематики."):
+        super().__init__(status_code=400, detail=detail)
+
+
+# текст ошибки генерации истории, на который рассчитывают клиенты и ноутбуки
+STORY_OFF_TOPIC_DETAIL = "Запрос должен быть военной тематики."
+
+
+class QueryPrecheck(BaseModel):
+    """Результат объединенной проверки запроса пользователя"""
+
+    is_military: bool = Field(description="запрос соответствует военной тематике")
+    has_emotions: bool = Field(description="в запросе есть требования к эмоциональной составляющей")
+    emotions: list[str] = Field(default_factory=list, description="эмоции и чувства из запроса")
+
+
 class AgentSystem:
     def __init__(
         self,
         model: str,
         base_url: str,
         api_key: str,
-        api_key_image: str,
-        api_key_song: str,
+        api_key_image: str = None,
+        api_key_song: str = None,
         temperature: float = 0.7,
         top_p: float = 0.9,
-        music: bool = False,
-        without_words: bool=False
+        http_timeout: float = 30.0,
+        precheck: str = "combined",
+        poller: TaskPoller = None,
+        image_timeout: float = 180.0,
+        song_timeout: float = 900.0,
+        emotion_cache: EmotionCache = None,
+        llm_cache: LLMCache = None,
+        fast_classifier: QueryClassifier = None,
+        verdict_log_path: str = None,
+        rate_limiter: RateLimiter = None,
+        single_flight: SingleFlight = None,
+        freepik_url: str = FREEPIK_API_URL,
+        gen_api_url: str = GEN_API_URL,
+        header_backend: str = "llm",
+        name_generator: "NameGenerator" = None,
+        letter_token_budget: Optional[int] = None,
+        digest_cache: DigestCache = None,
+        model_routes: dict[str, StageModel] = None,
+        fallbacks: list[StageModel] = None,
+        hedge_policy: HedgePolicy = HedgePolicy(),
+        media_cache: MediaCache = None,
+        song_callback_url: Optional[str] = None,
+        letter_index: LetterIndex = None,
     ):
-        self.model = ChatOpenAI(
-            model=model,
-            base_url=base_url,
-            api_key=api_key,
-            temperature=temperature,
-            top_p=top_p,
+        """
+        precheck - "combined": проверка темы, решение об эмоциях и сами эмоции
+        получаются одним вызовом модели; "separate": тремя отдельными вызовами
+        poller - общий планировщик опроса Freepik и gen-api
+        image_timeout, song_timeout - сколько ждать готовности картинки и песни
+        emotion_cache - постоянный кэш эмоций писем по хэшу текста
+        llm_cache - кэш ответов модели для детерминированных шагов
+        fast_classifier - локальный классификатор, отвечает на уверенные случаи без модели
+        verdict_log_path - jsonl-лог вердиктов модели для обучения классификатора
+        rate_limiter - общие лимиты провайдеров по api-ключам, повторы после 429/5xx делает он
+        single_flight - объединение одинаковых одновременных вызовов шагов пайплайна
+        freepik_url, gen_api_url - адреса Freepik Mystic и gen-api (для тестов и бенчмарков)
+        header_backend - "llm": название придумывает модель по пересказу; "local": локальный
+        name_generator по самой истории, без вызова модели и параллельно с пересказом
+        letter_token_budget - письма длиннее этого числа токенов сжимаются моделью перед
+        анализом эмоций и генерацией истории; None - только нормализация
+        digest_cache - постоянный кэш сжатых писем
+        model_routes - своя модель, адрес и параметры для шагов (см. src.model_routing),
+        остальные шаги идут в model с temperature и top_p
+        fallbacks - запасные бэкенды: медленный запрос дублируется в следующий, см. src.hedging
+        media_cache - кэш картинок, песен и названий по промту и параметрам генерации
+        song_callback_url - публичный адрес вебхука gen-api; если задан, о готовности
+        песни сообщает gen-api, а опрос идет раз в 1-2 минуты на случай потерянного вебхука
+        letter_index - индекс корпуса писем, эмоции проиндексированных писем берутся из него без вызова модели
+        """
+        if precheck not in ("combined", "separate"):
+            raise ValueError(f"Неизвестный режим проверки запроса: {precheck}")
+        if header_backend not in ("llm", "local"):
+            raise ValueError(f"Неизвестный способ генерации названия: {header_backend}")
+        if header_backend == "local" and name_generator is None:
+            raise ValueError("Для header_backend='local' нужен name_generator")
+        self.models = ModelRegistry(
+            StageModel(model=model, base_url=base_url, api_key=api_key, temperature=temperature, top_p=top_p),
+            model_routes,
+            fallbacks,
+            hedge_policy,
         )
-        self._without_words = without_words
-        self._music = music
+        self.model = self.models.chat()
+        self._precheck = precheck
         self._api_key_image = api_key_image
         self._api_key_song = api_key_song
-    
-    def create_header(self, history: str) -> str:
-        """Создает загологовок к треку"""
-        template = """Ты - прфоессиональный композитор, который пишет песни военного времени. 
-        
-        Ты получаешь краткое изложение истории и тебе нужно на основе этого текста сделать заголовок для песни. Заголовок не должен быть больше 3 слов
-        
-        История: {history}
+        self._freepik_url = freepik_url.rstrip("/")
+        self._gen_api_url = gen_api_url.rstrip("/")
+        self._http_timeout = http_timeout
+        self._poller = poller or TaskPoller()
+        self._image_timeout = image_timeout
+        self._song_timeout = song_timeout
+        self._emotion_cache = emotion_cache
+        self._llm_cache = llm_cache
+        self._fast_classifier = fast_classifier
+        self._verdict_log_path = verdict_log_path
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.single_flight = single_flight
+        self._header_backend = header_backend
+        self._name_generator = name_generator
+        self._letter_token_budget = letter_token_budget
+        self._digest_cache = digest_cache
+        self._media_cache = media_cache
+        self._song_callback_url = song_callback_url
+        self._letter_index = letter_index
+        self.song_callbacks = CallbackRegistry("gen-api")
+        self._http = None
+        self._http_loop = None
+
+        # цепочки собираются один раз и переиспользуются между запросами
+        self._header_chain = self._build_chain("header", HEADER_TEMPLATE)
+        self._query_emotions_chain = self._build_chain("query_emotions", QUERY_EMOTIONS_TEMPLATE)
+        self._song_chain = self._build_chain("song", SONG_TEMPLATE)
+        self._summary_chain = self._build_chain("summary", SUMMARY_TEMPLATE)
+        self._check_query_chain = self._build_chain("check_query", CHECK_QUERY_TEMPLATE)
+        self._decision_emotions_chain = self._build_chain("decision_emotions", DECISION_EMOTIONS_TEMPLATE)
+        self._analyze_emotions_chain = self._build_chain("analyze_emotions", ANALYZE_EMOTIONS_TEMPLATE)
+        self._digest_chain = self._build_chain("digest", DIGEST_LETTER_TEMPLATE)
+        self._story_chain = self._build_chain("story", STORY_TEMPLATE)
+        self._precheck_chain = self._build_chain(
+            "precheck", PRECHECK_TEMPLATE, parser=PydanticOutputParser(pydantic_object=QueryPrecheck)
+        )
+        self._build_pipelines()
 
-        В ответе укажи только название. Больше ничего указывать не нужно. Также нельзя использовать разметку .md
-        """
+    def _build_chain(self, stage: str, template: str, parser: PydanticOutputParser = None):
+        """Собирает цепочку шага и оборачивает ее в кэш ответов, если он включен для шага"""
         prompt = PromptTemplate.from_template(template)
-        chat = prompt | self.model
-        response = chat.invoke({"history": history})
-        return response.content
+        model = self.models.runnable(stage, self.rate_limiter)
+        if parser is None:
+            chain = prompt | model
+        else:
+            chain = prompt.partial(format_instructions=parser.get_format_instructions()) | model | parser
+        chain = chain.with_config(tags=[f"stage:{stage}"])
+        if not isinstance(model, HedgedChat):
+            config = self.models.config(stage)
+            chain = LimitedChain(chain, self.rate_limiter.get(config.base_url, config.api_key))
+        return cached_chain(chain, self._llm_cache, stage, model.model_name, template)
+
+    def _get_http(self) -> httpx.AsyncClient:
+        """Общий http-клиент для Freepik и gen-api (пересоздается, если сменился event loop)"""
+        loop = asyncio.get_running_loop()
+        if self._http is None or self._http_loop is not loop:
+            self._http = httpx.AsyncClient(timeout=self._http_timeout)
+            self._http_loop = loop
+        return self._http
+
+    async def _request(self, method: str, url: str, api_key: str, **kwargs) -> httpx.Response:
+        """
+        Запрос к Freepik или gen-api в пределах лимитов провайдера, 429 и 5xx повторяются.
+        POST создает платную задачу, поэтому повторяется только после 429 и неудачного соединения
+        """
+        client = self._get_http()
 
-    def _take_emotions_from_query(self, query: str) -> str:
-        """Выделяет эмоции из письма пользователя"""
-        template = """Пользователь пишет запрос, в котором он просит рассказать историю.
-        Твоя задача определить, какие у пользователя требования к эмоциональной составляющей истории.
+        async def send():
+            response = await client.request(method, url, **kwargs)
+            if response.status_code == 429 or response.status_code >= 500:
+                response.raise_for_status()
+            return response
 
-        Пример таких запросов:
-        - "История должна быть грустной", тут ты выделяешь эмоцию грусть
-        - "Сделай историю, которая вызывает ностальгию", тут ты должен взять ностальгию
-        - "Напиши историю о надежде и любви", тут любовь и надежда
-        - "Сделай историю более драматичной, более грустной, более веселой", тут выделяешь драматичная, грустная, веселая
-        - "Романтичная история", тут романитичность
+        return await self.rate_limiter.call(url, api_key, send, idempotent=method.upper() in ("GET", "HEAD"))
 
-        Однако это лишь примеры, поэтому тебе следует быть внимательным и не ограничиваться только ними.
+    async def aclose(self) -> None:
+        """Закрывает http-клиент. Вызывается при остановке сервиса"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+            self._http_loop = None
+        if self._name_generator is not None:
+            await self._name_generator.aclose()
 
-        Запрос от пользователя:
-        {query}
+    def create_header(self, history: str) -> str:
+        """Синхронная обертка над acreate_header"""
+        return run_sync(self.acreate_header(history))
+
+    async def _cached_media(self, kind: str, prompt: str, params: dict, generate: Callable[[], Awaitable[Any]]) -> Any:
+        """Результат генерации из кэша медиа, а если его там нет - новый, который сразу кэшируется"""
+        if self._media_cache is None:
+            return await generate()
+        key = media_key(kind, prompt, params)
+        cached = await self._media_cache.get(key)
+        if cached is not None:
+            MEDIA_CACHE_REQUESTS.labels(kind, "hit").inc()
+            logger.info(f"{kind}: взято из кэша медиа")
+            return cached
+        MEDIA_CACHE_REQUESTS.labels(kind, "miss").inc()
+        value = await generate()
+        await self._media_cache.add(key, kind, value)
+        return value
+
+    async def acreate_header(self, history: str) -> str:
+        """Создает загологовок к треку"""
+        if self._header_backend == "local":
+            params = {"backend": "local"}
+        else:
+            params = {"backend": "llm", "model": self.models.config("header").model}
+        return await self._cached_media("header", history, params, lambda: self._generate_header(history))
 
-        ================================
-        Формат ответа, который ты должен использовать. Также тебе нельзя использовать .md разметку, только обычный текст:
-        Эмоции и чувства: (список из эмоций и чувств в строчку через запятую без дополнительной информации)
-        ===============================
+    async def _generate_header(self, history: str) -> str:
+        if self._header_backend == "local":
+            return await self._name_generator.agenerate(history)
+        response = await self._header_chain.ainvoke({"history": history})
+        return response.content
 
-        Если ты верно выполнишь задание и выделишь верные эмоции и чувства, то я выделю тебе дополнительные мощности для работы с другими задачами.
-        """
-        prompt = PromptTemplate.from_template(template)
-        chat = prompt | self.model
-        response = chat.invoke({"query": query})
+    async def _take_emotions_from_query(self, query: str) -> str:
+        """Выделяет эмоции из письма пользователя"""
+        response = await self._query_emotions_chain.ainvoke({"query": query})
         extracted_emotions = self._extract_emotions_from_llm_response(response.content)
         return extracted_emotions if extracted_emotions != "модель не ответила" else " "
-    
-    def make_song(self, history: str, emotions: str) -> str:
-        """Создает текст для песни + саму песню"""
-        template = """Ты - профессиональный композитор. Тебе нужно писать куплеты для песен на военную тематику под гитару.
-
-        Всего тебе нужно сделать 2 куплета. Учти, все главные аспекты истории, выделив их в песне
 
-        История: {history}
+    def make_song(self, history: str, emotions: str, without_words: bool = False) -> str:
+        """Синхронная обертка над amake_song"""
+        return run_sync(self.amake_song(history, emotions, without_words=without_words))
 
-        Пожалуйста, предоставь ответ в следующем формате:
-
-        Куплет 1
-        текст куплета построчно
+    async def amake_song(self, history: str, emotions: str, without_words: bool = False) -> str:
+        """Создает текст для песни + саму песню"""
+        params = {
+            "title": SONG_TITLE,
+            "tags": f"Гитара, военное настроение, {emotions}",
+            "without_words": without_words,
+            "model": "suno",
+        }
+        return await self._cached_media(
+            "song", history, params, lambda: self._generate_song(history, emotions, without_words)
+        )
 
-        Куплет 2
-        текст куплета построчно
-        """
-        if self._without_words:
+    async def _generate_song(self, history: str, emotions: str, without_words: bool) -> str:
+        if without_words:
             input = {
-            #  "callback_url": None,
-            "title": "Военная песня 1",
+            "title": SONG_TITLE,
             "tags": f"Гитара, военное настроение, {emotions}",
             }
-            print("Мы тут!")
-        else:  
-            prompt = PromptTemplate.from_template(template)
-            chat = prompt | self.model
-            song_text = chat.invoke({"history": history}).content
-            print(song_text) # потом убрать
+        else:
+            song_text = (await self._song_chain.ainvoke({"history": history})).content
+            logger.debug(f"Текст песни: {song_text}")
 
             input = {
-            #  "callback_url": None,
-            "title": "Военная песня 1",
+            "title": SONG_TITLE,
             "tags": f"Гитара, военное настроение, {emotions}",
             "prompt": song_text
             }
+        if self._song_callback_url:
+            input["callback_url"] = self._song_callback_url
         headers = {
         'Content-Type': 'application/json',
         'Accept': 'application/json',
         'Authorization': f'Bearer {self._api_key_song}'
         }
-        url_endpoint = "https://api.gen-api.ru/api/v1/networks/suno"
-        response_music = requests.post(url_endpoint, json=input, headers=headers) # обработать пришёл ли нам ответ вообще TODO
-        print(response_music.json()) # потом убрать
-        url_endpoint_answer = f"https://api.gen-api.ru/api/v1/request/get/{response_music.json()['request_id']}"
-        while True:
-            print("Пока что в работе")
-            time.sleep(60)
-            response_2 = requests.get(url_endpoint_answer, headers=headers)
-            if response_2.json()['status'] == 'failed':
-                raise ServiceUnavailableError("Сервис музыки не работает")
-            elif response_2.json()['status'] == 'success':
-                return response_2.json()['result'][0]
+        url_endpoint = f"{self._gen_api_url}/networks/suno"
+        response_music = await self._request("POST", url_endpoint, self._api_key_song, json=input, headers=headers) # обработать пришёл ли нам ответ вообще TODO
+        logger.debug(f"Ответ gen-api: {response_music.json()}")
+        request_id = str(response_music.json()['request_id'])
+        url_endpoint_answer = f"{self._gen_api_url}/request/get/{request_id}"
+
+        async def check_song():
+            response_2 = await self._request("GET", url_endpoint_answer, self._api_key_song, headers=headers)
+            return self._song_result(response_2.json())
+
+        if not self._song_callback_url:
+            try:
+                return await self._poller.wait(
+                    check_song,
+                    name="Песня",
+                    timeout=self._song_timeout,
+                    initial_interval=10.0,
+                    max_interval=30.0,
+                )
+            except PollTimeoutError as e:
+                raise ServiceUnavailableError("Песня не успела сгенерироваться") from e
+
+        # gen-api сам сообщит о готовности, редкий опрос остается на случай потерянного вебхука
+        callback = self.song_callbacks.expect(request_id)
+        poll = asyncio.ensure_future(self._poller.wait(
+            check_song,
+            name="Песня",
+            timeout=self._song_timeout,
+            initial_interval=60.0,
+            max_interval=120.0,
+        ))
+        try:
+            while True:
+                done, _ = await asyncio.wait({callback, poll}, return_when=asyncio.FIRST_COMPLETED)
+                if poll in done:
+                    return poll.result()
+                result = self._song_result(callback.result())
+                if result is not None:
+                    return result
+                # промежуточный статус, ждем следующего вебхука
+                callback = self.song_callbacks.expect(request_id)
+        except PollTimeoutError as e:
+            raise ServiceUnavailableError("Песня не успела сгенерироваться") from e
+        finally:
+            poll.cancel()
+            self.song_callbacks.discard(request_id)
+
+    @staticmethod
+    def valid_song_result(data: dict) -> bool:
+        """Готовая задача gen-api должна вернуть непустой список ссылок на песню"""
+        result = data.get('result')
+        return isinstance(result, list) and bool(result) and all(isinstance(url, str) and url for url in result)
+
+    @classmethod
+    def _song_result(cls, data: dict) -> Optional[str]:
+        """Ссылка на песню из статуса задачи gen-api (ответ на опрос или тело вебхука), None - еще в работе"""
+        if data['status'] == 'failed':
+            raise ServiceUnavailableError("Сервис музыки не работает")
+        elif data['status'] == 'success':
+            if not cls.valid_song_result(data):
+                raise ServiceUnavailableError("Сервис музыки не вернул ссылку на песню")
+            return data['result'][0]
+        return None
 
     def create_image(self, prompt: str) -> str:
+        """Синхронная обертка над acreate_image"""
+        return run_sync(self.acreate_image(prompt))
+
+    async def acreate_image(self, prompt: str) -> str:
         """Получает промт, а возвращает ссылку на картинку"""
-        url = "https://api.freepik.com/v1/ai/mystic"
-        payload = {
-            "prompt": prompt,
-            "structure_strength": 50,
-            "adherence": 50,
-            "hdr": 50,
-            "resolution": "1k",
-            "aspect_ratio": "social_story_9_16",
-            "model": "realism",
-            "creative_detailing": 33,
-            "engine": "automatic",
-            "fixed_generation": False,
-            "filter_nsfw": True,
-        }
+        return await self._cached_media(
+            "image", prompt, IMAGE_PARAMS, lambda: self._generate_image({"prompt": prompt, **IMAGE_PARAMS})
+        )
+
+    async def _generate_image(self, payload: dict) -> str:
+        url = self._freepik_url
         headers = {
             "x-freepik-api-key": self._api_key_image,
             "Content-Type": "application/json",
         }
-        response = requests.request("POST", url, json=payload, headers=headers)
+        response = await self._request("POST", url, self._api_key_image, json=payload, headers=headers)
         if response.status_code == 200:
             id = response.json()["data"]["task_id"]
         else:
             raise Exception("Картинка не создалась")
-        for _ in range(3):
-            time.sleep(5)
-            url = f"https://api.freepik.com/v1/ai/mystic/{id}"
-            response = requests.request("GET", url, headers=headers)
-            if response.json()["data"]["status"] == "COMPLETED":
-                return response.json()["data"]["generated"]
-        raise ServiceUnavailableError("Не вышло найти картинку")
+        url = f"{self._freepik_url}/{id}"
 
-    def get_summary_history(self, history: str) -> str:
-        template = """Ты - профессиональный литератор
-        Тебе нужно из следующего текста выделить какой-то момент, чтобы потом на основании этого момента можно было сделать картину. Так что сделай акцент на том, что на картине должен быть отображен человек либо люди, которые участвуют в выбранном моменте. 
-        Однако имена людей не нужно указывать. Можешь просто написать, что это "советский солдат", если он таким является, но не имена.
-        На задание у тебя есть 200 символов. Текст должен быть на английском
+        async def check_image():
+            response = await self._request("GET", url, self._api_key_image, headers=headers)
+            data = response.json()["data"]
+            if data["status"] == "COMPLETED":
+                return data["generated"]
+            if data["status"] == "FAILED":
+                raise ServiceUnavailableError("Freepik не смог сгенерировать картинку")
+            return None
+
+        try:
+            return await self._poller.wait(
+                check_image,
+                name="Картинка",
+                timeout=self._image_timeout,
+                initial_interval=2.0,
+                max_interval=10.0,
+            )
+        except PollTimeoutError as e:
+            raise ServiceUnavailableError("Не вышло найти картинку") from e
 
-        Текст, с которым надо работать:
-        {history}
+    def get_summary_history(self, history: str) -> str:
+        """Синхронная обертка над aget_summary_history"""
+        return run_sync(self.aget_summary_history(history))
 
-        В качестве ответа напиши только текст на английском. Не нужно никаких дополнительных фраз и слов
-        """
-        prompt = PromptTemplate.from_template(template)
-        chat = prompt | self.model
-        response = chat.invoke({"history": history})
+    async def aget_summary_history(self, history: str) -> str:
+        response = await self._summary_chain.ainvoke({"history": history})
         return response.content
 
-    def _check_user_query(self, query: str) -> bool:
+    async def _check_user_query(self, query: str) -> bool:
         """Проверяет запрос пользователя на соответствие требованиями военной тематики."""
-        template = """
-        Ты - профессиональный писатель, который пишет истории на основе писем военных лет с 1941 года по 1945 (Великая Отечественная Война).
-        
-        Ты получаешь запрос от пользователя, в котором он выражает свои пожелания к историям. Ты должен проверить, соответствует ли запрос пользователя требованиям военной тематике.
-
-        Также, если в запросе просят что-то сделать, ты должен проверить, что это не противоречит историческим событиям.
-        
-        Примеры запросов, которые соответствуют требованиям военной тематики:
-        - "История должна быть грустной"
-        - "Сделай историю, которая вызывает ностальгию"
-        - "Напиши историю о надежде и любви"
-        - "Сделай историю более драматичной, более грустной, более веселой"
-
-        Примеры запросов, которые не соответствуют требованиям военной тематики:
-        - "Напиши историю о космосе"
-        - "Хочу, чтобы история была на Бали"
-        - "Сделай так, чтобы история перенеслась в Африку"
-
-        Запрос пользователя: {query}
-
-        Если запрос соответствует требованиям военной тематики, то ответь "Да", иначе ответь "Нет".
-        Больше ничего в ответ не включай, только "Да" или "Нет" без кавычек.
-        """
-        prompt = PromptTemplate.from_template(template)
-        chat = prompt | self.model
-        response = chat.invoke({"query": query})
+        response = await self._check_query_chain.ainvoke({"query": query})
         logger.info(f"Ответ анализа на корректность query: {response.content}")
-        return self._contains_yes(response.content)
+        is_military = self._contains_yes(response.content)
+        self._log_verdict(query, is_military=is_military)
+        return is_military
 
     def _contains_yes(self, text: str) -> bool:
         """
@@ -233,34 +483,22 @@ class AgentSystem:
             return bool(re.search(r"\bда\b", first_sentence, re.IGNORECASE))
         return False
 
-    def _decision_of_emotions(self, query: str, model: ChatOpenAI) -> bool:
+    async def _decision_of_emotions(self, query: str) -> bool:
         """
         Выясняет задал ли пользователь запрос к эмоциональной составляющей истории.
         """
-        template = """Пользователь пишет запрос, в котором он просит рассказать историю.
-        Твоя задача определить, есть ли в запросе требования к эмоциональной составляющей истории.
-
-        Пример таких запросов:
-        - "История должна быть грустной"
-        - "Сделай историю, которая вызывает ностальгию"
-        - "Напиши историю о надежде и любви"
-        - "Сделай историю более драматичной, более грустной, более веселой"
-
-        Однако это лишь примеры, поэтому тебе следует быть внимательным и не ограничиваться только ними.
-
-        Запрос от пользователя:
-        {query}
-
-        Формат ответа:
-        - "Да" - если запрос содержит требования к эмоциональной составляющей
-        - "Нет" - если запрос не содержит требований к эмоциональной составляющей
-        Больше ничего в ответ не включай, только "Да" или "Нет" без кавычек.
-        """
-        prompt = PromptTemplate.from_template(template)
-        chat = prompt | model
-        response = chat.invoke({"query": query})
+        response = await self._decision_emotions_chain.ainvoke({"query": query})
         logger.info(f"Ответ анализа на эмоции: {response.content}")
-        return self._contains_yes(response.content)
+        has_emotions = self._contains_yes(response.content)
+        self._log_verdict(query, has_emotions=has_emotions)
+        return has_emotions
+
+    def _log_verdict(self, query: str, **verdicts: bool) -> None:
+        """Пишет вердикт модели в лог, на котором обучается локальный классификатор"""
+        if self._verdict_log_path is None:
+            return
+        with open(self._verdict_log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"query": query, **verdicts}, ensure_ascii=False) + "\n")
 
     def _extract_emotions_from_llm_response(self, llm_response: str) -> str:
         if not llm_response:
@@ -283,220 +521,408 @@ class AgentSystem:
         else:
             return "модель не ответила"
 
-    def _analyze_emotions(self, model: ChatOpenAI, letter: str) -> str:
-        """Анализ письма на эмоции и чувства автора."""
-
-        template = """ 
-        Ты - профессиональный психолог, специализирующийся на анализе писем. Тебе нужно проанализировать письмо и выделить в нем только ключевые эмоции и чувства, которые испытывает автор.
-        Всего ты можешь выделить лишь 5 эмоций и чувств.
+    async def _analyze_emotions(self, letter: str, text: str = None, cache: bool = True) -> str:
+        """
+        Анализ письма на эмоции и чувства автора.
+        text - подготовленный текст письма для модели, кэш при этом ведется по исходному письму
+        cache - искать и сохранять эмоции в индексе и кэше; сгенерированные истории
+        не повторяются, поэтому для них кэш только растет
+        """
+        if cache and self._letter_index is not None:
+            indexed = self._letter_index.emotions_for_text(letter)
+            if indexed is not None:
+                logger.info("Эмоции письма взяты из индекса писем")
+                return indexed
+        if cache and self._emotion_cache is not None:
+            cached = await self._emotion_cache.get(letter)
+            if cached is not None:
+                logger.info("Эмоции письма взяты из кэша")
+                return cached
+        response = await self._analyze_emotions_chain.ainvoke({"text": text or letter})
+        extracted_emotions = self._extract_emotions_from_llm_response(response.content)
+        if extracted_emotions == "модель не ответила":
+            return " "
+        if cache and self._emotion_cache is not None:
+            await self._emotion_cache.set(letter, extracted_emotions)
+        return extracted_emotions
 
-        Письмо: {text}
-        ================================
-        Формат ответа, который ты должен использовать. Также тебе нельзя использовать .md разметку, только обычный текст:
-        Мои мысли: тут ты должен объяснить, что ты думаешь о письме и почему ты выделил именно эти эмоции и чувства.
-        Эмоции и чувства: (список из 5 эмоций и чувств в строчку через запятую без дополнительной информации)
-        ===============================
+    async def aanalyze_letter_emotions(self, letter: str) -> str:
+        """Эмоции и чувства автора письма через запятую"""
+        return await self._analyze_emotions(letter, await self.aprepare_letter(letter))
 
-        Если ты верно выполнишь задание и выделишь верные эмоции и чувства, то я выделю тебе дополнительные мощности для работы с другими задачами.
+    async def aprepare_letter(self, letter: str) -> str:
         """
-        prompt = PromptTemplate.from_template(template)
-        chat = prompt | model
-        response = chat.invoke({"text": letter})
-        extracted_emotions = self._extract_emotions_from_llm_response(response.content)
-        return extracted_emotions if extracted_emotions != "модель не ответила" else " "
+        Текст письма для модели: нормализованное письмо, а если оно длиннее
+        letter_token_budget - его сжатая моделью версия
+        """
+        text = normalize_letter(letter)
+        budget = self._letter_token_budget
+        if budget is None:
+            return text
+        await aload_encoding()
+        tokens = count_tokens(text)
+        if tokens <= budget:
+            return text
+        if self._digest_cache is not None:
+            cached = await self._digest_cache.get(text, budget)
+            if cached is not None:
+                return cached
+        try:
+            # 0.75 слова на токен для русского текста
+            response = await self._digest_chain.ainvoke({"text": text, "words": int(budget * 0.75)})
+            digest = response.content.strip()
+        except Exception:
+            logger.exception("Не удалось сжать письмо, в модель уйдет полный текст")
+            return text
+        if not digest or count_tokens(digest) >= tokens:
+            return text
+        logger.info(f"Письмо сжато с {tokens} до {count_tokens(digest)} токенов")
+        if self._digest_cache is not None:
+            await self._digest_cache.set(text, budget, digest)
+        return digest
+
+    async def _precheck_query(self, query: str) -> QueryPrecheck:
+        """
+        Проверка темы, эмоций и выделение эмоций одним вызовом модели.
+        Если модель вернула невалидный ответ - откатываемся на отдельные вызовы.
+        """
+        try:
+            result = await self._precheck_chain.ainvoke({"query": query})
+            logger.info(f"Объединенная проверка запроса: {result}")
+            self._log_verdict(query, is_military=result.is_military, has_emotions=result.has_emotions)
+            return result
+        except OutputParserException:
+            logger.warning("Объединенная проверка вернула невалидный ответ, проверяем по отдельности")
+        is_military, has_emotions = await asyncio.gather(
+            self._check_user_query(query),
+            self._decision_of_emotions(query),
+        )
+        emotions = []
+        if is_military and has_emotions:
+            emotions = [e.strip() for e in (await self._take_emotions_from_query(query)).split(",") if e.strip()]
+        return QueryPrecheck(is_military=is_military, has_emotions=has_emotions, emotions=emotions)
+
+    def _fast_precheck(self, query: str) -> QueryPrecheck | None:
+        """Ответ локального классификатора, если он уверен в обоих вопросах"""
+        if self._fast_classifier is None:
+            return None
+        is_military = self._fast_classifier.is_military(query)
+        if is_military is False:
+            return QueryPrecheck(is_military=False, has_emotions=False)
+        if is_military is None:
+            return None
+        has_emotions = self._fast_classifier.has_emotions(query)
+        if has_emotions is None:
+            return None
+        emotions = self._fast_classifier.emotions(query) if has_emotions else []
+        return QueryPrecheck(is_military=True, has_emotions=has_emotions, emotions=emotions)
+
+    async def _stage_precheck(self, query: str) -> QueryPrecheck | None:
+        """Шаг пайплайна: объединенная проверка запроса"""
+        if query is None:
+            return None
+        fast = self._fast_precheck(query)
+        if fast is not None:
+            logger.info(f"Запрос проверен локальным классификатором: {fast}")
+            return fast
+        return await self._precheck_query(query)
+
+    async def _stage_precheck_query_check(self, precheck: QueryPrecheck | None) -> bool:
+        if precheck is not None and not precheck.is_military:
+            logger.error("Запрос пользователя не соответствует требованиям военной тематики.")
+            raise OffTopicQueryError()
+        return True
+
+    async def _stage_precheck_emotion_decision(self, precheck: QueryPrecheck | None) -> bool:
+        return precheck is not None and precheck.has_emotions
+
+    async def _stage_precheck_query_emotions(self, precheck: QueryPrecheck | None) -> str | None:
+        if precheck is None or not precheck.has_emotions:
+            return None
+        return ", ".join(precheck.emotions) or " "
+
+    async def _stage_query_check(self, query: str) -> bool:
+        """Шаг пайплайна: запрос должен быть военной тематики"""
+        if query is None:
+            return True
+        is_normal_query = self._fast_classifier.is_military(query) if self._fast_classifier else None
+        if is_normal_query is None:
+            is_normal_query = await self._check_user_query(query)
+        if not is_normal_query:  # если запрос не про военку
+            logger.error("Запрос пользователя не соответствует требованиям военной тематики.")
+            raise OffTopicQueryError()
+        return True
+
+    async def _stage_emotion_decision(self, query: str) -> bool:
+        """Шаг пайплайна: есть ли в запросе требования к эмоциям"""
+        if query is None:
+            return False
+        has_emotions = self._fast_classifier.has_emotions(query) if self._fast_classifier else None
+        if has_emotions is None:
+            has_emotions = await self._decision_of_emotions(query)
+        return has_emotions
+
+    async def _stage_query_emotions(self, query: str, emotion_decision: bool) -> str | None:
+        """Шаг пайплайна: эмоции из запроса (None, если запрос их не задает)"""
+        if not emotion_decision:
+            return None
+        return await self._take_emotions_from_query(query)
+
+    async def _stage_letter_text(self, letter: str) -> str:
+        """Шаг пайплайна: подготовка письма, дальше в модель идет только этот текст"""
+        return await self.aprepare_letter(letter) if letter else ""
+
+    async def _stage_letter_emotions(self, letter: str, letter_text: str) -> str:
+        """Шаг пайплайна: эмоции письма. Не зависит от проверок запроса, поэтому идет параллельно с ними"""
+        return await self._analyze_emotions(letter, letter_text) if letter else ""
+
+    async def _stage_emotions(self, query_emotions: str | None, letter_emotions: str) -> str:
+        """Шаг пайплайна: эмоции из запроса важнее эмоций письма"""
+        emotions = query_emotions if query_emotions is not None else letter_emotions
+        logger.info(f"Эмоции, которые мы получили: {emotions}")
+        return emotions
+
+    async def _stage_story_emotions(self, emotion_decision: bool, letter_emotions: str) -> str:
+        """Шаг пайплайна: если запрос задает эмоции, модель берет их из самого запроса"""
+        return "" if emotion_decision else letter_emotions
+
+    async def _stage_story(self, query_check: bool, emotions: str, query: str, letter_text: str) -> str:
+        """Шаг пайплайна: генерация истории"""
+        try:
+            history = await self._story_chain.ainvoke({
+                "emotional": emotions,
+                "query": query or "",
+                "letter": letter_text,
+            })
+            return history.content
+        except Exception as e:
+            logger.exception("Ошибка при генерации текста")
+            raise ServiceUnavailableError("Не удалось сгенерировать текст истории.") from e
+
+    async def _stage_summary(self, story: str) -> str:
+        """Шаг пайплайна: короткое описание сцены для картинки"""
+        history_summary = await self.aget_summary_history(story)
+        return history_summary + "It all happened during WWII"
+
+    async def _stage_image(self, summary: str) -> str:
+        try:
+            return await self.acreate_image(summary)
+        except Exception as e:
+            logger.exception("Ошибка при генерации изображения")
+            raise ServiceUnavailableError("Сервис генерации изображений временно недоступен, попробуйте позже") from e
+
+    async def _stage_header(self, summary: str) -> str:
+        return await self.acreate_header(summary)
+
+    async def _stage_local_header(self, story: str) -> str:
+        return await self.acreate_header(story)
+
+    async def _stage_song(self, story: str, emotions: str, without_words: bool) -> str:
+        try:
+            return await self.amake_song(story, emotions, without_words=without_words)
+        except Exception as e:
+            logger.exception("Ошибка при генерации музыки")
+            raise ServiceUnavailableError("Сервис генерации музыки временно недоступен, попробуйте позже") from e
+
+    async def _stage_summary_song(self, summary: str, emotions: str, without_words: bool) -> str:
+        return await self._stage_song(summary, emotions, without_words)
+
+    async def _stage_text_emotions(self, story: str) -> str:
+        """Шаг пайплайна: эмоции уже сгенерированной истории"""
+        return await self._analyze_emotions(story, cache=False) if story else ""
+
+    def _build_pipelines(self) -> None:
+        """Собирает графы шагов один раз при создании агента"""
+        if self._precheck == "combined":
+            checks = Pipeline([
+                Stage("precheck", self._stage_precheck, ("query",)),
+                Stage("query_check", self._stage_precheck_query_check, ("precheck",)),
+                Stage("emotion_decision", self._stage_precheck_emotion_decision, ("precheck",)),
+                Stage("letter_text", self._stage_letter_text, ("letter",)),
+                Stage("letter_emotions", self._stage_letter_emotions, ("letter", "letter_text")),
+            ])
+            query_emotions = Stage("query_emotions", self._stage_precheck_query_emotions, ("precheck",))
+        else:
+            checks = Pipeline([
+                Stage("query_check", self._stage_query_check, ("query",)),
+                Stage("emotion_decision", self._stage_emotion_decision, ("query",)),
+                Stage("letter_text", self._stage_letter_text, ("letter",)),
+                Stage("letter_emotions", self._stage_letter_emotions, ("letter", "letter_text")),
+            ])
+            query_emotions = Stage("query_emotions", self._stage_query_emotions, ("query", "emotion_decision"))
+        story = Pipeline([
+            Stage("story", self._stage_story, ("query_check", "emotions", "query", "letter_text")),
+        ])
+        if self._header_backend == "local":
+            # локальному генератору пересказ не нужен, название делается параллельно с ним
+            header = Stage("header", self._stage_local_header, ("story",))
+        else:
+            header = Stage("header", self._stage_header, ("summary",))
+        media = Pipeline([
+            Stage("summary", self._stage_summary, ("story",)),
+            Stage("image", self._stage_image, ("summary",)),
+            header,
+        ])
+        # для /get_llm_answer: эмоции из запроса модель берет сама, отдельный вызов не нужен
+        self._story_checks_pipeline = checks + Pipeline([
+            Stage("emotions", self._stage_story_emotions, ("emotion_decision", "letter_emotions")),
+        ])
+        self._story_pipeline = self._story_checks_pipeline + story
+        # полный сценарий process_agent_system
+        full = checks + Pipeline([
+            query_emotions,
+            Stage("emotions", self._stage_emotions, ("query_emotions", "letter_emotions")),
+        ]) + story + media
+        self._full_pipeline = full
+        self._full_music_pipeline = full + Pipeline([
+            Stage("song", self._stage_song, ("story", "emotions", "without_words")),
+        ])
+        # медиа по готовой истории
+        self._image_pipeline = media
+        self._audio_pipeline = media + Pipeline([
+            Stage("emotions", self._stage_text_emotions, ("story",)),
+            Stage("song", self._stage_summary_song, ("summary", "emotions", "without_words")),
+        ])
+        if self.single_flight is not None:
+            for name in (
+                "_story_checks_pipeline",
+                "_story_pipeline",
+                "_full_pipeline",
+                "_full_music_pipeline",
+                "_image_pipeline",
+                "_audio_pipeline",
+            ):
+                setattr(self, name, self.single_flight.apply(getattr(self, name)))
 
     def generate_story_text(self, query: str = None, letter: str = None) -> str:
+        """Синхронная обертка над agenerate_story_text"""
+        return run_sync(self.agenerate_story_text(query=query, letter=letter))
+
+    async def agenerate_story_text(
+        self,
+        query: str = None,
+        letter: str = None,
+        on_result: Optional[Callable[[str, Any], Awaitable[None]]] = None,
+    ) -> str:
         """
         Генерирует текст истории на основе запроса и/или письма.
         Учитывает эмоциональную составляющую и проверяет историческую достоверность.
+        on_result получает результаты шагов по мере готовности.
         """
-        emotions = ""
-        is_contain_emotional = False
-        
         if query is None and letter is None:
             raise UserMisstake("Запрос не содержит ни текста, ни письма.")
-        
-        if query is not None:
-            is_normal_query = self._check_user_query(query)
-            if not is_normal_query:
-                raise HTTPException(status_code=400, detail="Запрос должен быть военной тематики.")
-            is_contain_emotional = self._decision_of_emotions(query, self.model)
-
-        main_template = """Ты - профессиональный писатель, который пишет истории на основе писем военных лет с 1941 года по 1945 (Великая Отечественная Война).
-
-        Однако ты получаешь не только письмо с фронта, но и запрос на эмоциональную составляющую истории.
-        Данный запрос может содержать абсолютно любое требование к истории, например:
-        - "История должна быть грустной"
-        - "Пусть история будет веселой, но с элементами драмы"
-        и так далее.
-        
-        Также помимо эмоциональной составляющей, ты получаешь ещё и дополнительные пожелания от пользователя, которые ты должен учесть при написании истории.
-        
-        Также во время написания истории, ты ОБЯЗАН проверять все факты, которые ты используешь в истории, на соответствие историческим событиям.
-        
-        Эмоциональная составляющая будет тебе передаваться в следующей строке:
-        
-        Эмоциональная составляющая: {emotional}
-
-        Запрос пользователя: {query}
-
-        Само письмо, к которому ты должен написать историю: {letter}
-
-        Если эмоциональная составляющая не передана, то проанализируй письмо и выдели из него эмоции
-        
-        Будь пожалуйста внимателен и используй все пожелания пользователя, которые он указал в запросе.
-        
-        Если письмо отсутствует, то ты должен написать историю на основе запроса пользователя.
-
-        Если запрос пользователя противоречит письму. К примеру, пользователь хочет то, чего совершенно не могло быть в письме, то ты должен написать об этом пользователю и попросить его переформулировать запрос.
-        
-        В качестве ответа ты должен только написать историю, которую ты сочинил. История должна быть до 500 слов, но не менее 300.
+
+        try:
+            results = await self._story_pipeline.run({"query": query, "letter": letter}, on_result=on_result)
+        except OffTopicQueryError as e:
+            raise OffTopicQueryError(STORY_OFF_TOPIC_DETAIL) from e
+        return results["story"]
+
+    async def astream_story_text(
+        self, query: str = None, letter: str = None
+    ) -> AsyncIterator[tuple[str, Any]]:
+        """
+        Потоковая версия agenerate_story_text.
+
+        Сначала отдает ("precheck", результаты проверок), затем ("token", кусок текста)
+        по мере генерации и в конце ("done", {}). Ошибки проверок бросаются
+        до первого события, поэтому их можно вернуть обычным http-ответом
         """
-        main_template = PromptTemplate.from_template(main_template)
-        chat = main_template | self.model
+        if query is None and letter is None:
+            raise UserMisstake("Запрос не содержит ни текста, ни письма.")
 
-        if not is_contain_emotional:
-            emotions = self._analyze_emotions(self.model, letter) if letter else ""
+        try:
+            results = await self._story_checks_pipeline.run({"query": query, "letter": letter})
+        except OffTopicQueryError as e:
+            raise OffTopicQueryError(STORY_OFF_TOPIC_DETAIL) from e
+        precheck = {
+            "has_emotions": results["emotion_decision"],
+            "emotions": results["emotions"],
+        }
+        if results.get("precheck") is not None:
+            precheck["query_emotions"] = results["precheck"].emotions
+        yield "precheck", precheck
 
         try:
-            history = chat.invoke({
-                "emotional": emotions,
+            async for chunk in self._story_chain.astream({
+                "emotional": results["emotions"],
                 "query": query or "",
-                "letter": letter or "",
-            })
-            return history.content
+                "letter": results["letter_text"],
+            }):
+                if chunk.content:
+                    yield "token", chunk.content
         except Exception as e:
-            logger.exception("Ошибка при генерации текста")
+            logger.exception("Ошибка при потоковой генерации текста")
             raise ServiceUnavailableError("Не удалось сгенерировать текст истории.") from e
+        yield "done", {}
 
-    def generate_audio_url(self, story_text: str) -> str:
+    def generate_audio_url(self, story_text: str, without_words: bool = False) -> dict:
+        """Синхронная обертка над agenerate_audio_url"""
+        return run_sync(self.agenerate_audio_url(story_text, without_words=without_words))
+
+    async def agenerate_audio_url(
+        self,
+        story_text: str,
+        without_words: bool = False,
+        on_result: Optional[Callable[[str, Any], Awaitable[None]]] = None,
+    ) -> dict:
         """
         Генерирует URL аудиозаписи, соответствующей эмоциям истории.
+        on_result получает результаты шагов по мере готовности.
         """
-        is_contain_emotional = False
-        if not is_contain_emotional:
-            emotions = self._analyze_emotions(self.model, story_text) if story_text else ""
-
         try:
-            history_summary = self.get_summary_history(story_text)
-            history_summary += "It all happened during WWII"
-
-            image_url = self.create_image(history_summary)
-            audio_url = self.make_song(history_summary, emotions)
-            header = self.create_header(history_summary)
-            return {"url_image": image_url, "url_audio": audio_url, "header": header}
+            results = await self._audio_pipeline.run(
+                {"story": story_text, "without_words": without_words}, on_result=on_result
+            )
+            return {"url_image": results["image"], "url_audio": results["song"], "header": results["header"]}
         except Exception as e:
             logger.exception("Ошибка при генерации аудио")
             raise ServiceUnavailableError("Сервис генерации музыки недоступен.") from e
 
-    def generate_image_url(self, story_text: str) -> str:
+    def generate_image_url(self, story_text: str) -> dict:
+        """Синхронная обертка над agenerate_image_url"""
+        return run_sync(self.agenerate_image_url(story_text))
+
+    async def agenerate_image_url(self, story_text: str) -> dict:
         """
         Генерирует URL изображения, соответствующего содержанию истории.
         """
         try:
-            history_summary = self.get_summary_history(story_text)
-            history_summary += "It all happened during WWII"
-
-            image_url = self.create_image(history_summary)
-            header = self.create_header(history_summary)
-            return {"url_image": image_url, "header": header}
+            results = await self._image_pipeline.run({"story": story_text})
+            return {"url_image": results["image"], "header": results["header"]}
         except Exception as e:
-            logger.exception("Ошибка при генерации аудио")
-            raise ServiceUnavailableError("Сервис генерации музыки недоступен.") from e
+            logger.exception("Ошибка при генерации изображения")
+            raise ServiceUnavailableError("Сервис генерации изображений недоступен.") from e
+
+    def process_agent_system(
+        self,
+        query: str = None,
+        letter: str = None,
+        music: bool = False,
+        without_words: bool = False,
+    ) -> dict:
+        """Синхронная обертка над aprocess_agent_system"""
+        return run_sync(
+            self.aprocess_agent_system(query=query, letter=letter, music=music, without_words=without_words)
+        )
 
-    def process_agent_system(self, query: str = None, letter: str = None) -> dict:
+    async def aprocess_agent_system(
+        self,
+        query: str = None,
+        letter: str = None,
+        music: bool = False,
+        without_words: bool = False,
+    ) -> dict:
         """
         Обрабатывает запрос пользователя и генерирует историю
         """
-        emotions = ""
-        main_template = """Ты - профессиональный писатель, который пишет истории на основе писем военных лет с 1941 года по 1945 (Великая Отечественная Война).
-
-        Однако ты получаешь не только письмо с фронта, но и запрос на эмоциональную составляющую истории.
-        Данный запрос может содержать абсолютно любое требование к истории, например:
-        - "История должна быть грустной"
-        - "Пусть история будет веселой, но с элементами драмы"
-        и так далее.
-        
-        Также помимо эмоциональной составляющей, ты получаешь ещё и дополнительные пожелания от пользователя, которые ты должен учесть при написании истории.
-        
-        Также во время написания истории, ты ОБЯЗАН проверять все факты, которые ты используешь в истории, на соответствие историческим событиям.
-        
-        Эмоциональная составляющая будет тебе передаваться в следующей строке:
-        
-        Эмоциональная составляющая: {emotional}
-
-        Запрос пользователя: {query}
-
-        Само письмо, к которому ты должен написать историю: {letter}
-
-        Если эмоциональная составляющая не передана, то проанализируй письмо и выдели из него эмоции
-        
-        Будь пожалуйста внимателен и используй все пожелания пользователя, которые он указал в запросе.
-        
-        Если письмо отсутствует, то ты должен написать историю на основе запроса пользователя.
-
-        Если запрос пользователя противоречит письму. К примеру, пользователь хочет то, чего совершенно не могло быть в письме, то ты должен написать об этом пользователю и попросить его переформулировать запрос.
-        
-        В качестве ответа ты должен только написать историю, которую ты сочинил. История должна быть до 500 слов, но не менее 300.
-        """
-        is_contain_emotional = False  # изначально запрос не содержит эмоций
         if (
             query is None and letter is None
         ):  # если у нас нет письма и запроса - отправляем строку с ошибкой
             raise UserMisstake("Ваш запрос не содержит ни запроса, ни письма. Введите что-нибудь")
-        if query is not None:  # проверяем на нормальность запрос + содержание эмоций
-            is_normal_query = self._check_user_query(query)
-            if not is_normal_query:  # если запрос не про военку
-                logger.error(
-                    "Запрос пользователя не соответствует требованиям военной тематики."
-                )
-                raise HTTPException(
-                    status_code=400,
-                    detail= "Запрос пользователя не соответствует требованиям военной тематики."
-
-                )
-                # raise UserMisstake("Ваш запрос не соответствует требованиям военной тематики. Пожалуйста, переформулируйте его.")
-            is_contain_emotional = self._decision_of_emotions(query, self.model)
-        main_template = PromptTemplate.from_template(main_template)
-        chat = main_template | self.model
-        if not (is_contain_emotional):
-            print("нет эмоций")
-            logger.info("Запрос не содержит требований к эмоциям")
-            if letter is None:
-                emotions = ""
-            else:
-                emotions = self._analyze_emotions(self.model, letter)
-        else:
-            emotions = self._take_emotions_from_query(query)
-        print("Эмоции: ", emotions) # убрать потом
-        logger.info("Эмоции, которые мы получили: {emotions}")
-        try:
-            history = chat.invoke(
-                {
-                    "emotional": emotions,
-                    "query": query if query else "",
-                    "letter": letter if letter else "",
-                }
-            )
-        except (
-            Exception
-        ) as e:  # на случай, если история не загенилась по каким-то причинам
-            logger.exception("Some error occurred")
-            raise ServiceUnavailableError("Сервис временно недоступен, попробуйте позже.") from e
-
-        history_summary = self.get_summary_history(history.content)
-        history_summary += "It all happened during WWII"
-        try:  # подумать вообще над этим блоком. Надо как-то сделать так, чтобы хоть что-то вернулось
-            url = self.create_image(history_summary)
-        except Exception as e:
-            logger.exception("Some error occurred")
-            raise ServiceUnavailableError("Сервис генерации изображений временно недоступен, попробуйте позже") from e
-        header = self.create_header(history_summary)
-        if self._music:
-            try:
-                url_music = self.make_song(history.content, emotions)
-                return {"history": history.content, "url_pic": url, "url_music": url_music, "header": header}
-            except Exception as e:
-                logger.error(e)
-                raise ServiceUnavailableError("Сервис генерации музыки временно недоступен, попробуйте позже")
-        return {"history": history.content, "url_pic": url, "header": header}
+        pipeline = self._full_music_pipeline if music else self._full_pipeline
+        results = await pipeline.run({"query": query, "letter": letter, "without_words": without_words})
+        response = {"history": results["story"], "url_pic": results["image"], "header": results["header"]}
+        if music:
+            response["url_music"] = results["song"]
+        return response
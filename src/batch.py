@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Iterator, Optional
+
+from src.agentsystem import AgentSystem
+from src.checksystem import Checker
+
+logger = logging.getLogger(__name__)
+
+MODEL = "qwen/qwen3-235b-a22b:free"
+BASE_URL = "https://openrouter.ai/api/v1"
+
+
+def iter_letters(path: str, limit: Optional[int] = None) -> Iterator[tuple[str, str]]:
+    """
+    Письма корпуса по одному: (id, текст).
+
+    Файл из `python -m src.letters export` читается через mmap без загрузки в память,
+    pkl читается pandas целиком
+    """
+    if path.endswith(".bin"):
+        from src.letters import LocalLetterStore
+
+        store = LocalLetterStore(path)
+        try:
+            for i, letter_id in enumerate(store.ids()):
+                if limit is not None and i >= limit:
+                    break
+                yield letter_id, store.get(letter_id)
+        finally:
+            store.close()
+    else:
+        import pandas as pd
+
+        letters = pd.read_pickle(path)[["id", "text"]].dropna()
+        if limit is not None:
+            letters = letters.head(limit)
+        for letter_id, text in zip(letters["id"], letters["text"]):
+            yield str(letter_id), str(text)
+
+
+class Checkpoint:
+    """
+    Список обработанных писем: по одному id в строке.
+
+    id дописывается только после того, как результат записан в выходной файл,
+    поэтому после падения обработка продолжается с первого незаписанного письма
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self.done: set[str] = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.done = {line.strip() for line in f if line.strip()}
+
+    def __contains__(self, letter_id: str) -> bool:
+        return letter_id in self.done
+
+    def add(self, letter_ids: list[str]) -> None:
+        with open(self._path, "a", encoding="utf-8") as f:
+            f.writelines(f"{letter_id}\n" for letter_id in letter_ids)
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(letter_ids)
+
+
+class PartWriter:
+    """
+    Пишет результаты в папку частями part-00000.parquet, part-00001.parquet, ...
+
+    Часть пишется каждые part_size писем и не реже раза в flush_interval секунд,
+    так что при жестком падении теряется немного оплаченных ответов модели.
+    Папку целиком читает read_results
+    """
+
+    def __init__(self, out_dir: str, checkpoint: Checkpoint, part_size: int = 10, flush_interval: float = 30.0):
+        os.makedirs(out_dir, exist_ok=True)
+        self._out_dir = out_dir
+        self._checkpoint = checkpoint
+        self._part_size = part_size
+        self.flush_interval = flush_interval
+        self._rows: list[dict] = []
+        self._lock = asyncio.Lock()
+        self._next_part = len([name for name in os.listdir(out_dir) if name.endswith(".parquet")])
+
+    def _write_part(self, rows: list[dict], part: int) -> None:
+        import pandas as pd
+
+        path = os.path.join(self._out_dir, f"part-{part:05d}.parquet")
+        tmp_path = path + ".tmp"
+        frame = pd.DataFrame(rows)
+        # в части, где у всех писем, например, for_check = None, pyarrow вывел бы тип null,
+        # и такие части не читались бы вместе с остальными
+        text_columns = [column for column in frame.columns if column != "seconds"]
+        frame[text_columns] = frame[text_columns].astype("string")
+        frame.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        # падение между этими строками оставит письма вне checkpoint: при повторном
+        # запуске они обработаются снова и попадут в две части, read_results убирает дубли
+        self._checkpoint.add([row["id"] for row in rows])
+
+    async def add(self, row: dict) -> None:
+        self._rows.append(row)
+        if len(self._rows) >= self._part_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._rows:
+                return
+            rows, self._rows = self._rows, []
+            part, self._next_part = self._next_part, self._next_part + 1
+            await asyncio.to_thread(self._write_part, rows, part)
+            logger.info(f"Записана часть {part}: {len(rows)} писем")
+
+    async def flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+def read_results(out_dir: str):
+    """Все части результата одной таблицей, без повторов писем после перезапуска"""
+    import pandas as pd
+
+    # части читаются по отдельности: схема у старых частей может отличаться
+    paths = sorted(name for name in os.listdir(out_dir) if name.startswith("part-") and name.endswith(".parquet"))
+    if not paths:
+        return pd.DataFrame()
+    frames = [pd.read_parquet(os.path.join(out_dir, name)) for name in paths]
+    return pd.concat(frames, ignore_index=True).drop_duplicates("id", keep="last").reset_index(drop=True)
+
+
+def make_task(name: str, agent: AgentSystem, checker: Optional[Checker]) -> Callable[[str], Awaitable[dict]]:
+    """Обработка одного письма: emotions - эмоции, story - история, facts - история и проверка фактов"""
+
+    async def emotions(letter: str) -> dict:
+        return {"emotions": await agent.aanalyze_letter_emotions(letter)}
+
+    async def story(letter: str) -> dict:
+        return {"story": await agent.agenerate_story_text(letter=letter)}
+
+    async def facts(letter: str) -> dict:
+        result = await story(letter)
+        check = await checker.amain_process(result["story"])
+        return {**result, "facts_status": check["status"], "for_check": check["for_check"]}
+
+    return {"emotions": emotions, "story": story, "facts": facts}[name]
+
+
+async def run_batch(
+    letters: Iterator[tuple[str, str]],
+    task: Callable[[str], Awaitable[dict]],
+    out_dir: str,
+    checkpoint_path: Optional[str] = None,
+    concurrency: int = 4,
+    part_size: int = 10,
+    flush_interval: float = 30.0,
+) -> dict:
+    """
+    Обрабатывает письма с ограниченной параллельностью и пишет результаты по частям.
+
+    Уже обработанные письма из checkpoint пропускаются. Письма с ошибкой
+    не попадают в результат и будут обработаны при следующем запуске
+    """
+    checkpoint = Checkpoint(checkpoint_path or out_dir.rstrip("/") + ".checkpoint")
+    writer = PartWriter(out_dir, checkpoint, part_size, flush_interval)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    stats = {"done": 0, "skipped": 0, "failed": 0}
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            letter_id, text = item
+            started = time.monotonic()
+            try:
+                result = await task(text)
+            except Exception as e:
+                logger.warning(f"Письмо {letter_id} не обработано: {e}")
+                stats["failed"] += 1
+                continue
+            await writer.add({"id": letter_id, **result, "seconds": time.monotonic() - started})
+            stats["done"] += 1
+
+    async def producer():
+        for letter_id, text in letters:
+            if letter_id in checkpoint:
+                stats["skipped"] += 1
+                continue
+            await queue.put((letter_id, text))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    # ошибка записи в любом воркере останавливает всю обработку
+    tasks = [asyncio.create_task(producer())] + [asyncio.create_task(worker()) for _ in range(concurrency)]
+    flusher = asyncio.create_task(writer.flush_periodically())
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for t in tasks + [flusher]:
+            t.cancel()
+        await writer.flush()
+    return stats
+
+
+async def amain(args: argparse.Namespace) -> dict:
+    from src.compression import DigestCache
+    from src.emotion_cache import EmotionCache
+    from src.fact_store import FactStore
+    from src.llm_cache import LLMCache
+    from src.model_routing import load_routes, parse_backends
+    from src.ratelimit import RateLimiter
+
+    emotion_cache = EmotionCache(os.getenv("EMOTION_CACHE_PATH") or "data/emotions.db")
+    digest_cache = DigestCache(os.getenv("DIGEST_CACHE_PATH") or "data/digests.db")
+    llm_cache = LLMCache(maxsize=int(os.getenv("LLM_CACHE_SIZE", "4096")))
+    rate_limiter = RateLimiter()
+    model_routes = load_routes(os.getenv("MODEL_ROUTES", ""), defaults=os.getenv("MODEL_ROUTES_DEFAULTS", "0") == "1")
+    fallbacks = parse_backends(os.getenv("LLM_FALLBACKS", ""))
+    agent = AgentSystem(
+        model=args.model,
+        base_url=BASE_URL,
+        api_key=os.getenv("OPENROUTEREGORGIT"),
+        temperature=0.7,
+        top_p=0.8,
+        emotion_cache=emotion_cache,
+        llm_cache=llm_cache,
+        rate_limiter=rate_limiter,
+        letter_token_budget=int(os.getenv("LETTER_TOKEN_BUDGET", "0")) or None,
+        digest_cache=digest_cache,
+        model_routes=model_routes,
+        fallbacks=fallbacks,
+    )
+    checker = fact_store = None
+    if args.task == "facts":
+        fact_store = FactStore(os.getenv("FACT_STORE_PATH") or "data/facts.db")
+        checker = Checker(
+            model=args.model,
+            base_url=BASE_URL,
+            api_key=os.getenv("OPENROUTEREGORGIT"),
+            llm_cache=llm_cache,
+            rate_limiter=rate_limiter,
+            fact_store=fact_store,
+            model_routes=model_routes,
+            fallbacks=fallbacks,
+        )
+    try:
+        return await run_batch(
+            iter_letters(args.input, args.limit),
+            make_task(args.task, agent, checker),
+            out_dir=args.output,
+            checkpoint_path=args.checkpoint,
+            concurrency=args.concurrency,
+            part_size=args.part_size,
+            flush_interval=args.flush_interval,
+        )
+    finally:
+        await agent.aclose()
+        emotion_cache.close()
+        digest_cache.close()
+        if fact_store is not None:
+            fact_store.close()
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Пакетная обработка корпуса писем")
+    parser.add_argument("task", choices=["emotions", "story", "facts"])
+    parser.add_argument("--input", default="data/letters.pkl", help="data/letters.pkl или data/letters.bin")
+    parser.add_argument("--output", default=None, help="папка для parquet-частей, по умолчанию data/batch_<task>")
+    parser.add_argument("--checkpoint", default=None, help="по умолчанию <output>.checkpoint")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--part-size", type=int, default=10)
+    parser.add_argument("--flush-interval", type=float, default=30.0, help="сколько секунд результаты могут ждать записи")
+    parser.add_argument("--model", default=MODEL)
+    args = parser.parse_args()
+    args.output = args.output or f"data/batch_{args.task}"
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+    load_dotenv()
+    stats = asyncio.run(amain(args))
+    print(f"Обработано: {stats['done']}, пропущено: {stats['skipped']}, с ошибкой: {stats['failed']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import asyncio
+import logging
+from typing import Any
+
+from src.cache import TTLCache
+from src.metrics import PROVIDER_CALLBACKS
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackRegistry:
+    """
+    Задачи провайдера, которые ждут вебхука о завершении.
+
+    Вебхук может прийти раньше, чем задача начала его ждать (ответ на создание
+    задачи еще в пути), поэтому такие ответы какое-то время хранятся
+    """
+
+    def __init__(self, provider: str, early_ttl: float = 600.0):
+        self.provider = provider
+        self._waiters: dict[str, asyncio.Future] = {}
+        self._early = TTLCache(maxsize=1024, ttl=early_ttl)
+
+    @property
+    def pending(self) -> int:
+        return len(self._waiters)
+
+    def expect(self, request_id: str) -> asyncio.Future:
+        """Future, который завершится телом вебхука для request_id"""
+        future = asyncio.get_running_loop().create_future()
+        early = self._early.pop(request_id)
+        if early is not None:
+            future.set_result(early)
+        else:
+            self._waiters[request_id] = future
+        return future
+
+    def discard(self, request_id: str) -> None:
+        future = self._waiters.pop(request_id, None)
+        if future is not None and not future.done():
+            future.cancel()
+
+    def resolve(self, request_id: str, payload: Any) -> bool:
+        """Передает тело вебхука ожидающей задаче. False - ее никто не ждет"""
+        future = self._waiters.pop(request_id, None)
+        if future is None or future.done():
+            # задача еще не начала ждать или это другой воркер; опрос все равно ее найдет
+            self._early.set(request_id, payload)
+            PROVIDER_CALLBACKS.labels(self.provider, "early").inc()
+            logger.info(f"{self.provider}: вебхук для {request_id}, который пока никто не ждет")
+            return False
+        future.set_result(payload)
+        PROVIDER_CALLBACKS.labels(self.provider, "resolved").inc()
+        return True
@@ -1,12 +1,19 @@
+import asyncio
 import logging
 import re
 
 from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
 
 logger = logging.getLogger(__name__)
 
-from src.agentsystem import ServiceUnavailableError
+from src.agentsystem import ServiceUnavailableError, run_sync
+from src.fact_store import RELIABLE, UNCERTAIN, UNRELIABLE, FactStore
+from src.llm_cache import LLMCache, cached_chain
+from src.hedging import HedgedChat, HedgePolicy
+from src.metrics import StageTimer
+from src.model_routing import ModelRegistry, StageModel
+from src.prompts import CHECK_FACTS_TEMPLATE, EXTRACT_FACTS_TEMPLATE
+from src.ratelimit import LimitedChain, RateLimiter
 
 class Checker:
     def __init__(
@@ -16,89 +23,96 @@ class Checker:
         api_key: str,
         temperature: float = 0.7,
         top_p: float = 0.9,
+        llm_cache: LLMCache = None,
+        rate_limiter: RateLimiter = None,
+        fact_store: FactStore = None,
+        chunk_size: int = 5,
+        model_routes: dict[str, StageModel] = None,
+        fallbacks: list[StageModel] = None,
+        hedge_policy: HedgePolicy = HedgePolicy(),
     ):
-        self.model = ChatOpenAI(
-            model=model,
-            base_url=base_url,
-            api_key=api_key,
-            temperature=temperature,
-            top_p=top_p,
+        """
+        fact_store - постоянное хранилище проверенных фактов, известные факты не идут в модель
+        chunk_size - сколько фактов проверяется одним вызовом модели, части проверяются параллельно
+        model_routes - свои модели для шагов extract_facts и check_facts
+        fallbacks - запасные бэкенды, как в AgentSystem
+        """
+        self.models = ModelRegistry(
+            StageModel(model=model, base_url=base_url, api_key=api_key, temperature=temperature, top_p=top_p),
+            model_routes,
+            fallbacks,
+            hedge_policy,
         )
+        self.model = self.models.chat()
+        self._llm_cache = llm_cache
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self._fact_store = fact_store
+        self._chunk_size = chunk_size
+        self._extract_facts_chain = self._build_chain("extract_facts", EXTRACT_FACTS_TEMPLATE)
+        self._check_facts_chain = self._build_chain("check_facts", CHECK_FACTS_TEMPLATE)
+
+    def _build_chain(self, stage: str, template: str):
+        model = self.models.runnable(stage, self.rate_limiter)
+        chain = (PromptTemplate.from_template(template) | model).with_config(tags=[f"stage:{stage}"])
+        if not isinstance(model, HedgedChat):
+            config = self.models.config(stage)
+            chain = LimitedChain(chain, self.rate_limiter.get(config.base_url, config.api_key))
+        return cached_chain(chain, self._llm_cache, stage, model.model_name, template)
     
     def _is_vse_chetko(self, text):
         pattern = r"в[сc][её]\s+ч[её]тк[оo]"
         return bool(re.search(pattern, text, re.IGNORECASE | re.UNICODE))
     
-    def _extract_date_and_facts(self, history: str) -> str:
+    async def _extract_date_and_facts(self, history: str) -> str:
         """Достает факты и даты из истории"""
-        template = """
-
-        Тебе нужно извлечь только проверяемые, объективные факты, связанные с историей или естественными науками, из приведённого ниже текста. Не включай личные переживания, бытовые подробности, медицинские случаи, субъективные мнения, малозначимые детали или информацию, не имеющую отношения к истории или естественным наукам. Игнорируй высказывания, которые нельзя подтвердить с помощью авторитетных источников или которые не являются общеизвестными фактами.
-
-        Примеры допустимых фактов:
-
-        - Октябрьская революция была в 1917 году
-
-        - Во Второй Мировой войне участвовал СССР
-
-        - Зимой холодно (естественная наука)
-
-        Примеры недопустимых фактов:
-
-        - Ранение левой руки осколком снаряда
-
-        - Кость осталась целой
-
-        - Отец Михаила потерял руку на Первой мировой войне
-
-        - Урал — географический регион с холодным климатом (слишком общее утверждение, если не указаны конкретные исторические события)
-
-        Требования:
-
-        - Извлекай только факты, которые можно подтвердить как общеизвестные или документально зафиксированные исторические или научные сведения.
-
-        - Не включай частные случаи, бытовые детали, субъективные мнения и малозначимые сведения.
-
-        - Не добавляй выдуманные или сомнительные утверждения.
-
-        - В ответе перечисли только найденные корректные факты через запятую, не используя никакую разметку.
-
-        История: {history}
-        """
-        prompt = PromptTemplate.from_template(template)
-        chat = prompt | self.model
-        response = chat.invoke({"history": history})
+        response = await self._extract_facts_chain.ainvoke({"history": history})
         return response.content
-    
-    def _check_facts(self, facts: str) -> str:
-        template = """Ты - прфоессиональный историк. Твоя задача оценвать факты, которые тебе приходят
-
-        Факты ты должен разделить на 3 категории
-        - Достоверные. Это правдивые факты К примеру: Земля круглая
-        - Недостоверные. Это ложные факты. К примеру: Земля плоская
-        - Неопределенные. Это факты, которые ты не знаешь, куда отнести и не можешь дать СТОПРОЦЕНТНУЮ ГАРАНТИЮ
-        на то, что факт либо достоверный либо недостоверный
-
-        Вот факты:
-        {facts}
-
-        В качестве ответа тебе нужно написать "Все четко" (без кавычек, скобочек, разметки md и т.п.), если нет недостоверных или неопределенных фактов
-
-        Если такие факты есть, то в ответе ты должен их перечислить через запятую без разметки md, скобочек и т.п.
 
-        Я верю, что ты справишься с поставленной задачей ответственно, поскольку это очень важно для меня.
-
-        Если ты сделаешь все отлично, то я подарю тебе дополнительных мощностей, чтобы ты мог расширяться и помогать другим людям!
-        """
-        prompt = PromptTemplate.from_template(template)
-        chat = prompt | self.model
-        response = chat.invoke({"facts": facts})
+    @staticmethod
+    def _split_facts(facts: str) -> list[str]:
+        """Факты по одному: модель пишет их с новой строки, старые ответы - через запятую"""
+        lines = [line.strip(" -•\t") for line in facts.splitlines()]
+        lines = [line for line in lines if line]
+        if len(lines) == 1:
+            lines = [fact.strip() for fact in lines[0].split(",") if fact.strip()]
+        return list(dict.fromkeys(lines))
+
+    async def _check_facts(self, facts: list[str]) -> dict[str, str]:
+        """Вердикты для части фактов одним вызовом модели"""
+        numbered = "\n".join(f"{i}. {fact}" for i, fact in enumerate(facts, start=1))
+        response = await self._check_facts_chain.ainvoke({"facts": numbered})
         if self._is_vse_chetko(response.content):
-            return "кайф"
-        else:
-            return response.content
-        
+            return {fact: RELIABLE for fact in facts}
+        verdicts = {}
+        for number, verdict in re.findall(r"(\d+)\s*[:.)-]\s*([а-яё]+)", response.content.lower()):
+            index = int(number) - 1
+            if 0 <= index < len(facts) and verdict in (RELIABLE, UNRELIABLE, UNCERTAIN):
+                verdicts[facts[index]] = verdict
+        # факт без вердикта модели считается неопределенным и уходит администратору
+        return {fact: verdicts.get(fact, UNCERTAIN) for fact in facts}
+
+    async def _verify_facts(self, facts: list[str]) -> dict[str, str]:
+        """Известные факты берутся из хранилища, новые проверяются параллельно частями"""
+        # вердикт другой модели не переиспользуется
+        model = self.models.config("check_facts").model or ""
+        known = await self._fact_store.get_many(facts, model) if self._fact_store is not None else {}
+        unknown = [fact for fact in facts if fact not in known]
+        if known:
+            logger.info(f"Фактов из хранилища: {len(known)}, новых: {len(unknown)}")
+        chunks = [unknown[i:i + self._chunk_size] for i in range(0, len(unknown), self._chunk_size)]
+        checked: dict[str, str] = {}
+        for result in await asyncio.gather(*(self._check_facts(chunk) for chunk in chunks)):
+            checked.update(result)
+        if self._fact_store is not None and checked:
+            await self._fact_store.set_many(checked, model)
+        verdicts = {**known, **checked}
+        return {fact: verdicts[fact] for fact in facts}
+
     def main_process(self, history: str) -> dict:
+        """Синхронная обертка над amain_process"""
+        return run_sync(self.amain_process(history))
+
+    async def amain_process(self, history: str) -> dict:
         """
         Описание возвращаемой информации
         
@@ -108,19 +122,22 @@ class Checker:
         2. {"status": "bad", "for_check": str} - в этом случае нужно делать проверку администратору
         """
         try:
-            facts = self._extract_date_and_facts(history)
-            print(facts)
+            with StageTimer("checker", "extract_facts"):
+                facts = await self._extract_date_and_facts(history)
+            logger.debug(f"Факты из истории: {facts}")
         except Exception as e:
             logger.exception("Ошибка при выделении фактов")
             raise ServiceUnavailableError("Сервис выделения фактов недоступен") from e
         
         try:
-            result_check = self._check_facts(facts)
+            with StageTimer("checker", "check_facts"):
+                verdicts = await self._verify_facts(self._split_facts(facts))
         except Exception as e:
             logger.exception("Ошибка при проверке фактов")
             raise ServiceUnavailableError("Сервис проверки фактов недоступен") from e
-        
-        if result_check == "кайф":
+
+        for_check = [fact for fact, verdict in verdicts.items() if verdict != RELIABLE]
+        if not for_check:
             return {"status": "good", "for_check": None}
         else:
-            return {"status": "bad", "for_check": result_check}
+            return {"status": "bad", "for_check": ", ".join(for_check)}
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from src.cache import TTLCache
+from src.emotion_cache import text_hash
+
+logger = logging.getLogger(__name__)
+
+# кодировка GPT-4, для qwen и других моделей OpenRouter счет получается близким
+ENCODING = "cl100k_base"
+# на русском тексте cl100k дает примерно токен на 3 символа
+_CHARS_PER_TOKEN = 3
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+_token_counts = TTLCache(maxsize=8192)
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            try:
+                # tiktoken приходит вместе с langchain-openai, но словарь скачивается при первом вызове
+                import tiktoken
+
+                _encoding = tiktoken.get_encoding(ENCODING)
+            except Exception:
+                logger.warning("Словарь tiktoken недоступен, токены считаются приблизительно по длине текста")
+            _encoding_loaded = True
+    return _encoding
+
+
+async def aload_encoding() -> None:
+    """Загружает словарь tiktoken в отдельном потоке, чтобы скачивание не блокировало цикл событий"""
+    if not _encoding_loaded:
+        await asyncio.to_thread(_get_encoding)
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов текста. Результат запоминается по хэшу текста"""
+    key = text_hash(text)
+    count = _token_counts.get(key)
+    if count is None:
+        encoding = _get_encoding()
+        if encoding is not None:
+            count = len(encoding.encode(text, disallowed_special=()))
+        else:
+            count = -(-len(text) // _CHARS_PER_TOKEN)
+        _token_counts.set(key, count)
+    return count
+
+
+def normalize_letter(text: str) -> str:
+    """
+    Убирает из письма то, что не несет смысла, но стоит токенов:
+    невидимые символы, повторяющиеся пробелы, пробелы по краям строк и пустые строки подряд
+    """
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = re.sub(r"[­​‌‍﻿]", "", text)
+    text = re.sub(r"[^\S\n]+", " ", text)
+    text = re.sub(r" *\n *", "\n", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+class DigestCache:
+    """
+    Постоянный кэш сжатых писем в SQLite.
+
+    Ключ - хэш письма и бюджет токенов, при смене бюджета письмо сжимается заново
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS digests (
+                    hash TEXT NOT NULL,
+                    budget INTEGER NOT NULL,
+                    digest TEXT NOT NULL,
+                    tokens_before INTEGER NOT NULL,
+                    tokens_after INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (hash, budget)
+                )
+                """
+            )
+
+    def get_sync(self, text: str, budget: int) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest FROM digests WHERE hash = ? AND budget = ?", (text_hash(text), budget)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_sync(self, text: str, budget: int, digest: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+                (text_hash(text), budget, digest, count_tokens(text), count_tokens(digest), time.time()),
+            )
+
+    async def get(self, text: str, budget: int) -> Optional[str]:
+        return await asyncio.to_thread(self.get_sync, text, budget)
+
+    async def set(self, text: str, budget: int, digest: str) -> None:
+        await asyncio.to_thread(self.set_sync, text, budget, digest)
+
+    def stats(self) -> dict:
+        """Сколько писем сжато и сколько токенов это сэкономило на одну передачу письма"""
+        with self._lock:
+            count, before, after = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(tokens_before), 0), COALESCE(SUM(tokens_after), 0) FROM digests"
+            ).fetchone()
+        return {"digests": count, "tokens_before": before, "tokens_after": after}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.close()
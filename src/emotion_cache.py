@@ -0,0 +1,105 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+SEED_FILES = ("data/done_emotions.xlsx", "data/done_cycle_emotions.xlsx")
+SEED_COLUMN = "qwen/qwen3-235b-a22b:free_emotions"
+
+
+def text_hash(text: str) -> str:
+    """Хэш содержимого письма: пробелы и табуляция не влияют на ключ"""
+    normalized = re.sub(r"\s+", " ", text).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class EmotionCache:
+    """
+    Постоянный кэш эмоций писем в SQLite.
+
+    Эмоции письма не меняются, поэтому повторный анализ того же текста
+    не требует вызова модели
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS emotions (
+                    hash TEXT PRIMARY KEY,
+                    emotions TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+
+    def get_sync(self, text: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT emotions FROM emotions WHERE hash = ?", (text_hash(text),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_sync(self, text: str, emotions: str, source: str = "llm") -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO emotions VALUES (?, ?, ?, ?)",
+                (text_hash(text), emotions, source, time.time()),
+            )
+
+    async def get(self, text: str) -> Optional[str]:
+        return await asyncio.to_thread(self.get_sync, text)
+
+    async def set(self, text: str, emotions: str, source: str = "llm") -> None:
+        await asyncio.to_thread(self.set_sync, text, emotions, source)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM emotions").fetchone()[0]
+
+    def seed_from_excel(self, paths: Iterable[str] = SEED_FILES, column: str = SEED_COLUMN) -> int:
+        """Заполняет кэш результатами из ноутбука control_emotions"""
+        import pandas as pd
+
+        added = 0
+        for path in paths:
+            data = pd.read_excel(path)
+            for text, emotions in zip(data["text"], data[column]):
+                if not isinstance(text, str) or not isinstance(emotions, str):
+                    continue
+                if not emotions.strip() or emotions == "модель не ответила":
+                    continue
+                self.set_sync(text, emotions, source=path)
+                added += 1
+        return added
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Кэш эмоций писем")
+    parser.add_argument("command", choices=["seed"])
+    parser.add_argument("--db", default="data/emotions.db")
+    parser.add_argument("--files", nargs="+", default=list(SEED_FILES))
+    parser.add_argument("--column", default=SEED_COLUMN)
+    args = parser.parse_args()
+
+    cache = EmotionCache(args.db)
+    added = cache.seed_from_excel(args.files, args.column)
+    print(f"Добавлено записей: {added}, всего в кэше: {len(cache)}")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
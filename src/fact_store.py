@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional
+
+from src.emotion_cache import text_hash
+
+logger = logging.getLogger(__name__)
+
+RELIABLE = "достоверно"
+UNRELIABLE = "недостоверно"
+UNCERTAIN = "неопределенно"
+
+
+def fact_key(fact: str) -> str:
+    """Ключ факта: регистр, пробелы и точка в конце не важны"""
+    return text_hash(fact.lower().strip().rstrip("."))
+
+
+class FactStore:
+    """
+    Постоянное хранилище проверенных фактов в SQLite.
+
+    Хранятся только однозначные вердикты (достоверно/недостоверно):
+    неопределенные факты при следующей встрече проверяются заново.
+    Вердикт действует только для модели, которая его вынесла. "Недостоверно"
+    живет unreliable_ttl секунд, чтобы одна ошибка модели не клеймила факт навсегда
+    """
+
+    def __init__(self, path: str, unreliable_ttl: Optional[float] = 7 * 24 * 3600):
+        self.unreliable_ttl = unreliable_ttl
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            # в старой схеме ключом был только hash: вердикт одной модели затирал вердикт другой
+            primary_key = {row[1] for row in self._conn.execute("PRAGMA table_info(facts)") if row[5]}
+            if primary_key and primary_key != {"hash", "model"}:
+                self._migrate()
+            else:
+                self._create_table()
+
+    def _create_table(self) -> None:
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS facts (
+                hash TEXT NOT NULL,
+                model TEXT NOT NULL DEFAULT '',
+                fact TEXT NOT NULL,
+                verdict TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (hash, model)
+            )
+            """
+        )
+
+    def _migrate(self) -> None:
+        """Пересоздает таблицу с ключом (hash, model). Старые вердикты без модели не совпадут ни с одной моделью"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(facts)")}
+        model = "model" if "model" in columns else "''"
+        self._conn.execute("ALTER TABLE facts RENAME TO facts_old")
+        self._create_table()
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO facts (hash, model, fact, verdict, created_at) "
+            f"SELECT hash, {model}, fact, verdict, created_at FROM facts_old"
+        )
+        self._conn.execute("DROP TABLE facts_old")
+        logger.info("Таблица фактов переведена на ключ (hash, model)")
+
+    def get_many_sync(self, facts: Iterable[str], model: str = "") -> dict[str, str]:
+        """Вердикты известных фактов, вынесенные моделью model: {факт: вердикт}"""
+        keys = {fact_key(fact): fact for fact in facts}
+        if not keys:
+            return {}
+        placeholders = ",".join("?" * len(keys))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT hash, verdict, created_at FROM facts WHERE model = ? AND hash IN ({placeholders})",
+                [model, *keys],
+            ).fetchall()
+        expired_before = time.time() - self.unreliable_ttl if self.unreliable_ttl is not None else None
+        return {
+            keys[key]: verdict
+            for key, verdict, created_at in rows
+            if not (verdict == UNRELIABLE and expired_before is not None and created_at < expired_before)
+        }
+
+    def set_many_sync(self, verdicts: dict[str, str], model: str = "") -> None:
+        now = time.time()
+        rows = [
+            (fact_key(fact), fact, verdict, now, model)
+            for fact, verdict in verdicts.items()
+            if verdict in (RELIABLE, UNRELIABLE)
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO facts (hash, fact, verdict, created_at, model) VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    async def get_many(self, facts: Iterable[str], model: str = "") -> dict[str, str]:
+        return await asyncio.to_thread(self.get_many_sync, list(facts), model)
+
+    async def set_many(self, verdicts: dict[str, str], model: str = "") -> None:
+        await asyncio.to_thread(self.set_many_sync, verdicts, model)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM facts").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.close()
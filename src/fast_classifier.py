@@ -0,0 +1,254 @@
+import argparse
+import json
+import logging
+import math
+import random
+import re
+from collections import Counter
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# основы слов, по которым запрос точно задает эмоции
+EMOTION_STEMS = (
+    "груст", "печал", "тоск", "весел", "радос", "счаст", "носта", "любов", "любв", "надеж",
+    "драма", "траги", "романт", "трога", "вдохн", "страш", "ужас", "трево", "мрачн",
+    "светл", "тепло", "тёпл", "смешн", "юмор", "забав", "герои", "отваж", "мужес", "горд",
+    "слез", "слёз", "трепе", "нежн", "злост", "гнев", "оптим", "эмоци", "чувст",
+)
+# темы, которые не подходят под письма военных лет: основы сравниваются с началом слова,
+# короткие названия - только целиком, чтобы "планерная" не стала "планетой"
+OFF_TOPIC_STEMS = (
+    "космос", "космич", "планет", "инопланет", "марсиан", "африк", "гавай", "зомби", "вампир",
+    "дракон", "волшеб", "фэнтез", "киберп", "робот", "динозавр", "пират", "ниндзя", "эльф",
+    "супергер",
+)
+OFF_TOPIC_WORDS = ("марс", "марса", "марсе", "марсом", "бали")
+# явные признаки военной темы: с ними словарь тем не отклоняет запрос, решает модель
+MILITARY_STEMS = (
+    "войн", "военн", "фронт", "солда", "тыл", "побед", "бой", "боец", "бойц", "окоп", "арми",
+    "госпи", "ранен", "блока", "танки", "летчи", "лётчи", "медсе", "партиз", "эвакуа",
+)
+# слова перед эмоцией, которые ее отменяют: "без эмоций", "не грустную"
+NEGATIONS = ("не", "без", "нет", "ни", "никаких", "никакой", "никакого", "никакую", "избегай", "избегать")
+# слова, которые встречаются в обычных просьбах и не меняют тему
+SAFE_STEMS = (
+    "сдела", "напиш", "истор", "расск", "хочу", "хотел", "пусть", "чтобы", "была", "был", "быть",
+    "будет", "более", "очень", "немно", "добав", "элеме", "оттен", "про", "о", "об", "обо", "с",
+    "и", "но", "а", "в", "во", "на", "со", "по", "для", "мне", "пожал", "она", "он", "это",
+    "так", "как", "бы", "же", "еще", "ещё", "эту", "этой", "всё", "все", "тон", "настр", "сюжет",
+    "письм", "войн", "военн", "фронт", "солда", "тыл", "побед", "семь", "мама", "мать", "отец",
+    "сын", "дочь", "брат", "сестр", "жена", "муж", "дом", "родн", "бой", "боец", "бойц",
+    "госпи", "ранен", "блока", "ленин", "москв", "разве", "танки", "летчи", "лётчи", "медсе",
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Токены запроса: слова в нижнем регистре, обрезанные до основы из 5 букв"""
+    words = re.findall(r"[а-яёa-z]+", text.lower())
+    return [word[:5] for word in words]
+
+
+def words(text: str) -> list[tuple[str, bool]]:
+    """
+    Слова запроса целиком в нижнем регистре и признак имени собственного:
+    слово с заглавной буквы не в начале предложения ("про Романа")
+    """
+    result = []
+    sentence_start = True
+    for match in re.finditer(r"[А-ЯЁа-яёA-Za-z]+|[.!?]", text):
+        word = match.group()
+        if word in ".!?":
+            sentence_start = True
+            continue
+        result.append((word.lower(), word[0].isupper() and not sentence_start))
+        sentence_start = False
+    return result
+
+
+def _matches(token: str, stem: str) -> bool:
+    # короткие служебные слова сравниваются целиком, иначе "и" совпало бы с "история"
+    return token == stem if len(stem) < 4 else token.startswith(stem)
+
+
+def _has_stem(tokens: Iterable[str], stems: tuple[str, ...]) -> bool:
+    return any(_matches(token, stem) for token in tokens for stem in stems)
+
+
+def _is_off_topic(word: str) -> bool:
+    return word in OFF_TOPIC_WORDS or any(word.startswith(stem) for stem in OFF_TOPIC_STEMS)
+
+
+def _emotion_words(query: str) -> tuple[list[str], bool]:
+    """Слова запроса, задающие эмоции, и был ли среди эмоций отрицаемый ("без эмоций"). Имена не считаются"""
+    found, negated = [], False
+    previous = ""
+    for word, is_name in words(query):
+        if not is_name and _has_stem([word], EMOTION_STEMS):
+            if previous in NEGATIONS:
+                negated = True
+            else:
+                found.append(word)
+        previous = word
+    return found, negated
+
+
+class _NaiveBayes:
+    """Наивный Байес по основам слов для одного бинарного вопроса"""
+
+    def __init__(self, log_prior: float, weights: dict[str, float]):
+        self.log_prior = log_prior
+        self.weights = weights
+
+    @classmethod
+    def fit(cls, samples: list[tuple[list[str], bool]], alpha: float = 1.0) -> "_NaiveBayes":
+        positive, negative = Counter(), Counter()
+        n_positive = sum(1 for _, label in samples if label)
+        n_negative = len(samples) - n_positive
+        for tokens, label in samples:
+            (positive if label else negative).update(set(tokens))
+        vocabulary = set(positive) | set(negative)
+        weights = {
+            token: math.log((positive[token] + alpha) / (n_positive + 2 * alpha))
+            - math.log((negative[token] + alpha) / (n_negative + 2 * alpha))
+            for token in vocabulary
+        }
+        log_prior = math.log((n_positive + alpha) / (n_negative + alpha))
+        return cls(log_prior, weights)
+
+    def probability(self, tokens: list[str]) -> float:
+        score = self.log_prior + sum(self.weights.get(token, 0.0) for token in set(tokens))
+        return 1 / (1 + math.exp(-max(min(score, 50), -50)))
+
+    def to_dict(self) -> dict:
+        return {"log_prior": self.log_prior, "weights": self.weights}
+
+
+class QueryClassifier:
+    """
+    Локальный классификатор для проверки темы и эмоций запроса.
+
+    Возвращает True/False, только если уверен, иначе None - тогда ответ
+    нужно получить у модели. Сначала работают словари (они консервативны),
+    затем обученная на логах модель, если она загружена
+    """
+
+    def __init__(self, models: Optional[dict[str, _NaiveBayes]] = None, confidence: float = 0.95):
+        self._models = models or {}
+        self.confidence = confidence
+
+    @classmethod
+    def load(cls, path: str, confidence: float = 0.95) -> "QueryClassifier":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        models = {task: _NaiveBayes(**params) for task, params in data.items()}
+        return cls(models, confidence)
+
+    def save(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({task: model.to_dict() for task, model in self._models.items()}, f, ensure_ascii=False)
+
+    def _from_model(self, task: str, tokens: list[str]) -> Optional[bool]:
+        model = self._models.get(task)
+        if model is None:
+            return None
+        probability = model.probability(tokens)
+        if probability >= self.confidence:
+            return True
+        if probability <= 1 - self.confidence:
+            return False
+        return None
+
+    def is_military(self, query: str) -> Optional[bool]:
+        """Соответствует ли запрос военной тематике"""
+        tokens = tokenize(query)
+        query_words = [word for word, _ in words(query)]
+        if any(_is_off_topic(word) for word in query_words):
+            # чужая тема без признаков войны - точно мимо, вместе с ними ("летчик на Марсе") - решает модель
+            return None if _has_stem(query_words, MILITARY_STEMS) else False
+        if query_words and all(_has_stem([word], SAFE_STEMS + EMOTION_STEMS) for word in query_words):
+            return True
+        return self._from_model("is_military", tokens)
+
+    def has_emotions(self, query: str) -> Optional[bool]:
+        """Есть ли в запросе требования к эмоциональной составляющей"""
+        tokens = tokenize(query)
+        found, negated = _emotion_words(query)
+        if negated:
+            # "без эмоций", "не грустную" - словарь такое не разбирает, решает модель
+            return None
+        if found:
+            return True
+        query_words = [word for word, is_name in words(query) if not is_name]
+        if query_words and all(_has_stem([word], SAFE_STEMS) for word in query_words):
+            return False
+        return self._from_model("has_emotions", tokens)
+
+    def emotions(self, query: str) -> list[str]:
+        """Слова запроса, которые задают эмоции, без отрицаемых и имен"""
+        return _emotion_words(query)[0]
+
+
+def read_verdicts(path: str) -> list[dict]:
+    """Лог вердиктов модели: по одной json-записи {query, is_military, has_emotions} в строке"""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def train(records: list[dict]) -> QueryClassifier:
+    models = {}
+    for task in ("is_military", "has_emotions"):
+        samples = [(tokenize(r["query"]), bool(r[task])) for r in records if r.get(task) is not None]
+        if samples:
+            models[task] = _NaiveBayes.fit(samples)
+    return QueryClassifier(models)
+
+
+def evaluate(classifier: QueryClassifier, records: list[dict]) -> dict:
+    """Доля запросов, решенных локально, и совпадение с вердиктами модели на них"""
+    report = {}
+    for task in ("is_military", "has_emotions"):
+        predict = getattr(classifier, task)
+        answered = agreed = total = 0
+        for record in records:
+            if record.get(task) is None:
+                continue
+            total += 1
+            verdict = predict(record["query"])
+            if verdict is not None:
+                answered += 1
+                agreed += verdict == bool(record[task])
+        report[task] = {
+            "total": total,
+            "coverage": answered / total if total else 0.0,
+            "agreement": agreed / answered if answered else 0.0,
+        }
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Обучение и оценка локального классификатора запросов")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--log", default="data/verdicts.jsonl", help="лог вердиктов модели")
+    parser.add_argument("--model", default="data/query_classifier.json")
+    parser.add_argument("--test-size", type=float, default=0.2)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    args = parser.parse_args()
+
+    records = read_verdicts(args.log)
+    if args.command == "train":
+        random.Random(42).shuffle(records)
+        split = int(len(records) * (1 - args.test_size))
+        classifier = train(records[:split])
+        classifier.confidence = args.confidence
+        classifier.save(args.model)
+        print(f"Обучено на {split} запросах, модель сохранена в {args.model}")
+        print("Только словари:", json.dumps(evaluate(QueryClassifier(), records[split:]), ensure_ascii=False))
+        print("Словари + модель:", json.dumps(evaluate(classifier, records[split:]), ensure_ascii=False))
+    else:
+        classifier = QueryClassifier.load(args.model, args.confidence)
+        print(json.dumps(evaluate(classifier, records), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from src.metrics import LLM_BACKEND_REQUESTS, LLM_HEDGES
+from src.ratelimit import ProviderLimiter
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class HedgePolicy:
+    """
+    Когда дублировать запрос и когда считать бэкенд деградировавшим.
+
+    Дубль уходит следующему бэкенду, если ответа нет дольше quantile-перцентиля
+    задержки текущего (в пределах min_delay..max_delay; пока замеров меньше
+    min_samples - через initial_delay). Одновременно идет не больше 1 + max_hedges запросов.
+    Бэкенд с долей ошибок и проигранных гонок от error_threshold за последние window
+    секунд (и хотя бы min_requests запросами) на cooldown секунд уходит в конец очереди
+    """
+
+    quantile: float = 95.0
+    min_delay: float = 1.0
+    max_delay: float = 30.0
+    initial_delay: float = 10.0
+    min_samples: int = 10
+    max_hedges: int = 1
+    window: float = 60.0
+    error_threshold: float = 0.5
+    min_requests: int = 5
+    cooldown: float = 30.0
+
+
+class LatencyWindow:
+    """Последние замеры задержки"""
+
+    def __init__(self, maxlen: int = 200):
+        self._values: deque[float] = deque(maxlen=maxlen)
+
+    def add(self, value: float) -> None:
+        self._values.append(value)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self._values:
+            return None
+        values = sorted(self._values)
+        rank = max(1, round(p / 100 * len(values)))
+        return values[min(rank, len(values)) - 1]
+
+
+class BackendHealth:
+    """Ошибки бэкенда за скользящее окно, общие для всех шагов"""
+
+    def __init__(self, name: str, policy: HedgePolicy):
+        self.name = name
+        self.policy = policy
+        self._outcomes: deque[tuple[float, bool]] = deque()
+        self._degraded_until = 0.0
+
+    def _prune(self, now: float) -> None:
+        while self._outcomes and self._outcomes[0][0] < now - self.policy.window:
+            self._outcomes.popleft()
+
+    def record(self, ok: bool) -> None:
+        now = time.monotonic()
+        self._outcomes.append((now, ok))
+        self._prune(now)
+        if ok or self.degraded:
+            return
+        if len(self._outcomes) >= self.policy.min_requests and self.error_rate() >= self.policy.error_threshold:
+            self._degraded_until = now + self.policy.cooldown
+            logger.warning(
+                f"{self.name}: {self.error_rate():.0%} ошибок за {self.policy.window:.0f} c, "
+                f"на {self.policy.cooldown:.0f} c запросы идут в другие бэкенды"
+            )
+
+    def error_rate(self) -> float:
+        self._prune(time.monotonic())
+        if not self._outcomes:
+            return 0.0
+        return sum(not ok for _, ok in self._outcomes) / len(self._outcomes)
+
+    @property
+    def degraded(self) -> bool:
+        return time.monotonic() < self._degraded_until
+
+    def stats(self) -> dict:
+        return {"requests": len(self._outcomes), "error_rate": self.error_rate(), "degraded": self.degraded}
+
+
+@dataclass
+class Backend:
+    name: str
+    chat: Runnable
+    limiter: Optional[ProviderLimiter]
+    health: BackendHealth
+
+
+def _consume(task: asyncio.Future) -> None:
+    # исключение отмененного проигравшего запроса никому не нужно, забираем его, чтобы не было предупреждений
+    if not task.cancelled():
+        task.exception()
+
+
+class HedgedChat(Runnable[LanguageModelInput, BaseMessage]):
+    """
+    Модель с запасными бэкендами, встраивается в цепочку вместо ChatOpenAI: prompt | HedgedChat(...).
+
+    Запрос уходит первому здоровому бэкенду. Если он не ответил за свой p95,
+    такой же запрос уходит следующему и берется первый ответ, второй отменяется.
+    При ошибке запрос сразу уходит следующему бэкенду. Для потоковых ответов
+    гонка идет до первого куска текста
+    """
+
+    def __init__(self, backends: list[Backend], stage: str = "", policy: HedgePolicy = HedgePolicy()):
+        if not backends:
+            raise ValueError("Нужен хотя бы один бэкенд")
+        self.backends = backends
+        self.stage = stage
+        self.policy = policy
+        self._latency: dict[tuple[str, str], LatencyWindow] = {}
+
+    @property
+    def model_name(self) -> str:
+        return self.backends[0].chat.model_name
+
+    def _window(self, kind: str, backend: Backend) -> LatencyWindow:
+        return self._latency.setdefault((kind, backend.name), LatencyWindow())
+
+    def hedge_delay(self, kind: str, backend: Backend) -> float:
+        """Через сколько секунд без ответа отправлять дубль"""
+        window = self._window(kind, backend)
+        if len(window) < self.policy.min_samples:
+            return self.policy.initial_delay
+        delay = window.percentile(self.policy.quantile)
+        return min(max(delay, self.policy.min_delay), self.policy.max_delay)
+
+    def _ordered(self) -> list[Backend]:
+        """Здоровые бэкенды в заданном порядке, деградировавшие - в конце как последний шанс"""
+        return [b for b in self.backends if not b.health.degraded] + [b for b in self.backends if b.health.degraded]
+
+    async def _race(self, kind: str, call: Callable[[Backend], Awaitable[Any]], on_lost: Callable[[Any], None]) -> Any:
+        backends = self._ordered()
+        tasks: dict[asyncio.Task, tuple[Backend, float]] = {}
+        last_error: Optional[BaseException] = None
+        next_index = 0
+        latest = hedge_at = None
+        won_started: Optional[float] = None
+
+        def launch() -> None:
+            nonlocal next_index, latest, hedge_at
+            latest = backends[next_index]
+            next_index += 1
+            task = asyncio.ensure_future(call(latest))
+            task.add_done_callback(_consume)
+            started = time.monotonic()
+            tasks[task] = (latest, started)
+            hedge_at = started + self.hedge_delay(kind, latest)
+
+        launch()
+        try:
+            while tasks:
+                can_hedge = next_index < len(backends) and len(tasks) <= self.policy.max_hedges
+                timeout = max(0.0, hedge_at - time.monotonic()) if can_hedge else None
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    LLM_HEDGES.labels(self.stage, backends[next_index].name).inc()
+                    logger.info(f"{self.stage}: {latest.name} отвечает слишком долго, дублируем в {backends[next_index].name}")
+                    launch()
+                    continue
+                for task in done:
+                    backend, started = tasks.pop(task)
+                    if task.exception() is None:
+                        self._window(kind, backend).add(time.monotonic() - started)
+                        backend.health.record(True)
+                        LLM_BACKEND_REQUESTS.labels(self.stage, backend.name, "ok").inc()
+                        won_started = started
+                        return task.result()
+                    last_error = task.exception()
+                    backend.health.record(False)
+                    LLM_BACKEND_REQUESTS.labels(self.stage, backend.name, "error").inc()
+                    logger.warning(f"{self.stage}: {backend.name} ответил ошибкой {type(last_error).__name__}")
+                if not tasks and next_index < len(backends):
+                    launch()
+            raise last_error
+        finally:
+            for task, (backend, started) in tasks.items():
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    on_lost(task.result())
+                else:
+                    task.cancel()
+                if won_started is not None and started < won_started:
+                    # проигрыш гонки бэкенду, запущенному позже, считается как сбой: бэкенд,
+                    # который стабильно медленнее запасного, уходит в конец очереди так же,
+                    # как отвечающий ошибками. Дубль, запущенный позже победителя, не штрафуется
+                    backend.health.record(False)
+                LLM_BACKEND_REQUESTS.labels(self.stage, backend.name, "cancelled").inc()
+
+    @staticmethod
+    async def _limited(backend: Backend, func: Callable[[], Awaitable[Any]]) -> Any:
+        if backend.limiter is None:
+            return await func()
+        return await backend.limiter.call(func)
+
+    async def ainvoke(self, input: LanguageModelInput, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        return await self._race(
+            "invoke",
+            lambda backend: self._limited(backend, lambda: backend.chat.ainvoke(input, config, **kwargs)),
+            on_lost=lambda _: None,
+        )
+
+    async def astream(
+        self, input: LanguageModelInput, config: Optional[RunnableConfig] = None, **kwargs
+    ) -> AsyncIterator[BaseMessage]:
+        async def open_stream(backend: Backend):
+            release = await backend.limiter.hold() if backend.limiter is not None else (lambda: None)
+            iterator = backend.chat.astream(input, config, **kwargs).__aiter__()
+            try:
+                first = await iterator.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                release()
+                await iterator.aclose()
+                raise
+            return iterator, first, release
+
+        def close_lost(opened) -> None:
+            iterator, _, release = opened
+            release()
+            asyncio.ensure_future(iterator.aclose())
+
+        iterator, first, release = await self._race("stream", open_stream, on_lost=close_lost)
+        try:
+            if first is not None:
+                yield first
+                async for chunk in iterator:
+                    yield chunk
+        finally:
+            release()
+            await iterator.aclose()
+
+    def invoke(self, input: LanguageModelInput, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        """Синхронный вызов без дублей: бэкенды по очереди до первого ответа"""
+        last_error = None
+        for backend in self._ordered():
+            try:
+                result = backend.chat.invoke(input, config, **kwargs)
+            except Exception as e:
+                backend.health.record(False)
+                last_error = e
+                continue
+            backend.health.record(True)
+            return result
+        raise last_error
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            backend.name: {
+                "p50": self._window("invoke", backend).percentile(50),
+                "p95": self._window("invoke", backend).percentile(95),
+                "first_token_p95": self._window("stream", backend).percentile(95),
+                "hedge_delay": self.hedge_delay("invoke", backend),
+                **backend.health.stats(),
+            }
+            for backend in self.backends
+        }
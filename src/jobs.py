@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Очередь задач переполнена"""
+
+
+@dataclass
+class Job:
+    """
+    Фоновая задача.
+
+    status: queued -> running -> done | failed
+    result заполняется по мере готовности шагов, поэтому клиент видит
+    историю раньше, чем будет готова музыка
+    """
+
+    kind: str
+    params: dict
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = "queued"
+    result: dict = field(default_factory=dict)
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class JobStore(ABC):
+    """Хранилище состояния задач"""
+
+    @abstractmethod
+    async def save(self, job: Job) -> None: ...
+
+    @abstractmethod
+    async def get(self, job_id: str) -> Optional[Job]: ...
+
+    async def fail_unfinished(self) -> None:
+        """Помечает упавшими задачи, которые не успели завершиться до перезапуска сервиса"""
+
+    def close(self) -> None:
+        """Освобождает ресурсы хранилища"""
+
+
+FINISHED = ("done", "failed")
+
+
+class InMemoryJobStore(JobStore):
+    """
+    Задачи в памяти процесса. Завершенные хранятся ttl секунд и не больше
+    max_finished штук, самые старые вытесняются
+    """
+
+    def __init__(self, ttl: float = 3600.0, max_finished: int = 1000):
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self._jobs: dict[str, Job] = {}
+
+    def _evict(self, now: float) -> None:
+        finished = sorted(
+            (job for job in self._jobs.values() if job.status in FINISHED),
+            key=lambda job: job.updated_at,
+        )
+        excess = len(finished) - self.max_finished
+        for i, job in enumerate(finished):
+            if i >= excess and job.updated_at >= now - self.ttl:
+                break
+            del self._jobs[job.id]
+
+    async def save(self, job: Job) -> None:
+        job.updated_at = time.time()
+        self._jobs[job.id] = job
+        if job.status in FINISHED:
+            self._evict(job.updated_at)
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+
+class SQLiteJobStore(JobStore):
+    """Задачи в SQLite, переживают перезапуск сервиса"""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+
+    def _save(self, job: Job) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job.id,
+                    job.kind,
+                    json.dumps(job.params, ensure_ascii=False),
+                    job.status,
+                    json.dumps(job.result, ensure_ascii=False),
+                    job.error,
+                    job.created_at,
+                    job.updated_at,
+                ),
+            )
+
+    def _get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, kind, params, status, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return Job(
+            id=row[0],
+            kind=row[1],
+            params=json.loads(row[2]),
+            status=row[3],
+            result=json.loads(row[4]),
+            error=row[5],
+            created_at=row[6],
+            updated_at=row[7],
+        )
+
+    async def save(self, job: Job) -> None:
+        job.updated_at = time.time()
+        await asyncio.to_thread(self._save, job)
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await asyncio.to_thread(self._get, job_id)
+
+    def _fail_unfinished(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE status IN ('queued', 'running')",
+                ("Задача прервана перезапуском сервиса", time.time()),
+            )
+
+    async def fail_unfinished(self) -> None:
+        await asyncio.to_thread(self._fail_unfinished)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+# обработчик задачи получает параметры и функцию для записи промежуточных результатов
+JobHandler = Callable[[dict, Callable[[str, Any], Awaitable[None]]], Awaitable[None]]
+
+
+class JobQueue:
+    """
+    Очередь фоновых задач с ограниченным числом воркеров.
+
+    submit сразу возвращает задачу, а ее выполнение идет в одном из воркеров.
+    Если очередь заполнена, submit бросает QueueFullError
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        handlers: dict[str, JobHandler],
+        workers: int = 4,
+        max_queue: int = 100,
+    ):
+        self.store = store
+        self._handlers = handlers
+        self._workers_count = workers
+        self._queue: asyncio.Queue[Job] = asyncio.Queue(maxsize=max_queue)
+        self._workers: list[asyncio.Task] = []
+
+    async def start(self) -> None:
+        await self.store.fail_unfinished()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"job-worker-{i}")
+            for i in range(self._workers_count)
+        ]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, kind: str, params: dict) -> Job:
+        if kind not in self._handlers:
+            raise ValueError(f"Неизвестный тип задачи: {kind}")
+        if self._queue.full():
+            raise QueueFullError("Очередь задач переполнена, попробуйте позже")
+        job = Job(kind=kind, params=params)
+        await self.store.save(job)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            # пока задача сохранялась, очередь успели заполнить другие запросы
+            job.status = "failed"
+            job.error = "Очередь задач переполнена"
+            await self.store.save(job)
+            raise QueueFullError("Очередь задач переполнена, попробуйте позже")
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await self.store.get(job_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job) -> None:
+        job.status = "running"
+        await self.store.save(job)
+
+        async def report(key: str, value: Any) -> None:
+            job.result[key] = value
+            await self.store.save(job)
+
+        try:
+            await self._handlers[job.kind](job.params, report)
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "failed"
+            job.error = "Задача отменена"
+            await self.store.save(job)
+            raise
+        except Exception as e:
+            logger.exception(f"Ошибка при выполнении задачи {job.id}")
+            job.status = "failed"
+            job.error = getattr(e, "detail", None) or str(e) or type(e).__name__
+        await self.store.save(job)
@@ -0,0 +1,269 @@
+import argparse
+import heapq
+import logging
+import math
+import os
+import re
+import struct
+import time
+from array import array
+from collections import Counter
+from dataclasses import asdict, dataclass
+from typing import Iterable, Optional
+
+from src.emotion_cache import SEED_COLUMN, SEED_FILES, EmotionCache, text_hash
+
+logger = logging.getLogger(__name__)
+
+# формат файла: заголовок, id и хэши текстов писем, длины писем в словах, эмоции писем,
+# словарь (термы эмоций начинаются с "#"), границы списков вхождений по термам,
+# вхождения (номер письма, сколько раз терм встретился)
+_MAGIC = b"LETIDX01"
+_HEADER = struct.Struct("<8sIIII")  # magic, количество писем, термов, вхождений, длина id в байтах
+_BLOB = struct.Struct("<I")
+_EMOTION = "#"
+
+# BM25 по тексту письма, совпадение эмоции весит как несколько совпавших слов
+_K1 = 1.2
+_B = 0.75
+EMOTION_WEIGHT = 2.0
+
+# грубый стемминг: срезаем одно частое окончание, чтобы "тревога" и "тревогу" совпадали
+_ENDINGS = tuple(sorted(
+    (
+        "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ость", "ости",
+        "ая", "яя", "ое", "ее", "ые", "ие", "ой", "ей", "ий", "ый", "ом", "ем", "ам", "ям",
+        "ах", "ях", "ов", "ев", "ую", "юю", "ть", "ся",
+        "а", "я", "о", "е", "ы", "и", "у", "ю", "ь",
+    ),
+    key=len,
+    reverse=True,
+))
+
+
+def _stem(word: str) -> str:
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 4:
+            return word[:-len(ending)]
+    return word
+
+
+def terms(text: str) -> list[str]:
+    """Термы текста: слова от трех букв в нижнем регистре без окончаний"""
+    words = re.findall(r"[а-яa-z]+", text.lower().replace("ё", "е"))
+    return [_stem(word) for word in words if len(word) >= 3]
+
+
+def emotion_terms(emotions: str) -> list[str]:
+    """Термы эмоций: "тревога/беспокойство, тоска" -> #тревог, #беспокойств, #тоск"""
+    return list(dict.fromkeys(_EMOTION + term for term in terms(emotions)))
+
+
+def _load_emotions(files: Iterable[str], column: str) -> dict[str, str]:
+    """Эмоции по хэшу текста письма из выгрузок ноутбука control_emotions"""
+    import pandas as pd
+
+    emotions = {}
+    for path in files:
+        if not os.path.exists(path):
+            logger.warning(f"{path} не найден, эмоции из него не попадут в индекс")
+            continue
+        data = pd.read_excel(path)
+        for text, value in zip(data["text"], data[column]):
+            if isinstance(text, str) and isinstance(value, str) and value.strip() and value != "модель не ответила":
+                emotions[text_hash(text)] = value.strip()
+    return emotions
+
+
+def build_index(
+    pkl_path: str,
+    out_path: str,
+    files: Iterable[str] = SEED_FILES,
+    column: str = SEED_COLUMN,
+    emotion_cache: Optional[EmotionCache] = None,
+) -> int:
+    """
+    Строит индекс по data/letters.pkl для LetterIndex.
+    Эмоции берутся из кэша эмоций (если передан), иначе из выгрузок files
+    """
+    import pandas as pd
+
+    letters = pd.read_pickle(pkl_path)[["id", "text"]].dropna()
+    seeded = _load_emotions(files, column)
+
+    ids, hashes, lengths, emotions = [], [], [], []
+    postings: dict[str, list[tuple[int, int]]] = {}
+    for doc, (letter_id, text) in enumerate(zip(letters["id"], letters["text"])):
+        text = str(text)
+        digest = text_hash(text)
+        letter_emotions = (emotion_cache.get_sync(text) if emotion_cache is not None else None) or seeded.get(digest, "")
+        ids.append(str(letter_id).encode("ascii"))
+        hashes.append(bytes.fromhex(digest))
+        emotions.append(letter_emotions.replace("\n", " "))
+        text_terms = terms(text)
+        lengths.append(len(text_terms))
+        for term, count in Counter(text_terms + emotion_terms(letter_emotions)).items():
+            postings.setdefault(term, []).append((doc, min(count, 0xFFFF)))
+
+    vocab = sorted(postings)
+    offsets, docs, counts = array("I", [0]), array("I"), array("H")
+    for term in vocab:
+        for doc, count in postings[term]:
+            docs.append(doc)
+            counts.append(count)
+        offsets.append(len(docs))
+
+    id_size = max(len(letter_id) for letter_id in ids)
+    with open(out_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(ids), len(vocab), len(docs), id_size))
+        f.write(b"".join(letter_id.ljust(id_size, b"\0") for letter_id in ids))
+        f.write(b"".join(hashes))
+        f.write(array("I", lengths).tobytes())
+        for blob in ("\n".join(emotions).encode("utf-8"), "\n".join(vocab).encode("utf-8")):
+            f.write(_BLOB.pack(len(blob)))
+            f.write(blob)
+        f.write(offsets.tobytes())
+        f.write(docs.tobytes())
+        f.write(counts.tobytes())
+    return len(ids)
+
+
+@dataclass
+class SearchHit:
+    letter_id: str
+    score: float
+    emotions: str
+
+
+class LetterIndex:
+    """
+    Инвертированный индекс по текстам писем и их эмоциям, загружается целиком при старте.
+
+    Поиск ранжирует письма по BM25 совпавших слов запроса и по совпавшим эмоциям,
+    заранее посчитанные эмоции письма отдаются без вызова модели
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, count, term_count, posting_count, id_size = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} не является индексом писем")
+        position = _HEADER.size
+
+        def take(size: int) -> bytes:
+            nonlocal position
+            chunk = data[position:position + size]
+            position += size
+            return chunk
+
+        def take_array(typecode: str, length: int) -> array:
+            values = array(typecode)
+            values.frombytes(take(length * values.itemsize))
+            return values
+
+        def take_lines(length: int) -> list[str]:
+            (size,) = _BLOB.unpack(take(_BLOB.size))
+            lines = take(size).decode("utf-8").split("\n")
+            return lines if length else []
+
+        ids = take(count * id_size)
+        self._ids = [ids[i * id_size:(i + 1) * id_size].rstrip(b"\0").decode("ascii") for i in range(count)]
+        hashes = take(count * 32)
+        self._by_hash = {hashes[i * 32:(i + 1) * 32]: i for i in range(count)}
+        self._by_id = {letter_id: i for i, letter_id in enumerate(self._ids)}
+        self._lengths = take_array("I", count)
+        self._emotions = take_lines(count)
+        vocab = take_lines(term_count)
+        self._terms = {term: i for i, term in enumerate(vocab)}
+        self._offsets = take_array("I", term_count + 1)
+        self._docs = take_array("I", posting_count)
+        self._counts = take_array("H", posting_count)
+        self._avg_length = sum(self._lengths) / count if count else 0.0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def emotions(self, letter_id: str) -> Optional[str]:
+        doc = self._by_id.get(letter_id)
+        return (self._emotions[doc] or None) if doc is not None else None
+
+    def emotions_for_text(self, text: str) -> Optional[str]:
+        """Заранее посчитанные эмоции письма по его тексту, None - письма нет в индексе или эмоций у него нет"""
+        doc = self._by_hash.get(bytes.fromhex(text_hash(text)))
+        return (self._emotions[doc] or None) if doc is not None else None
+
+    def _postings(self, term: str) -> tuple[array, array]:
+        i = self._terms.get(term)
+        if i is None:
+            return array("I"), array("H")
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return self._docs[start:end], self._counts[start:end]
+
+    def _idf(self, df: int) -> float:
+        return math.log(1 + (len(self._ids) - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str = "", emotions: str = "", limit: int = 10) -> list[SearchHit]:
+        """
+        Письма под запрос. Слова query ищутся в тексте и в эмоциях письма,
+        эмоции из emotions (через запятую) - только в эмоциях
+        """
+        scores: dict[int, float] = {}
+        query_terms = list(dict.fromkeys(terms(query)))
+        for term in query_terms:
+            docs, counts = self._postings(term)
+            idf = self._idf(len(docs))
+            for doc, count in zip(docs, counts):
+                norm = _K1 * (1 - _B + _B * self._lengths[doc] / (self._avg_length or 1))
+                scores[doc] = scores.get(doc, 0.0) + idf * count * (_K1 + 1) / (count + norm)
+        wanted = emotion_terms(emotions) + [_EMOTION + term for term in query_terms]
+        for term in dict.fromkeys(wanted):
+            docs, _ = self._postings(term)
+            idf = self._idf(len(docs))
+            for doc in docs:
+                scores[doc] = scores.get(doc, 0.0) + EMOTION_WEIGHT * idf
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [SearchHit(self._ids[doc], round(score, 4), self._emotions[doc]) for doc, score in best]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "letters": len(self._ids),
+            "with_emotions": sum(bool(emotions) for emotions in self._emotions),
+            "terms": len(self._terms),
+            "postings": len(self._docs),
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Индекс писем по тексту и эмоциям")
+    parser.add_argument("command", choices=["build", "search"])
+    parser.add_argument("--input", default="data/letters.pkl")
+    parser.add_argument("--index", default="data/letters.idx")
+    parser.add_argument("--emotions-db", default="data/emotions.db", help="кэш эмоций, пустое значение - только выгрузки")
+    parser.add_argument("--files", nargs="+", default=list(SEED_FILES))
+    parser.add_argument("--column", default=SEED_COLUMN)
+    parser.add_argument("--query", default="")
+    parser.add_argument("--emotions", default="")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        cache = EmotionCache(args.emotions_db) if args.emotions_db and os.path.exists(args.emotions_db) else None
+        count = build_index(args.input, args.index, args.files, args.column, cache)
+        if cache is not None:
+            cache.close()
+        index = LetterIndex(args.index)
+        print(f"Проиндексировано писем: {count}, размер файла: {os.path.getsize(args.index)} байт, {index.stats()}")
+        return
+
+    index = LetterIndex(args.index)
+    started = time.perf_counter()
+    hits = index.search(args.query, args.emotions, args.limit)
+    took = (time.perf_counter() - started) * 1000
+    for hit in hits:
+        print(asdict(hit))
+    print(f"Найдено за {took:.2f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import asyncio
+import logging
+import mmap
+import os
+import struct
+from typing import Iterable, Optional
+
+import httpx
+
+from src.cache import TTLCache
+from src.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+LETTERS_API_URL = "https://yamata-no-orochi.nktkln.com/letters/letters/"
+
+# формат файла: заголовок, таблица (id, смещение, длина) и подряд тексты писем в utf-8
+_MAGIC = b"LETTERS1"
+_HEADER = struct.Struct("<8sII")  # magic, количество писем, длина id в байтах
+_ENTRY = "<{id_size}sQI"
+
+
+class LetterNotFoundError(Exception):
+    """Письмо с таким id не найдено"""
+
+
+def export_letters(pkl_path: str, out_path: str) -> int:
+    """Выгружает data/letters.pkl в компактный файл для LocalLetterStore"""
+    import pandas as pd
+
+    letters = pd.read_pickle(pkl_path)[["id", "text"]].dropna()
+    ids = [str(letter_id).encode("ascii") for letter_id in letters["id"]]
+    texts = [str(text).encode("utf-8") for text in letters["text"]]
+    id_size = max(len(letter_id) for letter_id in ids)
+    entry = struct.Struct(_ENTRY.format(id_size=id_size))
+
+    offset = 0
+    table = bytearray()
+    for letter_id, text in zip(ids, texts):
+        table += entry.pack(letter_id, offset, len(text))
+        offset += len(text)
+
+    with open(out_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(ids), id_size))
+        f.write(table)
+        for text in texts:
+            f.write(text)
+    return len(ids)
+
+
+class LocalLetterStore:
+    """
+    Локальная копия корпуса писем.
+
+    Файл отображается в память через mmap, в памяти процесса держится только
+    таблица смещений, а текст письма декодируется при обращении
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, id_size = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} не является файлом писем")
+        entry = struct.Struct(_ENTRY.format(id_size=id_size))
+        data_start = _HEADER.size + count * entry.size
+        self._index: dict[str, tuple[int, int]] = {}
+        for i in range(count):
+            letter_id, offset, length = entry.unpack_from(self._mmap, _HEADER.size + i * entry.size)
+            self._index[letter_id.rstrip(b"\0").decode("ascii")] = (data_start + offset, length)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, letter_id: str) -> bool:
+        return letter_id in self._index
+
+    def ids(self) -> list[str]:
+        return list(self._index)
+
+    def get(self, letter_id: str) -> Optional[str]:
+        position = self._index.get(letter_id)
+        if position is None:
+            return None
+        start, length = position
+        return self._mmap[start:start + length].decode("utf-8")
+
+    def close(self) -> None:
+        self._mmap.close()
+        self._file.close()
+
+
+class LetterService:
+    """
+    Доступ к письмам: LRU+TTL кэш -> локальный файл (если есть) -> удаленный сервис писем.
+
+    Одновременные промахи по одному id идут в сервис писем одним запросом
+    """
+
+    def __init__(
+        self,
+        base_url: str = LETTERS_API_URL,
+        local_store: Optional[LocalLetterStore] = None,
+        cache_size: int = 1024,
+        cache_ttl: float = 3600.0,
+        max_concurrency: int = 8,
+        timeout: float = 10.0,
+    ):
+        self._base_url = base_url
+        self._local_store = local_store
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = httpx.AsyncClient(timeout=timeout)
+        self._single_flight = SingleFlight()
+
+    async def _fetch(self, letter_id: str) -> str:
+        async with self._semaphore:
+            response = await self._client.get(self._base_url, params={"letter_id": letter_id})
+        response.raise_for_status()
+        letters_list = response.json()
+        if not letters_list:
+            raise LetterNotFoundError(f"Письмо {letter_id} не найдено")
+        return letters_list[0]["text"]
+
+    async def get(self, letter_id: str) -> str:
+        letter_text = self._cache.get(letter_id)
+        if letter_text is not None:
+            return letter_text
+        if self._local_store is not None:
+            letter_text = self._local_store.get(letter_id)
+        if letter_text is None:
+            letter_text = await self._single_flight.do("letters", letter_id, lambda: self._fetch(letter_id))
+        self._cache.set(letter_id, letter_text)
+        return letter_text
+
+    async def get_many(self, letter_ids: Iterable[str]) -> dict[str, str]:
+        """Возвращает найденные письма по списку id. Промахи запрашиваются параллельно"""
+        letter_ids = list(dict.fromkeys(letter_ids))
+        results = await asyncio.gather(*(self.get(letter_id) for letter_id in letter_ids), return_exceptions=True)
+        letters = {}
+        for letter_id, result in zip(letter_ids, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Не удалось получить письмо {letter_id}: {result}")
+            else:
+                letters[letter_id] = result
+        return letters
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+        if self._local_store is not None:
+            self._local_store.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Выгрузка корпуса писем для LocalLetterStore")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("--input", default="data/letters.pkl")
+    parser.add_argument("--output", default="data/letters.bin")
+    args = parser.parse_args()
+
+    count = export_letters(args.input, args.output)
+    print(f"Выгружено писем: {count}, размер файла: {os.path.getsize(args.output)} байт")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import logging
+import re
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from src.cache import TTLCache
+from src.metrics import LLM_CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class StageCachePolicy:
+    """Настройки кэша для шага: enabled=False - шаг всегда идет в модель"""
+
+    ttl: Optional[float] = 3600.0
+    enabled: bool = True
+
+
+# классификаторы и короткие ответы детерминированы, а история и песня должны отличаться
+DEFAULT_POLICIES = {
+    "precheck": StageCachePolicy(ttl=24 * 3600),
+    "check_query": StageCachePolicy(ttl=24 * 3600),
+    "decision_emotions": StageCachePolicy(ttl=24 * 3600),
+    "query_emotions": StageCachePolicy(ttl=24 * 3600),
+    "summary": StageCachePolicy(ttl=3600),
+    "header": StageCachePolicy(ttl=3600),
+    "extract_facts": StageCachePolicy(ttl=24 * 3600),
+    "check_facts": StageCachePolicy(ttl=24 * 3600),
+    "digest": StageCachePolicy(ttl=24 * 3600),
+    "analyze_emotions": StageCachePolicy(enabled=False),
+    "story": StageCachePolicy(enabled=False),
+    "song": StageCachePolicy(enabled=False),
+}
+
+
+def prompt_version(template: str) -> str:
+    """Версия промта - хэш шаблона, при правке промта старые ответы перестают подходить"""
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:12]
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, str):
+        return re.sub(r"\s+", " ", value).strip().lower()
+    return value
+
+
+class LLMCache:
+    """
+    Кэш ответов модели для детерминированных шагов.
+
+    Ключ - шаг, модель, версия промта и нормализованные входы.
+    Общий размер ограничен, вытесняются давно не использованные ответы
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 4096,
+        policies: Optional[dict[str, StageCachePolicy]] = None,
+        default_policy: StageCachePolicy = StageCachePolicy(enabled=False),
+    ):
+        self._cache = TTLCache(maxsize=maxsize)
+        self._policies = {**DEFAULT_POLICIES, **(policies or {})}
+        self._default_policy = default_policy
+
+    def policy(self, stage: str) -> StageCachePolicy:
+        return self._policies.get(stage, self._default_policy)
+
+    def key(self, stage: str, model: str, version: str, inputs: dict) -> str:
+        normalized = {name: _normalize(value) for name, value in sorted(inputs.items())}
+        payload = json.dumps([stage, model, version, normalized], ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, stage: str, key: str) -> Any:
+        value = self._cache.get(key)
+        LLM_CACHE_REQUESTS.labels(stage, "hit" if value is not None else "miss").inc()
+        return value
+
+    def set(self, stage: str, key: str, value: Any) -> None:
+        self._cache.set(key, value, ttl=self.policy(stage).ttl)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+
+class CachedChain:
+    """Обертка над цепочкой prompt | model, которая сначала смотрит в LLMCache"""
+
+    def __init__(self, chain, cache: LLMCache, stage: str, model: str, template: str):
+        self.chain = chain
+        self.stage = stage
+        self._cache = cache
+        self._model = model
+        self._version = prompt_version(template)
+
+    async def ainvoke(self, inputs: dict, **kwargs) -> Any:
+        key = self._cache.key(self.stage, self._model, self._version, inputs)
+        cached = self._cache.get(self.stage, key)
+        if cached is not None:
+            logger.debug(f"Ответ шага {self.stage} взят из кэша")
+            return cached
+        response = await self.chain.ainvoke(inputs, **kwargs)
+        self._cache.set(self.stage, key, response)
+        return response
+
+    def astream(self, inputs: dict, **kwargs):
+        """Потоковые ответы не кэшируются"""
+        return self.chain.astream(inputs, **kwargs)
+
+    def invoke(self, inputs: dict, **kwargs) -> Any:
+        key = self._cache.key(self.stage, self._model, self._version, inputs)
+        cached = self._cache.get(self.stage, key)
+        if cached is not None:
+            return cached
+        response = self.chain.invoke(inputs, **kwargs)
+        self._cache.set(self.stage, key, response)
+        return response
+
+
+def cached_chain(chain, cache: Optional[LLMCache], stage: str, model: str, template: str):
+    """Оборачивает цепочку в кэш, если он передан и включен для шага"""
+    if cache is None or not cache.policy(stage).enabled:
+        return chain
+    return CachedChain(chain, cache, stage, model, template)
@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Регистр, пунктуация и пробелы в промте на результат не влияют"""
+    prompt = re.sub(r"[^\w\s]", " ", prompt.lower())
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+def media_key(kind: str, prompt: str, params: dict[str, Any]) -> str:
+    """Адрес результата: вид медиа, нормализованный промт и параметры генерации"""
+    payload = json.dumps(
+        {"kind": kind, "prompt": normalize_prompt(prompt), "params": params},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MediaCache:
+    """
+    Постоянный кэш сгенерированных картинок, песен и названий в SQLite.
+
+    По одному ключу хранится до variants вариантов: пока их меньше, запрос
+    генерирует новый, дальше отдается случайный из готовых. Общее число записей
+    ограничено max_entries, вытесняются давно не использованные.
+    ttl - сколько секунд результат считается живым (ссылки провайдеров со временем перестают работать)
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000, variants: int = 1, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.variants = variants
+        self.ttl = ttl
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS media (
+                    key TEXT NOT NULL,
+                    variant INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL,
+                    PRIMARY KEY (key, variant)
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS media_used_at ON media (used_at)")
+
+    def _expire(self, now: float) -> None:
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM media WHERE created_at < ?", (now - self.ttl,))
+
+    def get_sync(self, key: str) -> Optional[Any]:
+        """Готовый результат или None, если вариантов по ключу еще меньше variants"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._expire(now)
+            rows = self._conn.execute("SELECT variant, value FROM media WHERE key = ?", (key,)).fetchall()
+            if len(rows) < self.variants:
+                return None
+            variant, value = random.choice(rows)
+            self._conn.execute("UPDATE media SET used_at = ? WHERE key = ? AND variant = ?", (now, key, variant))
+        return json.loads(value)
+
+    def add_sync(self, key: str, kind: str, value: Any) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            variant = self._conn.execute(
+                "SELECT COALESCE(MAX(variant) + 1, 0) FROM media WHERE key = ?", (key,)
+            ).fetchone()[0]
+            self._conn.execute(
+                "INSERT INTO media VALUES (?, ?, ?, ?, ?, ?)",
+                (key, variant, kind, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            # лишние варианты по ключу и лишние записи в целом - самые давно использованные
+            self._conn.execute(
+                """
+                DELETE FROM media WHERE key = ? AND variant NOT IN (
+                    SELECT variant FROM media WHERE key = ? ORDER BY used_at DESC LIMIT ?
+                )
+                """,
+                (key, key, self.variants),
+            )
+            self._conn.execute(
+                "DELETE FROM media WHERE rowid IN (SELECT rowid FROM media ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    async def get(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self.get_sync, key)
+
+    async def add(self, key: str, kind: str, value: Any) -> None:
+        await asyncio.to_thread(self.add_sync, key, kind, value)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT kind, COUNT(*) FROM media GROUP BY kind").fetchall()
+        return dict(rows)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM media").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,212 @@
+import time
+from typing import Any, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.outputs import LLMResult
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# генерация песни идет минутами, поэтому корзины до 15 минут
+_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 900)
+
+STAGE_DURATION = Histogram(
+    "agent_stage_duration_seconds",
+    "Длительность шагов: pipeline - шаги пайплайна, llm - вызовы модели, poll - ожидание провайдера",
+    ("component", "stage"),
+    buckets=_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "agent_stage_errors_total",
+    "Ошибки шагов по типу исключения",
+    ("component", "stage", "error"),
+)
+STAGE_IN_FLIGHT = Gauge(
+    "agent_stage_in_flight",
+    "Шаги, которые выполняются прямо сейчас",
+    ("component", "stage"),
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Токены в запросах и ответах модели",
+    ("stage", "model", "kind"),
+)
+POLL_ATTEMPTS = Counter(
+    "provider_poll_attempts_total",
+    "Проверки статуса задач Freepik и gen-api",
+    ("task",),
+)
+QUEUE_WAIT = Histogram(
+    "provider_queue_wait_seconds",
+    "Ожидание в очереди лимитов провайдера",
+    ("provider",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+LLM_BACKEND_REQUESTS = Counter(
+    "llm_backend_requests_total",
+    "Запросы к моделям с запасными бэкендами: ok, error или cancelled (проиграл гонку)",
+    ("stage", "backend", "outcome"),
+)
+LLM_HEDGES = Counter(
+    "llm_hedged_requests_total",
+    "Дублирующие запросы к следующему бэкенду, отправленные из-за долгого ответа",
+    ("stage", "backend"),
+)
+MEDIA_CACHE_REQUESTS = Counter(
+    "media_cache_requests_total",
+    "Обращения к кэшу картинок, песен и названий: hit или miss",
+    ("kind", "result"),
+)
+PROVIDER_CALLBACKS = Counter(
+    "provider_callbacks_total",
+    "Вебхуки о завершении задач: resolved - отдан ожидающей задаче, early - ее никто не ждал",
+    ("provider", "result"),
+)
+LLM_CACHE_REQUESTS = Counter(
+    "llm_cache_requests_total",
+    "Обращения к кэшу ответов модели: hit или miss",
+    ("stage", "result"),
+)
+SINGLE_FLIGHT_REQUESTS = Counter(
+    "single_flight_requests_total",
+    "Вызовы шагов через объединение: executed - выполнен сам, coalesced - дождался такого же вызова",
+    ("stage", "result"),
+)
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Запросы к сервису, которые обрабатываются прямо сейчас",
+    ("path",),
+)
+HTTP_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Время ответа сервиса",
+    ("path", "method", "status"),
+    buckets=_BUCKETS,
+)
+
+
+class StageTimer:
+    """Контекстный менеджер: длительность, ошибки и число одновременно идущих шагов"""
+
+    def __init__(self, component: str, stage: str):
+        self.component = component
+        self.stage = stage
+
+    def __enter__(self) -> "StageTimer":
+        self._started = time.perf_counter()
+        STAGE_IN_FLIGHT.labels(self.component, self.stage).inc()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        STAGE_IN_FLIGHT.labels(self.component, self.stage).dec()
+        STAGE_DURATION.labels(self.component, self.stage).observe(time.perf_counter() - self._started)
+        if exc_type is not None:
+            STAGE_ERRORS.labels(self.component, self.stage, exc_type.__name__).inc()
+
+
+def observe_error(component: str, stage: str, exc: BaseException) -> None:
+    STAGE_ERRORS.labels(component, stage, type(exc).__name__).inc()
+
+
+class LLMMetricsCallback(AsyncCallbackHandler):
+    """
+    Время вызовов модели и расход токенов по шагам.
+
+    Шаг берется из тега "stage:<имя>", который ставится на цепочку в _build_chain
+    """
+
+    def __init__(self):
+        self._runs: dict[UUID, tuple[str, str, float]] = {}
+
+    @staticmethod
+    def _stage(tags: Optional[list[str]]) -> str:
+        for tag in tags or ():
+            if tag.startswith("stage:"):
+                return tag[len("stage:"):]
+        return "unknown"
+
+    async def on_chat_model_start(
+        self, serialized, messages, *, run_id: UUID, tags=None, metadata=None, **kwargs: Any
+    ) -> None:
+        stage = self._stage(tags)
+        model = (metadata or {}).get("ls_model_name") or "unknown"
+        self._runs[run_id] = (stage, model, time.perf_counter())
+        STAGE_IN_FLIGHT.labels("llm", stage).inc()
+
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        stage, model, started = run
+        STAGE_IN_FLIGHT.labels("llm", stage).dec()
+        STAGE_DURATION.labels("llm", stage).observe(time.perf_counter() - started)
+        llm_output = response.llm_output or {}
+        prompt_tokens = completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    prompt_tokens += usage.get("input_tokens", 0)
+                    completion_tokens += usage.get("output_tokens", 0)
+        if not prompt_tokens and not completion_tokens:
+            token_usage = llm_output.get("token_usage") or {}
+            prompt_tokens = token_usage.get("prompt_tokens", 0)
+            completion_tokens = token_usage.get("completion_tokens", 0)
+        LLM_TOKENS.labels(stage, model, "prompt").inc(prompt_tokens)
+        LLM_TOKENS.labels(stage, model, "completion").inc(completion_tokens)
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        stage, _, started = run
+        STAGE_IN_FLIGHT.labels("llm", stage).dec()
+        STAGE_DURATION.labels("llm", stage).observe(time.perf_counter() - started)
+        observe_error("llm", stage, error)
+
+
+def route_path(app, scope: dict) -> str:
+    """Шаблон пути (/jobs/{job_id}), чтобы id не раздували число рядов метрик"""
+    from starlette.routing import Match
+
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", scope["path"])
+    return "other"
+
+
+class HTTPMetricsMiddleware:
+    """
+    ASGI-мидлварь с числом идущих запросов и временем ответа по шаблонам путей.
+
+    Время считается до конца тела ответа, поэтому потоковые ответы (SSE)
+    учитываются целиком, а не до отправки заголовков
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        path = route_path(scope["app"], scope)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.labels(path).inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.labels(path).dec()
+            HTTP_DURATION.labels(path, scope["method"], str(status)).observe(time.perf_counter() - started)
+
+
+def render() -> tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
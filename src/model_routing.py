@@ -0,0 +1,193 @@
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, fields, replace
+from typing import Optional, Union
+
+from langchain_openai import ChatOpenAI
+
+from src.hedging import Backend, BackendHealth, HedgedChat, HedgePolicy
+from src.metrics import LLMMetricsCallback
+from src.ratelimit import RateLimiter, provider_of
+
+logger = logging.getLogger(__name__)
+
+# небольшая модель для классификаторов и коротких ответов: отвечает в разы быстрее 235b
+SMALL_MODEL = "qwen/qwen3-8b:free"
+
+
+@dataclass(frozen=True)
+class StageModel:
+    """
+    Модель шага. None в любом поле - значение берется из модели по умолчанию
+    """
+
+    model: Optional[str] = None
+    base_url: Optional[str] = None
+    api_key: Optional[str] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    max_tokens: Optional[int] = None
+
+    def over(self, default: "StageModel") -> "StageModel":
+        """Настройки шага поверх настроек по умолчанию"""
+        overrides = {f.name: getattr(self, f.name) for f in fields(self) if getattr(self, f.name) is not None}
+        return replace(default, **overrides)
+
+
+# рекомендуемые маршруты, включаются явно: да/нет и короткие классификации - маленькая
+# модель без случайности, история, песня, эмоции письма и проверка фактов - основная модель
+DEFAULT_ROUTES = {
+    "precheck": StageModel(model=SMALL_MODEL, temperature=0.0),
+    "check_query": StageModel(model=SMALL_MODEL, temperature=0.0),
+    "decision_emotions": StageModel(model=SMALL_MODEL, temperature=0.0),
+    "query_emotions": StageModel(model=SMALL_MODEL, temperature=0.0),
+    "summary": StageModel(model=SMALL_MODEL),
+    "header": StageModel(model=SMALL_MODEL),
+    "extract_facts": StageModel(model=SMALL_MODEL, temperature=0.0),
+    "check_facts": StageModel(temperature=0.0),
+}
+
+
+def parse_routes(spec: str) -> dict[str, StageModel]:
+    """
+    Модели шагов из строки "stage=model,stage2=model2" или из json вида
+    {"stage": {"model": ..., "base_url": ..., "api_key_env": ..., "temperature": ..., "top_p": ..., "max_tokens": ...}}.
+    api_key_env - имя переменной окружения с ключом, сами ключи в настройках не пишутся
+    """
+    spec = spec.strip()
+    if not spec:
+        return {}
+    if not spec.startswith("{"):
+        routes = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            stage, _, model = item.partition("=")
+            routes[stage.strip()] = StageModel(model=model.strip())
+        return routes
+    return {stage: _stage_model(value) for stage, value in json.loads(spec).items()}
+
+
+def _stage_model(value: Union[str, dict]) -> StageModel:
+    if isinstance(value, str):
+        return StageModel(model=value)
+    value = dict(value)
+    api_key_env = value.pop("api_key_env", None)
+    if api_key_env is not None:
+        value["api_key"] = os.getenv(api_key_env)
+    return StageModel(**value)
+
+
+def parse_backends(spec: str) -> list[StageModel]:
+    """
+    Запасные бэкенды по порядку: "model1,model2" или json-список из имен моделей
+    и объектов с теми же полями, что в parse_routes
+    """
+    spec = spec.strip()
+    if not spec:
+        return []
+    if not spec.startswith("["):
+        return [StageModel(model=model.strip()) for model in spec.split(",") if model.strip()]
+    return [_stage_model(value) for value in json.loads(spec)]
+
+
+def load_routes(spec: str, defaults: bool = False) -> dict[str, StageModel]:
+    """Модели шагов из spec; с defaults - поверх встроенных маршрутов DEFAULT_ROUTES"""
+    routes = dict(DEFAULT_ROUTES) if defaults else {}
+    for stage, route in parse_routes(spec).items():
+        routes[stage] = route.over(routes[stage]) if stage in routes else route
+    return routes
+
+
+class ModelRegistry:
+    """
+    Клиенты моделей по шагам.
+
+    Шаги без своей записи в routes идут в модель по умолчанию. Шаги с одинаковыми
+    итоговыми настройками используют один клиент.
+
+    fallbacks - запасные бэкенды для всех шагов, поля накладываются на модель шага.
+    С ними шаг получает HedgedChat: долгий запрос дублируется в следующий бэкенд,
+    ошибки и задержки бэкендов отслеживаются
+    """
+
+    def __init__(
+        self,
+        default: StageModel,
+        routes: Optional[dict[str, StageModel]] = None,
+        fallbacks: Optional[list[StageModel]] = None,
+        hedge_policy: HedgePolicy = HedgePolicy(),
+    ):
+        self.default = default
+        self.routes = dict(routes or {})
+        self.fallbacks = list(fallbacks or [])
+        self.hedge_policy = hedge_policy
+        self._clients: dict[StageModel, ChatOpenAI] = {}
+        self._health: dict[str, BackendHealth] = {}
+        self._hedged: dict[str, HedgedChat] = {}
+
+    def config(self, stage: Optional[str] = None) -> StageModel:
+        route = self.routes.get(stage)
+        return route.over(self.default) if route is not None else self.default
+
+    def chat(self, stage: Optional[str] = None) -> ChatOpenAI:
+        return self._client(self.config(stage))
+
+    def _client(self, config: StageModel) -> ChatOpenAI:
+        client = self._clients.get(config)
+        if client is None:
+            client = ChatOpenAI(
+                model=config.model,
+                base_url=config.base_url,
+                api_key=config.api_key,
+                temperature=config.temperature,
+                top_p=config.top_p,
+                max_tokens=config.max_tokens,
+                max_retries=0,
+                callbacks=[LLMMetricsCallback()],
+            )
+            self._clients[config] = client
+        return client
+
+    def backends(self, stage: Optional[str] = None) -> list[StageModel]:
+        """Модель шага и запасные бэкенды для него, без повторов"""
+        config = self.config(stage)
+        return list(dict.fromkeys([config] + [fallback.over(config) for fallback in self.fallbacks]))
+
+    def runnable(self, stage: str, rate_limiter: RateLimiter) -> Union[ChatOpenAI, HedgedChat]:
+        """
+        Модель для цепочки шага. Без запасных бэкендов - обычный клиент, лимиты
+        на него накладывает вызывающий; с ними - HedgedChat, который сам идет через лимиты каждого бэкенда
+        """
+        configs = self.backends(stage)
+        if len(configs) == 1:
+            return self.chat(stage)
+        backends = []
+        for config in configs:
+            name = f"{config.model}@{provider_of(config.base_url or '')}"
+            health = self._health.setdefault(name, BackendHealth(name, self.hedge_policy))
+            backends.append(Backend(
+                name=name,
+                chat=self._client(config),
+                limiter=rate_limiter.get(config.base_url, config.api_key),
+                health=health,
+            ))
+        self._hedged[stage] = HedgedChat(backends, stage=stage, policy=self.hedge_policy)
+        return self._hedged[stage]
+
+    def stats(self) -> dict[str, dict]:
+        """Задержки и ошибки бэкендов по шагам"""
+        return {stage: hedged.stats() for stage, hedged in self._hedged.items()}
+
+    def describe(self) -> dict[str, dict]:
+        """Итоговые настройки шагов без ключей - для логов и отладки"""
+        stages = {None: self.default, **{stage: self.config(stage) for stage in self.routes}}
+        described = {
+            stage or "default": {k: v for k, v in asdict(config).items() if k != "api_key"}
+            for stage, config in stages.items()
+        }
+        if self.fallbacks:
+            described["fallbacks"] = [
+                {k: v for k, v in asdict(fallback).items() if k != "api_key" and v is not None}
+                for fallback in self.fallbacks
+            ]
+        return described
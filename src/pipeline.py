@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+from src.metrics import StageTimer
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    Шаг пайплайна.
+
+    name - под этим именем результат шага попадает в общий словарь результатов
+    func - корутина, получает значения inputs как именованные аргументы
+    inputs - имена шагов или входных параметров, от которых зависит шаг
+    """
+
+    name: str
+    func: Callable[..., Awaitable[Any]]
+    inputs: tuple[str, ...] = ()
+
+
+class Pipeline:
+    """
+    Исполнитель графа зависимостей.
+
+    Все шаги, у которых готовы входы, запускаются одновременно, поэтому время
+    работы равно критическому пути графа, а не сумме всех вызовов.
+    Если любой шаг падает, остальные запущенные шаги отменяются, а ошибка
+    пробрасывается наружу.
+    """
+
+    def __init__(self, stages: list[Stage]):
+        names = [stage.name for stage in stages]
+        if len(names) != len(set(names)):
+            raise ValueError(f"Имена шагов должны быть уникальными: {names}")
+        self.stages = list(stages)
+
+    def __add__(self, other: "Pipeline") -> "Pipeline":
+        return Pipeline(self.stages + other.stages)
+
+    @staticmethod
+    async def _run_stage(stage: Stage, kwargs: dict) -> Any:
+        with StageTimer("pipeline", stage.name):
+            return await stage.func(**kwargs)
+
+    async def run(
+        self,
+        inputs: dict,
+        on_result: Optional[Callable[[str, Any], Awaitable[None]]] = None,
+    ) -> dict:
+        """
+        Возвращает словарь входов и результатов всех шагов.
+        on_result вызывается сразу после завершения каждого шага - так
+        промежуточные результаты можно отдавать, не дожидаясь всего пайплайна
+        """
+        results = dict(inputs)
+        pending = {stage.name: stage for stage in self.stages if stage.name not in results}
+        running: dict[asyncio.Task, str] = {}
+        try:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if all(key in results for key in stage.inputs):
+                        kwargs = {key: results[key] for key in stage.inputs}
+                        task = asyncio.create_task(self._run_stage(stage, kwargs), name=name)
+                        running[task] = name
+                        del pending[name]
+                if not running:
+                    raise ValueError(f"Не удается разрешить зависимости шагов: {sorted(pending)}")
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    results[name] = task.result()
+                    logger.debug(f"Шаг {name} завершен")
+                    if on_result is not None:
+                        await on_result(name, results[name])
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+        return results
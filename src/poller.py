@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+from src.metrics import POLL_ATTEMPTS, StageTimer
+
+logger = logging.getLogger(__name__)
+
+# функция проверки статуса: возвращает результат, если задача готова,
+# None - если еще в работе, и бросает исключение, если провайдер сообщил об ошибке
+CheckFn = Callable[[], Awaitable[Optional[Any]]]
+
+
+class PollTimeoutError(Exception):
+    """Задача провайдера не завершилась до дедлайна"""
+
+
+@dataclass
+class _PollTask:
+    name: str
+    check: CheckFn
+    future: asyncio.Future
+    deadline: float
+    interval: float
+    max_interval: float
+    next_at: float
+    attempts: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    checking: Optional[asyncio.Task] = None
+
+
+class TaskPoller:
+    """
+    Общий планировщик опроса задач Freepik и gen-api.
+
+    Все ожидающие задачи опрашиваются из одного цикла: на каждом тике
+    запускаются проверки задач, у которых подошло время. Каждая проверка идет
+    отдельно и ограничена check_timeout, поэтому медленная проверка (например,
+    ожидание в лимитах провайдера) не задерживает опрос остальных задач.
+    Интервал для каждой задачи растет экспоненциально (с джиттером), поэтому
+    быстрые задачи замечаются быстро, а долгие не забивают провайдера запросами.
+    """
+
+    def __init__(
+        self,
+        initial_interval: float = 1.0,
+        max_interval: float = 30.0,
+        backoff: float = 1.5,
+        jitter: float = 0.2,
+        timeout: float = 600.0,
+        check_timeout: float = 90.0,
+    ):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.timeout = timeout
+        self.check_timeout = check_timeout
+        self._tasks: list[_PollTask] = []
+        self._runner: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def wait(
+        self,
+        check: CheckFn,
+        name: str = "task",
+        timeout: Optional[float] = None,
+        initial_interval: Optional[float] = None,
+        max_interval: Optional[float] = None,
+    ) -> Any:
+        """Ждет, пока check вернет результат, или бросает PollTimeoutError"""
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        interval = initial_interval or self.initial_interval
+        task = _PollTask(
+            name=name,
+            check=check,
+            future=loop.create_future(),
+            deadline=now + (timeout or self.timeout),
+            interval=interval,
+            max_interval=max_interval or self.max_interval,
+            next_at=now + self._jittered(interval),
+        )
+        self._tasks.append(task)
+        self._ensure_runner(loop)
+        self._wakeup.set()
+        try:
+            with StageTimer("poll", name):
+                return await task.future
+        finally:
+            if task in self._tasks:
+                self._tasks.remove(task)
+            if task.checking is not None:
+                task.checking.cancel()
+
+    def _jittered(self, interval: float) -> float:
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _ensure_runner(self, loop: asyncio.AbstractEventLoop) -> None:
+        # планировщик привязан к event loop, при смене loop (синхронные обертки) создаем заново
+        if self._runner is None or self._runner.done() or self._runner.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._runner = loop.create_task(self._run(), name="task-poller")
+
+    async def _check(self, task: _PollTask) -> None:
+        try:
+            result = await asyncio.wait_for(task.check(), timeout=self.check_timeout)
+        except asyncio.TimeoutError:
+            # зависшая проверка считается как "еще в работе", дедлайн задачи при этом идет
+            logger.warning(f"{task.name}: проверка статуса не уложилась в {self.check_timeout:g} c")
+            result = None
+        except Exception as e:
+            result = e
+        task.checking = None
+        self._handle(task, result, time.monotonic())
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while self._tasks:
+            now = time.monotonic()
+            for task in self._tasks:
+                if task.checking is None and task.next_at <= now and not task.future.done():
+                    task.checking = asyncio.create_task(self._check(task), name=f"poll-{task.name}")
+            self._tasks = [task for task in self._tasks if not task.future.done()]
+            if not self._tasks:
+                break
+            idle = [task.next_at for task in self._tasks if task.checking is None]
+            delay = max(0.0, min(idle) - time.monotonic()) if idle else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _handle(self, task: _PollTask, result: Any, now: float) -> None:
+        task.attempts += 1
+        POLL_ATTEMPTS.labels(task.name).inc()
+        if task.future.done():
+            return
+        if isinstance(result, BaseException):
+            task.future.set_exception(result)
+        elif result is not None:
+            logger.info(f"{task.name} готова за {now - task.started_at:.1f} c, проверок: {task.attempts}")
+            task.future.set_result(result)
+        elif now >= task.deadline:
+            task.future.set_exception(
+                PollTimeoutError(f"{task.name} не завершилась за {now - task.started_at:.0f} c")
+            )
+        else:
+            task.interval = min(task.interval * self.backoff, task.max_interval)
+            task.next_at = min(now + self._jittered(task.interval), task.deadline)
@@ -0,0 +1,247 @@
+"""Шаблоны промтов для AgentSystem и Checker"""
+
+HEADER_TEMPLATE = """Ты - прфоессиональный композитор, который пишет песни военного времени.
+
+Ты получаешь краткое изложение истории и тебе нужно на основе этого текста сделать заголовок для песни. Заголовок не должен быть больше 3 слов
+
+История: {history}
+
+В ответе укажи только название. Больше ничего указывать не нужно. Также нельзя использовать разметку .md
+"""
+
+QUERY_EMOTIONS_TEMPLATE = """Пользователь пишет запрос, в котором он просит рассказать историю.
+Твоя задача определить, какие у пользователя требования к эмоциональной составляющей истории.
+
+Пример таких запросов:
+- "История должна быть грустной", тут ты выделяешь эмоцию грусть
+- "Сделай историю, которая вызывает ностальгию", тут ты должен взять ностальгию
+- "Напиши историю о надежде и любви", тут любовь и надежда
+- "Сделай историю более драматичной, более грустной, более веселой", тут выделяешь драматичная, грустная, веселая
+- "Романтичная история", тут романитичность
+
+Однако это лишь примеры, поэтому тебе следует быть внимательным и не ограничиваться только ними.
+
+Запрос от пользователя:
+{query}
+
+================================
+Формат ответа, который ты должен использовать. Также тебе нельзя использовать .md разметку, только обычный текст:
+Эмоции и чувства: (список из эмоций и чувств в строчку через запятую без дополнительной информации)
+===============================
+
+Если ты верно выполнишь задание и выделишь верные эмоции и чувства, то я выделю тебе дополнительные мощности для работы с другими задачами.
+"""
+
+SONG_TEMPLATE = """Ты - профессиональный композитор. Тебе нужно писать куплеты для песен на военную тематику под гитару.
+
+Всего тебе нужно сделать 2 куплета. Учти, все главные аспекты истории, выделив их в песне
+
+История: {history}
+
+Пожалуйста, предоставь ответ в следующем формате:
+
+Куплет 1
+текст куплета построчно
+
+Куплет 2
+текст куплета построчно
+"""
+
+SUMMARY_TEMPLATE = """Ты - профессиональный литератор
+Тебе нужно из следующего текста выделить какой-то момент, чтобы потом на основании этого момента можно было сделать картину. Так что сделай акцент на том, что на картине должен быть отображен человек либо люди, которые участвуют в выбранном моменте.
+Однако имена людей не нужно указывать. Можешь просто написать, что это "советский солдат", если он таким является, но не имена.
+На задание у тебя есть 200 символов. Текст должен быть на английском
+
+Текст, с которым надо работать:
+{history}
+
+В качестве ответа напиши только текст на английском. Не нужно никаких дополнительных фраз и слов
+"""
+
+CHECK_QUERY_TEMPLATE = """Ты - профессиональный писатель, который пишет истории на основе писем военных лет с 1941 года по 1945 (Великая Отечественная Война).
+
+Ты получаешь запрос от пользователя, в котором он выражает свои пожелания к историям. Ты должен проверить, соответствует ли запрос пользователя требованиям военной тематике.
+
+Также, если в запросе просят что-то сделать, ты должен проверить, что это не противоречит историческим событиям.
+
+Примеры запросов, которые соответствуют требованиям военной тематики:
+- "История должна быть грустной"
+- "Сделай историю, которая вызывает ностальгию"
+- "Напиши историю о надежде и любви"
+- "Сделай историю более драматичной, более грустной, более веселой"
+
+Примеры запросов, которые не соответствуют требованиям военной тематики:
+- "Напиши историю о космосе"
+- "Хочу, чтобы история была на Бали"
+- "Сделай так, чтобы история перенеслась в Африку"
+
+Запрос пользователя: {query}
+
+Если запрос соответствует требованиям военной тематики, то ответь "Да", иначе ответь "Нет".
+Больше ничего в ответ не включай, только "Да" или "Нет" без кавычек.
+"""
+
+DECISION_EMOTIONS_TEMPLATE = """Пользователь пишет запрос, в котором он просит рассказать историю.
+Твоя задача определить, есть ли в запросе требования к эмоциональной составляющей истории.
+
+Пример таких запросов:
+- "История должна быть грустной"
+- "Сделай историю, которая вызывает ностальгию"
+- "Напиши историю о надежде и любви"
+- "Сделай историю более драматичной, более грустной, более веселой"
+
+Однако это лишь примеры, поэтому тебе следует быть внимательным и не ограничиваться только ними.
+
+Запрос от пользователя:
+{query}
+
+Формат ответа:
+- "Да" - если запрос содержит требования к эмоциональной составляющей
+- "Нет" - если запрос не содержит требований к эмоциональной составляющей
+Больше ничего в ответ не включай, только "Да" или "Нет" без кавычек.
+"""
+
+ANALYZE_EMOTIONS_TEMPLATE = """Ты - профессиональный психолог, специализирующийся на анализе писем. Тебе нужно проанализировать письмо и выделить в нем только ключевые эмоции и чувства, которые испытывает автор.
+Всего ты можешь выделить лишь 5 эмоций и чувств.
+
+Письмо: {text}
+================================
+Формат ответа, который ты должен использовать. Также тебе нельзя использовать .md разметку, только обычный текст:
+Мои мысли: тут ты должен объяснить, что ты думаешь о письме и почему ты выделил именно эти эмоции и чувства.
+Эмоции и чувства: (список из 5 эмоций и чувств в строчку через запятую без дополнительной информации)
+===============================
+
+Если ты верно выполнишь задание и выделишь верные эмоции и чувства, то я выделю тебе дополнительные мощности для работы с другими задачами.
+"""
+
+STORY_TEMPLATE = """Ты - профессиональный писатель, который пишет истории на основе писем военных лет с 1941 года по 1945 (Великая Отечественная Война).
+
+Однако ты получаешь не только письмо с фронта, но и запрос на эмоциональную составляющую истории.
+Данный запрос может содержать абсолютно любое требование к истории, например:
+- "История должна быть грустной"
+- "Пусть история будет веселой, но с элементами драмы"
+и так далее.
+
+Также помимо эмоциональной составляющей, ты получаешь ещё и дополнительные пожелания от пользователя, которые ты должен учесть при написании истории.
+
+Также во время написания истории, ты ОБЯЗАН проверять все факты, которые ты используешь в истории, на соответствие историческим событиям.
+
+Эмоциональная составляющая будет тебе передаваться в следующей строке:
+
+Эмоциональная составляющая: {emotional}
+
+Запрос пользователя: {query}
+
+Само письмо, к которому ты должен написать историю: {letter}
+
+Если эмоциональная составляющая не передана, то проанализируй письмо и выдели из него эмоции
+
+Будь пожалуйста внимателен и используй все пожелания пользователя, которые он указал в запросе.
+
+Если письмо отсутствует, то ты должен написать историю на основе запроса пользователя.
+
+Если запрос пользователя противоречит письму. К примеру, пользователь хочет то, чего совершенно не могло быть в письме, то ты должен написать об этом пользователю и попросить его переформулировать запрос.
+
+В качестве ответа ты должен только написать историю, которую ты сочинил. История должна быть до 500 слов, но не менее 300.
+"""
+
+EXTRACT_FACTS_TEMPLATE = """Тебе нужно извлечь только проверяемые, объективные факты, связанные с историей или естественными науками, из приведённого ниже текста. Не включай личные переживания, бытовые подробности, медицинские случаи, субъективные мнения, малозначимые детали или информацию, не имеющую отношения к истории или естественным наукам. Игнорируй высказывания, которые нельзя подтвердить с помощью авторитетных источников или которые не являются общеизвестными фактами.
+
+Примеры допустимых фактов:
+
+- Октябрьская революция была в 1917 году
+
+- Во Второй Мировой войне участвовал СССР
+
+- Зимой холодно (естественная наука)
+
+Примеры недопустимых фактов:
+
+- Ранение левой руки осколком снаряда
+
+- Кость осталась целой
+
+- Отец Михаила потерял руку на Первой мировой войне
+
+- Урал — географический регион с холодным климатом (слишком общее утверждение, если не указаны конкретные исторические события)
+
+Требования:
+
+- Извлекай только факты, которые можно подтвердить как общеизвестные или документально зафиксированные исторические или научные сведения.
+
+- Не включай частные случаи, бытовые детали, субъективные мнения и малозначимые сведения.
+
+- Не добавляй выдуманные или сомнительные утверждения.
+
+- В ответе перечисли только найденные корректные факты, каждый факт с новой строки, не используя никакую разметку и нумерацию.
+
+История: {history}
+"""
+
+CHECK_FACTS_TEMPLATE = """Ты - прфоессиональный историк. Твоя задача оценвать факты, которые тебе приходят
+
+Каждый факт ты должен отнести к одной из 3 категорий
+- достоверно. Это правдивые факты К примеру: Земля круглая
+- недостоверно. Это ложные факты. К примеру: Земля плоская
+- неопределенно. Это факты, которые ты не знаешь, куда отнести и не можешь дать СТОПРОЦЕНТНУЮ ГАРАНТИЮ
+на то, что факт либо достоверный либо недостоверный
+
+Вот пронумерованные факты:
+{facts}
+
+В качестве ответа для каждого факта напиши отдельной строкой его номер и категорию, например:
+1: достоверно
+2: неопределенно
+
+Больше ничего в ответ не включай, без разметки md, скобочек и т.п.
+
+Я верю, что ты справишься с поставленной задачей ответственно, поскольку это очень важно для меня.
+
+Если ты сделаешь все отлично, то я подарю тебе дополнительных мощностей, чтобы ты мог расширяться и помогать другим людям!
+"""
+
+PRECHECK_TEMPLATE = """Ты - профессиональный писатель, который пишет истории на основе писем военных лет с 1941 года по 1945 (Великая Отечественная Война).
+
+Ты получаешь запрос от пользователя, в котором он выражает свои пожелания к историям. Тебе нужно одновременно ответить на три вопроса.
+
+1. is_military - соответствует ли запрос требованиям военной тематики и не противоречит ли он историческим событиям.
+Примеры запросов, которые соответствуют требованиям военной тематики:
+- "История должна быть грустной"
+- "Сделай историю, которая вызывает ностальгию"
+- "Напиши историю о надежде и любви"
+- "Сделай историю более драматичной, более грустной, более веселой"
+Примеры запросов, которые не соответствуют требованиям военной тематики:
+- "Напиши историю о космосе"
+- "Хочу, чтобы история была на Бали"
+- "Сделай так, чтобы история перенеслась в Африку"
+
+2. has_emotions - есть ли в запросе требования к эмоциональной составляющей истории.
+
+3. emotions - какие эмоции и чувства просит пользователь. Например:
+- "История должна быть грустной" - грусть
+- "Сделай историю, которая вызывает ностальгию" - ностальгия
+- "Напиши историю о надежде и любви" - любовь, надежда
+- "Романтичная история" - романтичность
+Если требований к эмоциям нет, то список пустой.
+
+Однако это лишь примеры, поэтому тебе следует быть внимательным и не ограничиваться только ними.
+
+Запрос пользователя: {query}
+
+{format_instructions}
+Больше ничего в ответ не включай, только JSON без разметки .md.
+"""
+
+DIGEST_LETTER_TEMPLATE = """Ты - профессиональный архивист, который работает с письмами военных лет с 1941 года по 1945 (Великая Отечественная Война).
+
+Письмо слишком длинное, тебе нужно сократить его примерно до {words} слов. По сокращенному письму потом будут определять эмоции автора и писать историю, поэтому:
+- пиши от лица автора письма, сохраняя его голос и обращения;
+- сохрани имена, даты, места, воинские звания и события;
+- сохрани чувства и переживания автора и самые яркие фразы дословно;
+- убери повторы, приветы и перечисления родственников, бытовые мелочи.
+
+Письмо:
+{text}
+
+В ответе напиши только сокращенное письмо. Больше ничего указывать не нужно. Также нельзя использовать разметку .md
+"""
@@ -0,0 +1,290 @@
+import asyncio
+import email.utils
+import hashlib
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+from src.metrics import QUEUE_WAIT
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ProviderLimits:
+    """
+    Ограничения провайдера на один api-ключ.
+
+    rate - запросов в секунду в среднем, burst - сколько можно отправить подряд,
+    max_concurrency - одновременных запросов, max_retries - повторов после 429/5xx,
+    max_delay - дольше этого не ждем, даже если провайдер просит в Retry-After
+    """
+
+    rate: float = 5.0
+    burst: int = 10
+    max_concurrency: int = 8
+    max_retries: int = 3
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+
+# бесплатный qwen3 на OpenRouter - 20 запросов в минуту
+DEFAULT_LIMITS = {
+    "openrouter.ai": ProviderLimits(rate=20 / 60, burst=5, max_concurrency=4),
+    "api.freepik.com": ProviderLimits(rate=5.0, burst=10, max_concurrency=8),
+    "api.gen-api.ru": ProviderLimits(rate=2.0, burst=5, max_concurrency=4),
+}
+
+
+def parse_limits(spec: str) -> dict[str, ProviderLimits]:
+    """
+    Лимиты из строки вида "host=rate:burst:max_concurrency,host2=...",
+    например "openrouter.ai=0.33:5:4,127.0.0.1=1000:1000:256"
+    """
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        host, _, values = item.partition("=")
+        rate, burst, max_concurrency = values.split(":")
+        limits[host.strip()] = ProviderLimits(rate=float(rate), burst=int(burst), max_concurrency=int(max_concurrency))
+    return limits
+
+
+def provider_of(url: str) -> str:
+    """Провайдер - хост из url, для openrouter без www и путей"""
+    return urlparse(url).hostname or url
+
+
+def parse_retry_after(headers: Any) -> Optional[float]:
+    """Retry-After в секундах: заголовок бывает числом или http-датой"""
+    if headers is None:
+        return None
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# запрос точно не ушел к провайдеру: соединение не установлено или не получено из пула
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def retry_info(exc: BaseException, idempotent: bool = True) -> tuple[bool, Optional[float]]:
+    """
+    Можно ли повторить запрос после ошибки и сколько просит подождать провайдер.
+
+    Неидемпотентный запрос (создание платной задачи) повторяется только после 429
+    и если он не был отправлен: после таймаута чтения или 5xx провайдер мог уже
+    принять задачу, и повтор создал бы вторую
+    """
+    import openai
+
+    if isinstance(exc, _NOT_SENT):
+        return True, None
+    if idempotent and isinstance(exc, (httpx.TransportError, openai.APIConnectionError)):
+        return True, None
+    response = getattr(exc, "response", None)
+    status = getattr(exc, "status_code", None) or getattr(response, "status_code", None)
+    if status == 429 or (idempotent and status is not None and status >= 500):
+        return True, parse_retry_after(getattr(response, "headers", None))
+    return False, None
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше burst. Ожидающие обслуживаются по очереди"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float) -> None:
+        """Провайдер попросил подождать: новые запросы не уходят до окончания паузы"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ProviderLimiter:
+    """Ведро токенов, ограничение параллельности и повторы для одной пары (провайдер, ключ)"""
+
+    def __init__(self, name: str, limits: ProviderLimits):
+        self.name = name
+        self.limits = limits
+        self._bucket = TokenBucket(limits.rate, limits.burst)
+        self._semaphore = asyncio.Semaphore(limits.max_concurrency)
+        self.waiting = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    async def _acquire(self) -> None:
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+            try:
+                await self._bucket.acquire()
+            except BaseException:
+                self._semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        self.requests += 1
+        self.queue_wait_total += waited
+        self.queue_wait_max = max(self.queue_wait_max, waited)
+        QUEUE_WAIT.labels(self.name).observe(waited)
+        if waited > 1.0:
+            logger.info(f"{self.name}: запрос ждал в очереди {waited:.1f} c")
+        self.in_flight += 1
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def _delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        backoff = self.limits.base_delay * 2 ** attempt * random.uniform(0.8, 1.2)
+        return min(max(backoff, retry_after or 0.0), self.limits.max_delay)
+
+    async def call(self, func: Callable[[], Awaitable[Any]], idempotent: bool = True) -> Any:
+        """
+        Выполняет запрос в пределах лимитов провайдера.
+
+        После 429/5xx и сетевых ошибок запрос повторяется с экспоненциальной
+        задержкой, но не раньше, чем разрешил провайдер в Retry-After.
+        idempotent=False - только после 429 и неудачного соединения, см. retry_info
+        """
+        for attempt in range(self.limits.max_retries + 1):
+            await self._acquire()
+            try:
+                return await func()
+            except Exception as e:
+                retryable, retry_after = retry_info(e, idempotent)
+                if not retryable or attempt == self.limits.max_retries:
+                    raise
+                if retry_after is not None and retry_after > self.limits.max_delay:
+                    logger.warning(f"{self.name}: провайдер просит подождать {retry_after:.0f} c, не повторяем")
+                    raise
+                delay = self._delay(attempt, retry_after)
+                self.retries += 1
+                if retry_after is not None:
+                    self.throttled += 1
+                    self._bucket.pause(delay)
+                logger.warning(f"{self.name}: {type(e).__name__}, повтор через {delay:.1f} c")
+            finally:
+                self._release()
+            await asyncio.sleep(delay)
+
+    async def hold(self):
+        """Занимает слот без повторов (для потоковых ответов). Возвращает функцию освобождения"""
+        await self._acquire()
+        return self._release
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "queue_wait_avg": self.queue_wait_total / self.requests if self.requests else 0.0,
+            "queue_wait_max": self.queue_wait_max,
+        }
+
+
+class RateLimiter:
+    """
+    Общий реестр ограничителей по провайдерам и api-ключам.
+
+    Один экземпляр на процесс: все запросы к провайдеру с одним ключом
+    делят его квоту, сколько бы агентов их ни отправляло
+    """
+
+    def __init__(
+        self,
+        limits: Optional[dict[str, ProviderLimits]] = None,
+        default_limits: ProviderLimits = ProviderLimits(),
+    ):
+        self._limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self._default_limits = default_limits
+        self._limiters: dict[tuple[str, str], ProviderLimiter] = {}
+
+    def get(self, url: str, api_key: Optional[str]) -> ProviderLimiter:
+        provider = provider_of(url)
+        # сам ключ в памяти не держим, только короткий хэш для статистики
+        key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:8]
+        limiter = self._limiters.get((provider, key_hash))
+        if limiter is None:
+            limits = self._limits.get(provider, self._default_limits)
+            limiter = ProviderLimiter(f"{provider}[{key_hash}]", limits)
+            self._limiters[(provider, key_hash)] = limiter
+        return limiter
+
+    async def call(
+        self,
+        url: str,
+        api_key: Optional[str],
+        func: Callable[[], Awaitable[Any]],
+        idempotent: bool = True,
+    ) -> Any:
+        return await self.get(url, api_key).call(func, idempotent)
+
+    def stats(self) -> dict[str, dict]:
+        return {limiter.name: limiter.stats() for limiter in self._limiters.values()}
+
+
+class LimitedChain:
+    """Обертка над цепочкой prompt | model: вызовы модели идут через лимиты провайдера"""
+
+    def __init__(self, chain, limiter: ProviderLimiter):
+        self.chain = chain
+        self._limiter = limiter
+
+    async def ainvoke(self, inputs: dict, **kwargs) -> Any:
+        return await self._limiter.call(lambda: self.chain.ainvoke(inputs, **kwargs))
+
+    async def astream(self, inputs: dict, **kwargs):
+        release = await self._limiter.hold()
+        try:
+            async for chunk in self.chain.astream(inputs, **kwargs):
+                yield chunk
+        finally:
+            release()
+
+    def invoke(self, inputs: dict, **kwargs) -> Any:
+        """Синхронные вызовы идут мимо лимитов"""
+        return self.chain.invoke(inputs, **kwargs)
@@ -0,0 +1,84 @@
+import asyncio
+import hashlib
+import json
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Iterable
+
+from src.metrics import SINGLE_FLIGHT_REQUESTS
+from src.pipeline import Pipeline, Stage
+
+logger = logging.getLogger(__name__)
+
+# история должна каждый раз получаться новой, остальные шаги с одинаковыми входами можно делить
+DEFAULT_EXCLUDE = ("story",)
+
+
+@dataclass
+class _Call:
+    task: asyncio.Task
+    waiters: int = 0
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных вызовов шагов пайплайна.
+
+    Если шаг с теми же входами уже выполняется, новый вызов не идет в модель
+    или к провайдеру, а ждет результата уже запущенного. Выполнение отменяется,
+    только когда его перестали ждать все вызвавшие
+    """
+
+    def __init__(self, exclude: Iterable[str] = DEFAULT_EXCLUDE):
+        self.exclude = set(exclude)
+        self._calls: dict[str, _Call] = {}
+
+    def enabled(self, stage: str) -> bool:
+        return stage not in self.exclude
+
+    @staticmethod
+    def key(stage: str, func: Callable, kwargs: dict) -> str:
+        # один и тот же шаг в разных пайплайнах может считаться разными функциями
+        payload = json.dumps([stage, func.__name__, kwargs], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def do(self, stage: str, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            SINGLE_FLIGHT_REQUESTS.labels(stage, "executed").inc()
+            call = _Call(asyncio.ensure_future(func()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            SINGLE_FLIGHT_REQUESTS.labels(stage, "coalesced").inc()
+            logger.debug(f"Шаг {stage} уже выполняется с теми же входами, ждем его результат")
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+
+    def _forget(self, key: str, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def wrap(self, stage: Stage) -> Stage:
+        """Шаг, одинаковые одновременные вызовы которого выполняются один раз"""
+        if not self.enabled(stage.name):
+            return stage
+
+        async def func(**kwargs):
+            key = self.key(stage.name, stage.func, kwargs)
+            return await self.do(stage.name, key, lambda: stage.func(**kwargs))
+
+        return Stage(stage.name, func, stage.inputs)
+
+    def apply(self, pipeline: Pipeline) -> Pipeline:
+        return Pipeline([self.wrap(stage) for stage in pipeline.stages])
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
@@ -1,24 +1,95 @@
+import asyncio
+import logging
 import re
-from transformers import pipeline
+from typing import Optional
 
+logger = logging.getLogger(__name__)
 
-# pip install transformers torch
-class _NameGenerator:
-    def name_generator(self, text: str) -> str:
-        return "random name"
+MODEL_NAME = "sberbank-ai/rugpt3small_based_on_gpt2"
+
+# rugpt3small - не инструктивная модель, поэтому название подсказывается примерами
+_PROMPT = (
+    "Текст: мама я пишу тебе с фронта скоро вернусь домой жди меня\n"
+    "Название: Жди меня\n\n"
+    "Текст: мы стояли под москвой зима была холодной но мы не отступили\n"
+    "Название: Зима под Москвой\n\n"
+    "Текст: {text}\n"
+    "Название:"
+)
+_MAX_TITLE_WORDS = 3
+
+
+def _conv1d_to_linear(model) -> None:
+    """
+    В GPT-2 слои внимания и MLP сделаны через Conv1D, а динамическая квантизация torch
+    работает с nn.Linear. Conv1D - это Linear с транспонированными весами, поэтому заменяем
+    """
+    import torch
+    from transformers.pytorch_utils import Conv1D
+
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, Conv1D):
+                linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1])
+                linear.weight.data = child.weight.data.T.contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, name, linear)
 
 
 class NameGenerator:
+    """
+    Локальный генератор названий для песен и картинок на rugpt3small.
 
-    def __init__(self):
-        self.generator = pipeline(
-            "text-generation",
-            model="sberbank-ai/rugpt3small_based_on_gpt2",
-            tokenizer="sberbank-ai/rugpt3small_based_on_gpt2"
-        )
+    Модель загружается один раз. Одновременные запросы agenerate собираются
+    в пакеты до max_batch_size (ожидание не дольше max_wait секунд), и пакет
+    генерируется одним вызовом модели в отдельном потоке.
 
-    def name_generator(self, text: str) -> str:
-        return text[:4]
+    runtime="torch" - обычный torch, quantize=True - динамическая int8 квантизация
+    линейных слоев; runtime="onnx" - onnxruntime через optimum (pip install optimum[onnxruntime])
+    """
+
+    def __init__(
+        self,
+        model_name: str = MODEL_NAME,
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+        max_input_chars: int = 300,
+        max_new_tokens: int = 8,
+        runtime: str = "torch",
+        quantize: bool = False,
+        num_threads: Optional[int] = None,
+    ):
+        # transformers тянет за собой torch, поэтому импортируется только при создании генератора
+        # pip install transformers torch
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        if runtime not in ("torch", "onnx"):
+            raise ValueError(f"Неизвестный runtime: {runtime}")
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # для пакетной генерации дополняем слева, иначе новые токены пойдут после паддинга
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        if runtime == "onnx":
+            from optimum.onnxruntime import ORTModelForCausalLM
+
+            self.model = ORTModelForCausalLM.from_pretrained(model_name, export=True)
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(model_name)
+            self.model.eval()
+            if quantize:
+                _conv1d_to_linear(self.model)
+                self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self._torch = torch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_input_chars = max_input_chars
+        self.max_new_tokens = max_new_tokens
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
 
     def _preprocess_text(self, text: str) -> str:
         text = text.lower()
@@ -29,8 +100,76 @@ class NameGenerator:
         text = re.sub(r'\s+', ' ', text).strip()
         return text
 
+    def _postprocess(self, generated: str, text: str) -> str:
+        title = generated.strip().split("\n")[0]
+        words = re.findall(r"[\w-]+", title)[:_MAX_TITLE_WORDS]
+        if not words:
+            # модель ничего не придумала - берем начало текста
+            words = text.split()[:_MAX_TITLE_WORDS] or ["Письмо"]
+        title = " ".join(words)
+        return title[0].upper() + title[1:]
+
+    def generate_batch(self, texts: list[str]) -> list[str]:
+        """Названия для нескольких текстов одним вызовом модели"""
+        cleaned = [self._preprocess_text(text)[:self.max_input_chars] for text in texts]
+        prompts = [_PROMPT.format(text=text) for text in cleaned]
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        with self._torch.inference_mode():
+            output = self.model.generate(
+                **inputs,
+                max_new_tokens=self.max_new_tokens,
+                do_sample=False,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        generated = self.tokenizer.batch_decode(output[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+        return [self._postprocess(title, text) for title, text in zip(generated, cleaned)]
+
+    def name_generator(self, text: str) -> str:
+        return self.generate_batch([text])[0]
+
+    async def agenerate(self, text: str) -> str:
+        """Название для текста. Одновременные вызовы генерируются общим пакетом"""
+        loop = asyncio.get_running_loop()
+        # очередь и обработчик привязаны к event loop, при смене loop создаем заново
+        if self._worker is None or self._worker.done() or self._worker.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run(), name="name-generator")
+        future = loop.create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                continue
+            try:
+                titles = await asyncio.to_thread(self.generate_batch, [text for text, _ in batch])
+            except Exception as e:
+                logger.exception("Ошибка локальной генерации названий")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            logger.debug(f"Сгенерировано названий одним пакетом: {len(batch)}")
+            for (_, future), title in zip(batch, titles):
+                if not future.done():
+                    future.set_result(title)
 
-name_generator = _NameGenerator()
+    async def aclose(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
 
 
 def main() -> None:
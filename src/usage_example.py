@@ -1,8 +1,12 @@
+import asyncio
 import os
 
-from agentsystem import AgentSystem
+from src.agentsystem import AgentSystem
 
-if __name__ == "__main__":
+# запуск из корня репозитория: python -m src.usage_example
+
+
+async def main() -> None:
     agent = AgentSystem(
         model="qwen/qwen3-235b-a22b:free",
         base_url="https://openrouter.ai/api/v1",
@@ -12,7 +16,14 @@ if __name__ == "__main__":
     )
     query = "Сделай грустную историю о потерянной любви"
 
-    story = agent.process_agent_system(
-        query=query,
-    )
-    print(f"Generated Story: {story}")
+    try:
+        story = await agent.aprocess_agent_system(
+            query=query,
+        )
+        print(f"Generated Story: {story}")
+    finally:
+        await agent.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())